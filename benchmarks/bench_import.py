@@ -0,0 +1,158 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+"""
+Benchmark of the time the plugin adds to starting Sublime Text, outside of the editor.
+
+commands.py is imported the way the editor loads it, each run in a fresh process,
+with the reactor, twisted and the negotiators started either lazily on the first
+command or eagerly while loading (lazy_startup false):
+
+- load: importing commands.py and creating the CollaborateCommand instance
+- first command: running the first collaborate task, which includes the deferred startup
+
+Run with the python 2 the plugin runs on, from the root of the package:
+
+    python benchmarks/bench_import.py
+    python benchmarks/bench_import.py --runs 20 --accounts 10 --json results.json
+"""
+import imp, json, optparse, os, subprocess, sys, time, traceback
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_DIR = os.path.dirname(BENCHMARKS_DIR)
+COMMANDS_PATH = os.path.join(PACKAGE_DIR, 'commands.py')
+MODES = ('lazy', 'eager')
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) / 2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def runChild(options):
+    """
+    Load the plugin once in this process and print the timings as JSON.
+    """
+    for path in (os.path.join(PACKAGE_DIR, 'libs'), BENCHMARKS_DIR):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    import sublime
+    # the editor main loop is not run here, so nothing handed to it would ever run
+    sublime.set_timeout = lambda callback, delay: None
+    accounts = {'connect_all_on_startup': False, 'lazy_startup': options.mode == 'lazy'}
+    if options.accounts > 0:
+        accounts['irc'] = [{'host': 'irc%d.example.com' % idx, 'port': 6667, 'username': 'bench%d' % idx, 'channel': 'bench'}
+            for idx in range(options.accounts)]
+    sublime.load_settings('Accounts.sublime-settings').set('subliminal_collaborator', accounts)
+    modulesBefore = len([module for module in sys.modules.values() if module is not None])
+    try:
+        startedAt = time.time()
+        commands = imp.load_source('commands', COMMANDS_PATH)
+        command = commands.CollaborateCommand()
+        loadedAt = time.time()
+        modulesLoaded = len([module for module in sys.modules.values() if module is not None]) - modulesBefore
+        reactorLoaded = 'twisted.internet.reactor' in sys.modules
+        command.run('showConnectedChats')
+        finishedAt = time.time()
+        if not commands.BOOTSTRAPPED:
+            # the command logs why and carries on, as it does in the editor
+            raise RuntimeError('plugin failed to start')
+    except Exception:
+        traceback.print_exc()
+        sys.stderr.flush()
+        os._exit(1)
+    print json.dumps({'mode': options.mode, 'load': (loadedAt - startedAt) * 1000, 'firstCommand': (finishedAt - loadedAt) * 1000,
+        'modules': modulesLoaded, 'reactorLoaded': reactorLoaded, 'negotiators': len(commands.registry.listNegotiatorKeys())})
+    sys.stdout.flush()
+    # the reactor thread, if started, would keep the process alive
+    os._exit(0)
+
+
+def runBenchmark(mode, options):
+    """
+    @return: C{list} of the C{dict} results of each run, or None if a run failed
+    """
+    results = []
+    for run in range(options.runs):
+        args = [sys.executable, os.path.abspath(__file__), '--child', '--mode', mode, '--accounts', str(options.accounts)]
+        # logging.cfg is read from the working directory, as in the editor
+        child = subprocess.Popen(args, stdout=subprocess.PIPE, cwd=PACKAGE_DIR)
+        output = child.communicate()[0]
+        lines = output.strip().splitlines()
+        if (child.returncode != 0) or (len(lines) == 0):
+            return None
+        results.append(json.loads(lines[-1]))
+    return results
+
+
+def summarize(mode, results):
+    return {'mode': mode, 'runs': len(results),
+        'load': median([result['load'] for result in results]),
+        'firstCommand': median([result['firstCommand'] for result in results]),
+        'modules': results[-1]['modules'], 'reactorLoaded': results[-1]['reactorLoaded'],
+        'negotiators': results[-1]['negotiators']}
+
+
+def describe(summary):
+    if 'error' in summary:
+        return '%-6s ERROR %s' % (summary['mode'], summary['error'])
+    return '%-6s load %7.1f ms  first command %7.1f ms  %4d modules loaded%s' % (summary['mode'], summary['load'],
+        summary['firstCommand'], summary['modules'], summary['reactorLoaded'] and ', reactor started' or '')
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--modes', default=','.join(MODES), help='comma separated startup modes, of %s' % ', '.join(MODES))
+    parser.add_option('--runs', type='int', default=5, help='fresh processes the plugin is loaded in per mode, the median is reported [default: %default]')
+    parser.add_option('--accounts', type='int', default=3, help='irc accounts configured, a negotiator is created for each [default: %default]')
+    parser.add_option('--json', dest='jsonFile', help='also write the results to this file')
+    # a single run, by the parent process
+    parser.add_option('--child', action='store_true', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--mode', help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+    if options.child:
+        runChild(options)
+        return 0
+    summaries = []
+    for mode in [mode for mode in options.modes.split(',') if mode]:
+        results = runBenchmark(mode, options)
+        if results is None:
+            summary = {'mode': mode, 'error': 'a run exited with an error'}
+        else:
+            summary = summarize(mode, results)
+        print describe(summary)
+        sys.stdout.flush()
+        summaries.append(summary)
+    if options.jsonFile:
+        jsonFile = open(options.jsonFile, 'w')
+        try:
+            json.dump(summaries, jsonFile, indent=2, sort_keys=True)
+        finally:
+            jsonFile.close()
+    failed = [summary for summary in summaries if 'error' in summary]
+    return len(failed) > 0 and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
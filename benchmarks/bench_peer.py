@@ -0,0 +1,340 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+"""
+Benchmarks of a host and a partner sharing a view, outside of the editor.
+
+Each benchmark runs in its own process so that the peak memory reported is its own:
+
+- share: time for the partner to receive and apply a view of a given size
+- throughput: edits per second the partner applies while the host edits as fast as it can
+- latency: time from a host edit to the partner applying it, while the host types steadily
+- relay: a host, an early partner and a late joiner sharing a view through a relay hub
+  running in the same process, while the host types steadily
+- broadcast: a broadcast to three early watchers and a late one, while the host types steadily
+
+In the relay and broadcast benchmarks the first follower falls behind by more than
+LAG_BACKLOG bytes part way through and is sent the view again; they report the time
+all followers take to settle on the host view once the host stops typing.  They
+listen on loopback TCP whatever the transports asked for.
+
+Every benchmark runs on each of the view sizes, so costs that grow with the size of
+the view show up as such.
+
+Run with the python 2 the plugin runs on, from the root of the package:
+
+    python benchmarks/bench_peer.py
+    python benchmarks/bench_peer.py --sizes 1K,1M --transports loopback --json results.json
+"""
+import harness
+from harness import reactor, sublime
+from sub_collab import relay
+from sub_collab.peer import base, basic, broadcast
+import json, optparse, os, random, subprocess, sys, time
+
+SCENARIOS = ('share', 'throughput', 'latency', 'relay', 'broadcast')
+# benchmarks of a host shared with followers through a listening port, run on tcp only
+FOLLOWER_SCENARIOS = ('relay', 'broadcast')
+DEFAULT_SIZES = '1K,64K,1M,10M,50M'
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024 * 1024}
+# bytes a relay partner or broadcast watcher may fall behind by in the follower benchmarks
+LAG_BACKLOG = 4096
+# seconds the followers have to settle on the host view once the host stops typing
+SETTLE_TIMEOUT = 60
+
+
+def parseSize(size):
+    size = size.strip().upper()
+    if size[-1:] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+
+def formatSize(size):
+    for suffix, factor in (('M', 1024 * 1024), ('K', 1024)):
+        if (size >= factor) and (size % factor == 0):
+            return '%d%s' % (size / factor, suffix)
+    return str(size)
+
+
+def shareScenario(finished, transport, size):
+    pair = harness.PeerPair(transport)
+    view = sublime.View(harness.makeText(size))
+    started = []
+    def shared():
+        elapsed = time.time() - started[0]
+        converged = pair.partner.view.substr(sublime.Region(0, pair.partner.view.size())) == view.substr(sublime.Region(0, view.size()))
+        pair.stop()
+        finished({'seconds': elapsed, 'mbPerSecond': size / elapsed / (1024 * 1024), 'converged': converged})
+    pair.connect()
+    started.append(time.time())
+    pair.share(view, shared)
+
+
+def editScenario(finished, transport, size, edits, interval, burst):
+    """
+    Host inserts edits characters at random offsets, burst of them every interval
+    seconds, and the partner checks each one off as its view grows.
+    """
+    pair = harness.PeerPair(transport)
+    view = sublime.View(harness.makeText(size))
+    rand = random.Random(1)
+    sentTimes = []
+    latencies = []
+    timing = {}
+    def edit():
+        for i in range(min(burst, edits - len(sentTimes))):
+            harness.typeText(view, rand.randint(0, view.size()), u'x')
+            sentTimes.append(time.time())
+            pair.host.sendViewEdits()
+        if len(sentTimes) < edits:
+            reactor.callLater(interval, edit)
+    def applied():
+        now = time.time()
+        while len(latencies) < pair.partner.view.size() - size:
+            latencies.append(now - sentTimes[len(latencies)])
+        if len(latencies) == edits:
+            elapsed = now - timing['started']
+            converged = pair.partner.view.substr(sublime.Region(0, pair.partner.view.size())) == view.substr(sublime.Region(0, view.size()))
+            pair.stop()
+            latencies.sort()
+            finished({
+                'seconds': elapsed,
+                'editsPerSecond': edits / elapsed,
+                'p50': harness.percentile(latencies, 0.5) * 1000.0,
+                'p90': harness.percentile(latencies, 0.9) * 1000.0,
+                'p99': harness.percentile(latencies, 0.99) * 1000.0,
+                'max': latencies[-1] * 1000.0,
+                'converged': converged
+            })
+    def start():
+        timing['started'] = time.time()
+        edit()
+    pair.partnerAppliedHooks.append(applied)
+    pair.connect()
+    pair.share(view, lambda: pair.whenEditsFlowing(start))
+
+
+def followScenario(finished, size, edits, interval, host, hostSide, addFollower, earlyFollowers):
+    """
+    Host shares a view with earlyFollowers followers then types edits characters, one
+    every interval seconds, and another follower joins half way through.  A quarter
+    of the way through, the connection to the first follower takes no more writes
+    until it has fallen behind by more than LAG_BACKLOG bytes, then catches up and is
+    sent the view again.
+
+    @param host: C{BasicPeer} connected as the host, with nothing shared yet
+    @param hostSide: callable returning the protocol instance the host side keeps for a follower, None until accepted
+    @param addFollower: callable connecting and returning a new follower C{BasicPeer}
+    """
+    view = sublime.View(harness.makeText(size))
+    rand = random.Random(1)
+    followers = [addFollower() for i in range(earlyFollowers)]
+    progress = {'typed': 0, 'lagging': None, 'fellBehind': False}
+    def allSettled():
+        for follower in followers:
+            if (follower.view is None) or (harness.viewText(follower.view) != harness.viewText(view)):
+                return False
+        return True
+    def edit():
+        harness.typeText(view, rand.randint(0, view.size()), u'x')
+        host.sendViewEdits()
+        progress['typed'] += 1
+        typed = progress['typed']
+        lagging = progress['lagging']
+        if typed == edits / 4:
+            lagging = progress['lagging'] = hostSide(followers[0])
+            lagging.streamProducers.pauseProducing()
+        elif (lagging is not None) and (lagging.follower.dropped or (typed == edits * 3 / 4)):
+            progress['fellBehind'] = lagging.follower.dropped
+            progress['lagging'] = None
+            lagging.streamProducers.resumeProducing()
+        if typed == edits / 2:
+            followers.append(addFollower())
+        if typed < edits:
+            reactor.callLater(interval, edit)
+        else:
+            progress['typedAt'] = time.time()
+            settle()
+    def settle():
+        now = time.time()
+        converged = allSettled()
+        if (not converged) and (now - progress['typedAt'] < SETTLE_TIMEOUT):
+            reactor.callLater(0.01, settle)
+            return
+        for peer in [host] + followers:
+            peer.viewMonitorThread.destroy()
+        finished({
+            'seconds': progress['typedAt'] - progress['started'],
+            'settleSeconds': now - progress['typedAt'],
+            'followers': len(followers),
+            'fellBehind': progress['fellBehind'],
+            'converged': converged
+        })
+    def start():
+        progress['started'] = time.time()
+        edit()
+    def connected():
+        host.startCollab(view)
+        harness.waitFor(allSettled, lambda: harness.waitFor(hostEditsFlowing, start))
+    def hostEditsFlowing():
+        return (host.heldEdits is None) and host.peerEditsAccepted
+    def accepted():
+        for follower in followers:
+            if (follower.transport is None) or (hostSide(follower) is None):
+                return False
+        # a host listening for its followers is only connected once sharing
+        return (host.peerType == base.SERVER) or (host.state == base.STATE_CONNECTED)
+    harness.waitFor(accepted, connected)
+
+
+def relayScenario(finished, size, edits, interval):
+    relay.MAX_PARTNER_BACKLOG = LAG_BACKLOG
+    hub = relay.RelayHub()
+    port = reactor.listenTCP(0, hub, interface='127.0.0.1').getHost().port
+    host = basic.BasicPeer('relay', harness.BenchNegotiator('bench-host'))
+    host.relayConnect('127.0.0.1', port, 'bench', base.HOST_ROLE)
+    partners = []
+    def addPartner():
+        partner = basic.BasicPeer('relay', harness.BenchNegotiator('bench-partner-%d' % len(partners)))
+        partner.relayConnect('127.0.0.1', port, 'bench', base.PARTNER_ROLE)
+        partners.append(partner)
+        return partner
+    def hostSide(partner):
+        if 'bench' not in hub.rooms:
+            return None
+        return harness.hostSideOf(partner, hub.rooms['bench'].partners)
+    followScenario(finished, size, edits, interval, host, hostSide, addPartner, 1)
+
+
+def broadcastScenario(finished, size, edits, interval):
+    broadcast.MAX_WATCHER_BACKLOG = LAG_BACKLOG
+    host = broadcast.BroadcastPeer(harness.BenchNegotiator('bench-host'))
+    port = host.hostConnect(0, '127.0.0.1')
+    watchers = []
+    def addWatcher():
+        watcher = basic.BasicPeer('host', harness.BenchNegotiator('bench-watcher-%d' % len(watchers)))
+        watcher.clientConnect('127.0.0.1', port)
+        watchers.append(watcher)
+        return watcher
+    def hostSide(watcher):
+        return harness.hostSideOf(watcher, host.watchers)
+    followScenario(finished, size, edits, interval, host, hostSide, addWatcher, 3)
+
+
+def runChild(options):
+    """
+    Run a single benchmark in this process and print its result as JSON.
+    """
+    size = parseSize(options.size)
+    if options.scenario == 'share':
+        result = harness.runScenario(shareScenario, options.timeout, options.transport, size)
+    elif options.scenario == 'throughput':
+        result = harness.runScenario(editScenario, options.timeout, options.transport, size, options.edits, 0, 50)
+    elif options.scenario == 'latency':
+        result = harness.runScenario(editScenario, options.timeout, options.transport, size, options.edits / 4, options.interval / 1000.0, 1)
+    elif options.scenario == 'relay':
+        result = harness.runScenario(relayScenario, options.timeout, size, options.edits / 4, options.interval / 1000.0)
+    else:
+        result = harness.runScenario(broadcastScenario, options.timeout, size, options.edits / 4, options.interval / 1000.0)
+    result.update({'scenario': options.scenario, 'transport': options.transport, 'size': size})
+    print json.dumps(result)
+
+
+def runBenchmark(scenario, transport, size, options):
+    """
+    @return: C{dict} result of a benchmark run in a child process
+    """
+    args = [sys.executable, os.path.abspath(__file__), '--child', '--scenario', scenario, '--transport', transport,
+        '--size', str(size), '--edits', str(options.edits), '--interval', str(options.interval), '--timeout', str(options.timeout)]
+    child = subprocess.Popen(args, stdout=subprocess.PIPE)
+    output = child.communicate()[0]
+    lines = output.strip().splitlines()
+    if (child.returncode != 0) or (len(lines) == 0):
+        return {'scenario': scenario, 'transport': transport, 'size': size, 'error': 'exited with %s' % child.returncode}
+    return json.loads(lines[-1])
+
+
+def describe(result):
+    label = '%-10s %-8s %5s' % (result['scenario'], result['transport'], formatSize(result['size']))
+    if 'error' in result:
+        return '%s  ERROR %s' % (label, result['error'])
+    memory = ''
+    if result.get('peakMemory') is not None:
+        memory = '  peak %6.1f MB' % (result['peakMemory'] / (1024.0 * 1024.0))
+    converged = ''
+    if not result['converged']:
+        converged = '  NOT CONVERGED'
+    if result['scenario'] == 'share':
+        details = '%8.3f s  %7.2f MB/s' % (result['seconds'], result['mbPerSecond'])
+    elif result['scenario'] == 'throughput':
+        details = '%8.0f edits/s' % result['editsPerSecond']
+    elif result['scenario'] in FOLLOWER_SCENARIOS:
+        details = 'settled in %6.3f s  %d followers' % (result['settleSeconds'], result['followers'])
+        if not result['fellBehind']:
+            details += '  NONE FELL BEHIND'
+    else:
+        details = 'p50 %6.2f ms  p90 %6.2f ms  p99 %6.2f ms  max %6.2f ms' % (result['p50'], result['p90'], result['p99'], result['max'])
+    return '%s  %s%s%s' % (label, details, memory, converged)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--scenarios', default=','.join(SCENARIOS), help='comma separated benchmarks to run, of %s' % ', '.join(SCENARIOS))
+    parser.add_option('--transports', default=','.join(harness.TRANSPORTS), help='comma separated transports, of %s' % ', '.join(harness.TRANSPORTS))
+    parser.add_option('--sizes', default=DEFAULT_SIZES, help='comma separated view sizes to run the benchmarks on [default: %default]')
+    parser.add_option('--edits', type='int', default=2000, help='edits made by the throughput benchmark, a quarter of that by the others [default: %default]')
+    parser.add_option('--interval', type='float', default=10, help='milliseconds between edits of the latency, relay and broadcast benchmarks [default: %default]')
+    parser.add_option('--timeout', type='float', default=600, help='seconds after which a benchmark is given up on [default: %default]')
+    parser.add_option('--json', dest='jsonFile', help='also write the results to this file')
+    # a single benchmark, run by the parent process
+    parser.add_option('--child', action='store_true', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--scenario', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--transport', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--size', help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+    if options.child:
+        runChild(options)
+        return 0
+    results = []
+    for scenario in [scenario for scenario in options.scenarios.split(',') if scenario]:
+        sizes = [size for size in options.sizes.split(',') if size]
+        transports = [transport for transport in options.transports.split(',') if transport]
+        if scenario in FOLLOWER_SCENARIOS:
+            transports = ['tcp']
+        for transport in transports:
+            for size in sizes:
+                result = runBenchmark(scenario, transport, parseSize(size), options)
+                print describe(result)
+                sys.stdout.flush()
+                results.append(result)
+    if options.jsonFile:
+        jsonFile = open(options.jsonFile, 'w')
+        try:
+            json.dump(results, jsonFile, indent=2, sort_keys=True)
+        finally:
+            jsonFile.close()
+    failed = [result for result in results if ('error' in result) or (not result['converged']) or (not result.get('fellBehind', True))]
+    return len(failed) > 0 and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
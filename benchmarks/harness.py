@@ -0,0 +1,248 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+
+# Two peers sharing a view outside of the editor, for the benchmarks in bench_peer.py.
+#
+# The sublime module stand-in next to this file is put ahead of everything else
+# on the path, then the plugin libs, so that sub_collab imports as it does in
+# the editor.  Everything runs on the reactor thread, which plays the part of
+# the editor main thread.
+import os, sys
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+LIBS_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'libs')
+for path in (LIBS_DIR, BENCHMARKS_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+import sublime
+from twisted.internet import reactor
+from twisted.protocols import loopback
+from sub_collab.peer import base, basic
+from sub_collab import registry
+import random, time
+
+try:
+    import resource
+except ImportError:
+    # not available on windows
+    resource = None
+
+TRANSPORTS = ('tcp', 'loopback')
+
+
+class BenchNegotiator(object):
+    """
+    Stands in for the chat negotiator a session is started from.
+    """
+    observers = set()
+
+    def __init__(self, negotiatorId):
+        self.negotiatorId = negotiatorId
+        registry.negotiators[negotiatorId] = self
+
+    def getId(self):
+        return self.negotiatorId
+
+
+class PeerPair(object):
+    """
+    A host and a partner BasicPeer connected over loopback TCP or an in-memory
+    twisted.protocols.loopback transport.
+    """
+
+
+    def __init__(self, transport='tcp'):
+        """
+        @param transport: C{str} one of TRANSPORTS
+        """
+        self.transport = transport
+        self.host = basic.BasicPeer('partner', BenchNegotiator('bench-host'))
+        self.partner = basic.BasicPeer('host', BenchNegotiator('bench-partner'))
+        self.partnerAppliedHooks = []
+        self.partnerSharedHooks = []
+        partnerRecvEditOps = self.partner.recvEditOps
+        def recvEditOps(ops):
+            partnerRecvEditOps(ops)
+            for hook in self.partnerAppliedHooks:
+                hook()
+        self.partner.recvEditOps = recvEditOps
+        partnerOnStartCollab = self.partner.onStartCollab
+        def onStartCollab():
+            partnerOnStartCollab()
+            for hook in self.partnerSharedHooks:
+                hook()
+        self.partner.onStartCollab = onStartCollab
+
+
+    def connect(self):
+        """
+        Connect the peers, must be called from the reactor thread.
+        """
+        if self.transport == 'tcp':
+            port = self.host.hostConnect(0, '127.0.0.1')
+            self.partner.clientConnect('127.0.0.1', port)
+            return
+        for peer, peerType, role in ((self.host, base.SERVER, base.HOST_ROLE), (self.partner, base.CLIENT, base.PARTNER_ROLE)):
+            peer.peerType = peerType
+            peer.role = role
+            peer.state = base.STATE_CONNECTING
+        self.partner.host = 'loopback'
+        self.partner.port = 0
+        loopback.loopbackAsync(self.host, self.partner)
+        # the partner opens the CONNECTED handshake once connected, see BasicPeer.buildProtocol()
+        self.partner.buildProtocol(None)
+
+
+    def share(self, view, onShared):
+        """
+        Share a view with the partner.
+
+        @param onShared: callable invoked once the partner has applied the whole view
+        """
+        def shared():
+            self.partnerSharedHooks.remove(shared)
+            onShared()
+        self.partnerSharedHooks.append(shared)
+        self.host.startCollab(view)
+
+
+    def whenEditsFlowing(self, callback):
+        """
+        Call back once edits made by the host are no longer held back for the share in progress.
+        """
+        if (self.host.heldEdits is not None) or (not self.host.peerEditsAccepted):
+            reactor.callLater(0.01, self.whenEditsFlowing, callback)
+        else:
+            callback()
+
+
+    def stop(self):
+        for peer in (self.host, self.partner):
+            peer.viewMonitorThread.destroy()
+
+
+def typeText(view, point, text):
+    """
+    Insert text into a view as typing it at the given point in the editor does,
+    leaving the caret after it.
+    """
+    viewEdit = view.begin_edit()
+    view.insert(viewEdit, point, text)
+    view.end_edit(viewEdit)
+    view.sel().clear()
+    view.sel().add(sublime.Region(point + len(text)))
+    view._lastCommand = ('insert', {'characters': text}, 1)
+
+
+def viewText(view):
+    """
+    @return: C{unicode} contents of the whole view
+    """
+    return view.substr(sublime.Region(0, view.size()))
+
+
+def waitFor(condition, callback, interval=0.01):
+    """
+    Call back once condition() holds, checking it every interval seconds.
+    """
+    if condition():
+        callback()
+    else:
+        reactor.callLater(interval, waitFor, condition, callback, interval)
+
+
+def hostSideOf(peer, connections):
+    """
+    @param peer: client-side C{BasicPeer} connected over TCP
+    @param connections: protocol instances accepted by the listening end
+
+    @return: the protocol instance of connections at the other end of the connection of peer, None if not accepted yet
+    """
+    port = peer.transport.getHost().port
+    for connection in connections:
+        if connection.transport.getPeer().port == port:
+            return connection
+    return None
+
+
+def makeText(size, seed=0):
+    """
+    @return: C{unicode} text of about size characters, in lines of source-code-like words
+    """
+    rand = random.Random(seed)
+    words = [u'def', u'self', u'return', u'import', u'view', u'peer', u'None', u'(x)', u'+=', u'\u00e9t\u00e9']
+    lines = []
+    total = 0
+    while total < size:
+        line = u'    ' * rand.randint(0, 3) + u' '.join([rand.choice(words) for i in range(rand.randint(2, 12))])
+        lines.append(line)
+        total += len(line) + 1
+    return u'\n'.join(lines)[:size]
+
+
+def percentile(values, fraction):
+    """
+    @param values: sorted C{list} of numbers
+    @param fraction: C{float} between 0 and 1
+
+    @return: value at the given fraction of the list, nearest rank
+    """
+    if len(values) == 0:
+        return None
+    index = max(0, min(len(values) - 1, int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def peakMemory():
+    """
+    @return: C{int} peak resident memory of this process in bytes, None if unknown
+    """
+    if resource is None:
+        return None
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxRss
+    return maxRss * 1024
+
+
+def runScenario(scenario, timeout, *args):
+    """
+    Run a scenario on the reactor and return its result.
+
+    @param scenario: callable taking a callback for its result C{dict} and any further args
+    @param timeout: C{float} seconds after which the scenario is given up on
+
+    @return: C{dict} result of the scenario, with an 'error' if it timed out
+    """
+    result = {}
+    def finished(scenarioResult):
+        if not result:
+            result.update(scenarioResult)
+            reactor.stop()
+    def timedOut():
+        finished({'error': 'timed out after %ds' % timeout})
+    reactor.callWhenRunning(scenario, finished, *args)
+    reactor.callLater(timeout, timedOut)
+    reactor.run(installSignalHandlers=False)
+    result['peakMemory'] = peakMemory()
+    return result
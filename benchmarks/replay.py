@@ -0,0 +1,364 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+"""
+Replay a session recording into a headless peer.
+
+The messages the recorded peer received are fed to a new peer of the same
+role, at the pace they were received or faster, and what that peer sends in
+return is discarded.  Edits the recorded partner made itself with concurrent
+editing are made again at the same point of the edit history, so replaying a
+partner-side recording rebuilds the shared views just as the partner had them.
+Recordings of real sessions can so be used to reproduce stalls and as load for
+benchmarks.
+
+Record sessions by setting the "record_dir" session setting, then run from
+the root of the package:
+
+    python benchmarks/replay.py ~/collab-recordings/nick-20140301-101500-client.screc
+    python benchmarks/replay.py --speed 10 recording.screc
+    python benchmarks/replay.py --speed 0 recording.screc.2 recording.screc.1 recording.screc
+
+Given a single file, its older rotated files are replayed ahead of it.  A
+recording starting in the middle of a session, its older files rotated away,
+is replayed on top of an empty view, and compressed view chunks or edits can
+only be replayed from the next time the view is (re)shared on.
+"""
+import harness
+from harness import reactor, sublime
+from sub_collab.peer import base, ot, recorder, resume, stats
+from zope.interface import implements
+from twisted.internet import interfaces
+import logging, optparse, struct, sys, time, zlib
+
+HEADER_FMT = harness.basic.BasicPeer.messageHeaderFmt
+HEADER_SIZE = struct.calcsize(HEADER_FMT)
+CHANNEL_ID_FMT = harness.basic.BasicPeer.channelIdFmt
+CHANNEL_ID_SIZE = struct.calcsize(CHANNEL_ID_FMT)
+EDIT_COUNTS_FMT = harness.basic.BasicPeer.editCountsFmt
+EDIT_COUNTS_SIZE = struct.calcsize(EDIT_COUNTS_FMT)
+
+
+def parseFrame(frame):
+    """
+    @return: (messageType, messageSubType, sequence, payload) C{tuple}, sequence being None if not sequenced
+    """
+    magicNumber = struct.unpack('!H', frame[:2])[0]
+    if magicNumber == resume.SEQUENCED_MAGIC_NUMBER:
+        magicNumber, messageType, messageSubType, sequence = struct.unpack(resume.SEQUENCED_HEADER_FMT, frame[:resume.SEQUENCED_HEADER_SIZE])
+        return messageType, messageSubType, sequence, frame[resume.SEQUENCED_HEADER_SIZE:]
+    magicNumber, messageType, messageSubType = struct.unpack(HEADER_FMT, frame[:HEADER_SIZE])
+    return messageType, messageSubType, None, frame[HEADER_SIZE:]
+
+
+class SessionHistory(object):
+    """
+    Edit history of one session of the recording, the connection itself or one of its channels.
+    """
+
+    def __init__(self, compressedEdits):
+        # views received, the edit counts start over with each one
+        self.viewsReceived = 0
+        # END_OF_VIEW_ACK sent, local edits made after the n-th belong to the n-th view
+        self.viewsAcknowledged = 0
+        # peer operations received for the current view
+        self.operationsReceived = 0
+        # (view, number) of peer operations -> index of the event applying it
+        self.operationEvents = {}
+        self.editDecompressor = None
+        if compressedEdits:
+            self.editDecompressor = zlib.decompressobj()
+
+
+class Recording(object):
+    """
+    Events of a recording in the order to replay them: ('frame', frame) events with
+    a message received, and ('edit', (channelId, view, received, operation)) events
+    with an edit the recorded peer made, placed ahead of the first peer operation
+    it had not applied yet.
+    """
+
+    def __init__(self, paths):
+        self.description = None
+        self.events = []
+        self.features = set()
+        self.sessions = {}
+        self.received = 0
+        self.sent = 0
+        for path in paths:
+            description, records = recorder.readRecording(path)
+            if self.description is None:
+                self.description = description
+                self.features = set(description['features'])
+            for when, direction, frame in records:
+                if direction == recorder.INCOMING:
+                    self.addIncoming(when, frame)
+                else:
+                    self.addOutgoing(when, frame)
+
+    def session(self, channelId):
+        if channelId not in self.sessions:
+            features = self.features
+            if channelId is not None:
+                features = features - set([base.FEATURE_CHANNELS, base.FEATURE_RESUME, base.FEATURE_PING])
+            self.sessions[channelId] = SessionHistory(base.FEATURE_ZLIB_EDITS in features)
+        return self.sessions[channelId]
+
+    def unwrap(self, frame):
+        """
+        @return: (channelId, messageType, messageSubType, sequence, payload) C{tuple}
+        """
+        messageType, messageSubType, sequence, payload = parseFrame(frame)
+        if messageType != base.CHANNEL:
+            return (None, messageType, messageSubType, sequence, payload)
+        channelId = struct.unpack(CHANNEL_ID_FMT, payload[:CHANNEL_ID_SIZE])[0]
+        messageType, messageSubType, channelSequence, payload = parseFrame(payload[CHANNEL_ID_SIZE:])
+        return (channelId, messageType, messageSubType, sequence, payload)
+
+    def addIncoming(self, when, frame):
+        channelId, messageType, messageSubType, sequence, payload = self.unwrap(frame)
+        if sequence is not None:
+            if sequence < self.received:
+                # replayed on resuming, but the peer already had it
+                return
+            self.received = sequence + 1
+        if (channelId is None) and (messageType == base.CONNECTED) and (self.description['peerType'] == base.CLIENT):
+            self.features = harness.basic.parseFeatures(payload)
+        session = self.session(channelId)
+        if messageType == base.END_OF_VIEW:
+            session.viewsReceived += 1
+            session.operationsReceived = 0
+        elif (messageType == base.EDIT) and (messageSubType == base.EDIT_TYPE_OT):
+            session.operationEvents[(session.viewsReceived, session.operationsReceived)] = len(self.events)
+            session.operationsReceived += 1
+        self.events.append((when, 'frame', frame))
+
+    def addOutgoing(self, when, frame):
+        channelId, messageType, messageSubType, sequence, payload = self.unwrap(frame)
+        if sequence is not None:
+            if sequence < self.sent:
+                # sent again on resuming
+                return
+            self.sent = sequence + 1
+        if (channelId is None) and (messageType == base.CONNECTED) and (self.description['peerType'] == base.SERVER):
+            self.features = harness.basic.parseFeatures(payload)
+        session = self.session(channelId)
+        if messageType == base.END_OF_VIEW_ACK:
+            session.viewsAcknowledged += 1
+            return
+        if messageType != base.EDIT:
+            return
+        if session.editDecompressor is not None:
+            payload = session.editDecompressor.decompress(payload)
+        if (messageSubType != base.EDIT_TYPE_OT) or (session.viewsAcknowledged == 0):
+            # only edits made on a view received from the peer can be made again
+            return
+        sent, received = struct.unpack(EDIT_COUNTS_FMT, payload[:EDIT_COUNTS_SIZE])
+        operation = ot.decodeOperation(payload[EDIT_COUNTS_SIZE:])
+        event = (when, 'edit', (channelId, session.viewsAcknowledged, received, operation))
+        index = session.operationEvents.get((session.viewsAcknowledged, received))
+        if index is None:
+            self.events.append(event)
+            return
+        # the peer operation was received, but not applied yet when the edit was made
+        self.events.insert(index, (self.events[index][0], 'edit', event[2]))
+        for session in self.sessions.values():
+            for key, later in session.operationEvents.items():
+                if later >= index:
+                    session.operationEvents[key] = later + 1
+
+
+class SinkTransport(object):
+    """
+    Transport of the replaying peer, counting what it sends.
+    """
+    implements(interfaces.ITransport, interfaces.IConsumer)
+
+    disconnecting = False
+
+    def __init__(self):
+        self.written = 0
+        self.producer = None
+
+    def write(self, data):
+        self.written += len(data)
+
+    def writeSequence(self, data):
+        for chunk in data:
+            self.write(chunk)
+
+    def loseConnection(self):
+        pass
+
+    def abortConnection(self):
+        pass
+
+    def getPeer(self):
+        return None
+
+    def getHost(self):
+        return None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+class Replay(object):
+    """
+    Feeds the events of a recording to a peer, scheduled relative to the time of the first one.
+    """
+
+
+    def __init__(self, recording, speed):
+        """
+        @param recording: C{Recording} to replay
+        @param speed: C{float} replay speed, 1 for the recorded pace, 0 for as fast as possible
+        """
+        self.recording = recording
+        self.speed = speed
+        self.transport = SinkTransport()
+        self.peer = None
+        self.position = 0
+        self.replayStarted = None
+        self.replayed = 0
+        self.edits = 0
+        self.failed = 0
+        self.onDone = None
+
+
+    def createPeer(self):
+        description = self.recording.description
+        self.peer = harness.basic.BasicPeer(description['peer'], harness.BenchNegotiator('replay'))
+        self.peer.peerType = description['peerType']
+        self.peer.role = description['role']
+        self.peer.state = base.STATE_CONNECTING
+        self.peer.makeConnection(self.transport)
+        if description['state'] != base.STATE_CONNECTING:
+            # the file starts after the CONNECTED handshake
+            self.peer.setFeatures(set(description['features']))
+            self.peer.state = base.STATE_CONNECTED
+            self.peer.view = sublime.active_window().new_file()
+
+
+    def start(self, onDone):
+        self.onDone = onDone
+        self.createPeer()
+        self.replayStarted = time.time()
+        self.next()
+
+
+    def next(self):
+        if self.position >= len(self.recording.events):
+            self.waitForViewChanges()
+            return
+        when, kind, data = self.recording.events[self.position]
+        delay = 0
+        if self.speed > 0:
+            firstTime = self.recording.events[0][0]
+            delay = max(0, (when - firstTime) / self.speed - (time.time() - self.replayStarted))
+        reactor.callLater(delay, self.replay)
+
+
+    def replay(self):
+        when, kind, data = self.recording.events[self.position]
+        if kind == 'edit':
+            session = self.session(data[0])
+            if (session is not None) and session.viewChangesScheduled:
+                # edits are made on top of everything received before them
+                reactor.callLater(0.001, self.replay)
+                return
+        self.position += 1
+        try:
+            if kind == 'frame':
+                self.peer.stringReceived(data)
+                self.replayed += 1
+            else:
+                self.makeEdit(*data)
+        except Exception, e:
+            # keep going, the recording may start in the middle of a session
+            self.failed += 1
+            harness.basic.BasicPeer.logger.warn('Failed to replay %s: %s' % (kind, e))
+        self.next()
+
+
+    def session(self, channelId):
+        if channelId is None:
+            return self.peer
+        return self.peer.channels.get(channelId)
+
+
+    def makeEdit(self, channelId, view, received, operation):
+        """
+        Make an edit of the recorded peer again, and send it on like the original.
+        """
+        session = self.session(channelId)
+        if (session is None) or (session.editState is None) or (session.editState.received != received) \
+                or (ot.baseLength(operation) != session.view.size()):
+            raise ValueError('edit made after %d peer operations does not fit the view' % received)
+        viewEdit = session.view.begin_edit()
+        for offset, deleteLength, insertText in ot.toOps(operation):
+            session.view.replace(viewEdit, sublime.Region(offset, offset + deleteLength), insertText)
+        session.view.end_edit(viewEdit)
+        session.hasPendingEdits = True
+        session.flushEdits()
+        self.edits += 1
+
+
+    def waitForViewChanges(self):
+        sessions = [self.peer] + self.peer.channels.values()
+        if len([session for session in sessions if session.viewChangesScheduled]) > 0:
+            reactor.callLater(0.01, self.waitForViewChanges)
+            return
+        for session in sessions:
+            session.viewMonitorThread.destroy()
+        self.onDone()
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] recording [recording ...]')
+    parser.add_option('--speed', type='float', default=1, help='replay speed, 1 for the recorded pace, 0 for as fast as possible [default: %default]')
+    options, paths = parser.parse_args()
+    if len(paths) == 0:
+        parser.error('no recording given')
+    logging.basicConfig(level=logging.WARN)
+    if len(paths) == 1:
+        paths = recorder.recordingFiles(paths[0]) or paths
+    recording = Recording(paths)
+    replay = Replay(recording, options.speed)
+    def done():
+        elapsed = time.time() - replay.replayStarted
+        print 'replayed %d messages and %d edits (%d failed) in %.3f s, %d bytes sent in return' % \
+            (replay.replayed, replay.edits, replay.failed, elapsed, replay.transport.written)
+        for session in [replay.peer] + replay.peer.channels.values():
+            if session.view is not None:
+                print 'view of %s: %d characters' % (session.str(), session.view.size())
+            print '\n'.join(stats.formatSnapshot(session.str(), session.getStats()))
+        reactor.stop()
+    reactor.callWhenRunning(replay.start, done)
+    reactor.run(installSignalHandlers=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,377 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+
+# In-memory stand-in for the parts of the Sublime Text 2 API used by sub_collab,
+# so that sessions can be run and measured outside of the editor.  Functions
+# scheduled with set_timeout() run on the reactor thread, which plays the part
+# of the editor main thread.
+import bisect, sys
+
+# Sublime Text 2 runs plugins with utf-8 as the default encoding
+reload(sys)
+sys.setdefaultencoding('utf-8')
+
+DRAW_OUTLINED = 256
+HIDDEN = 128
+
+_nextViewId = [0]
+
+
+class Region(object):
+
+    def __init__(self, a, b=None):
+        if b is None:
+            b = a
+        self.a = a
+        self.b = b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def size(self):
+        return self.end() - self.begin()
+
+    def empty(self):
+        return self.a == self.b
+
+    def __eq__(self, other):
+        return isinstance(other, Region) and (self.a, self.b) == (other.a, other.b)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        return '(%d, %d)' % (self.a, self.b)
+
+    __repr__ = __str__
+
+
+class RegionSet(list):
+
+    def clear(self):
+        del self[:]
+
+    def add(self, region):
+        self.append(region)
+
+    def __str__(self):
+        return '[' + ', '.join([str(region) for region in self]) + ']'
+
+
+class Settings(dict):
+
+    def get(self, key, default=None):
+        return dict.get(self, key, default)
+
+    def set(self, key, value):
+        self[key] = value
+
+    def erase(self, key):
+        self.pop(key, None)
+
+    def add_on_change(self, key, callback):
+        pass
+
+    def clear_on_change(self, key):
+        pass
+
+
+class Edit(object):
+    pass
+
+
+class View(object):
+    """
+    Text buffer of a view, kept in chunks of up to CHUNK_SIZE characters so that
+    editing costs about the same whatever the size of the view, as it does in the
+    editor.  Benchmarks measure the plugin, not this stand-in.
+    """
+
+    CHUNK_SIZE = 65536
+
+    def __init__(self, text=u'', name=''):
+        _nextViewId[0] += 1
+        self._id = _nextViewId[0]
+        self._chunks = [text[pos:pos + self.CHUNK_SIZE] for pos in range(0, len(text), self.CHUNK_SIZE)] or [u'']
+        # character offset of the start of each chunk
+        self._starts = []
+        self._restart(0)
+        self._size = len(text)
+        self._readOnly = False
+        self._sel = RegionSet([Region(0)])
+        self._regions = {}
+        self._settings = Settings(syntax='Packages/Text/Plain text.tmLanguage')
+        self._name = name
+        self._status = {}
+        # (command, args, repeat) of the last modifying command, see command_history()
+        self._lastCommand = (None, None, 0)
+
+    def _restart(self, first):
+        del self._starts[first:]
+        pos = 0
+        if first > 0:
+            pos = self._starts[first - 1] + len(self._chunks[first - 1])
+        for chunk in self._chunks[first:]:
+            self._starts.append(pos)
+            pos += len(chunk)
+
+    def _chunkAt(self, point):
+        return max(0, bisect.bisect_right(self._starts, point) - 1)
+
+    def _checkWritable(self):
+        if self._readOnly:
+            raise RuntimeError('view %d is read only' % self._id)
+
+    def id(self):
+        return self._id
+
+    def buffer_id(self):
+        return self._id
+
+    def size(self):
+        return self._size
+
+    def substr(self, region):
+        if isinstance(region, int):
+            region = Region(region, region + 1)
+        begin = max(0, region.begin())
+        end = min(self._size, region.end())
+        if begin >= end:
+            return u''
+        first = self._chunkAt(begin)
+        last = self._chunkAt(end - 1)
+        if first == last:
+            return self._chunks[first][begin - self._starts[first]:end - self._starts[first]]
+        pieces = [self._chunks[first][begin - self._starts[first]:]]
+        pieces.extend(self._chunks[first + 1:last])
+        pieces.append(self._chunks[last][:end - self._starts[last]])
+        return u''.join(pieces)
+
+    def begin_edit(self, *args):
+        return Edit()
+
+    def end_edit(self, edit):
+        pass
+
+    def insert(self, edit, point, text):
+        self._checkWritable()
+        self._replace(point, point, text)
+        return len(text)
+
+    def erase(self, edit, region):
+        self.replace(edit, region, u'')
+
+    def replace(self, edit, region, text):
+        self._checkWritable()
+        self._replace(region.begin(), region.end(), text)
+
+    def _replace(self, begin, end, text):
+        first = self._chunkAt(begin)
+        last = self._chunkAt(end)
+        merged = self._chunks[first][:begin - self._starts[first]] + text + self._chunks[last][end - self._starts[last]:]
+        pieces = [merged]
+        if (len(merged) == 0) and (len(self._chunks) > last - first + 1):
+            pieces = []
+        elif len(merged) > 2 * self.CHUNK_SIZE:
+            pieces = [merged[pos:pos + self.CHUNK_SIZE] for pos in range(0, len(merged), self.CHUNK_SIZE)]
+        self._chunks[first:last + 1] = pieces
+        self._restart(first)
+        self._size += len(text) - (end - begin)
+
+    def command_history(self, index, modifyingOnly=False):
+        if index != 0:
+            # nothing was undone
+            return (None, None, 0)
+        return self._lastCommand
+
+    def set_read_only(self, readOnly):
+        self._readOnly = readOnly
+
+    def is_read_only(self):
+        return self._readOnly
+
+    def sel(self):
+        return self._sel
+
+    def add_regions(self, key, regions, scope='', icon='', flags=0):
+        self._regions[key] = list(regions)
+
+    def get_regions(self, key):
+        return list(self._regions.get(key, []))
+
+    def erase_regions(self, key):
+        self._regions.pop(key, None)
+
+    def settings(self):
+        return self._settings
+
+    def set_syntax_file(self, syntax):
+        self._settings['syntax'] = syntax
+
+    def file_name(self):
+        return None
+
+    def name(self):
+        return self._name
+
+    def set_name(self, name):
+        self._name = name
+
+    def set_scratch(self, scratch):
+        pass
+
+    def visible_region(self):
+        return Region(0, min(self._size, 4000))
+
+    def split_by_newlines(self, region):
+        lines = []
+        position = region.begin()
+        for line in self.substr(region).split(u'\n'):
+            lines.append(Region(position, position + len(line)))
+            position += len(line) + 1
+        return lines
+
+    def show_at_center(self, point):
+        pass
+
+    def set_status(self, key, value):
+        self._status[key] = value
+
+    def erase_status(self, key):
+        self._status.pop(key, None)
+
+    def run_command(self, command, args=None):
+        pass
+
+    def window(self):
+        return _window
+
+
+class Window(object):
+
+    def __init__(self):
+        self._views = []
+        self._panels = {}
+
+    def id(self):
+        return 1
+
+    def new_file(self):
+        view = View()
+        self._views.append(view)
+        return view
+
+    def views(self):
+        return list(self._views)
+
+    def active_view(self):
+        if len(self._views) > 0:
+            return self._views[-1]
+        return None
+
+    def focus_view(self, view):
+        if view in self._views:
+            self._views.remove(view)
+            self._views.append(view)
+
+    def get_output_panel(self, name):
+        return self._panels.setdefault(name, View(name=name))
+
+    def show_quick_panel(self, items, onDone, flags=0):
+        pass
+
+    def show_input_panel(self, caption, initialText, onDone, onChange, onCancel):
+        pass
+
+    def run_command(self, command, args=None):
+        pass
+
+
+_window = Window()
+settingsByName = {}
+
+
+def active_window():
+    return _window
+
+
+def windows():
+    return [_window]
+
+
+def set_timeout(callback, delay):
+    # may be called from any thread, like the real thing
+    # (the reactor is imported here so that importing this module does not install one)
+    from twisted.internet import reactor
+    reactor.callFromThread(reactor.callLater, delay / 1000.0, callback)
+
+
+def get_clipboard():
+    return u''
+
+
+def status_message(message):
+    pass
+
+
+def message_dialog(message):
+    pass
+
+
+def error_message(message):
+    pass
+
+
+def ok_cancel_dialog(message, okTitle=''):
+    return True
+
+
+def load_settings(name):
+    # the same instance for every load, benchmarks fill it in before the plugin reads it
+    return settingsByName.setdefault(name, Settings())
+
+
+def save_settings(name):
+    pass
+
+
+def packages_path():
+    return ''
+
+
+def installed_packages_path():
+    return ''
+
+
+def platform():
+    return sys.platform.startswith('win') and 'windows' or (sys.platform == 'darwin' and 'osx' or 'linux')
+
+
+def arch():
+    return 'x64'
+
+
+def version():
+    return '2221'
@@ -33,18 +33,18 @@ if libs_path not in sys.path:
     sys.path.insert(0, libs_path)
 
 # need the windows select.pyd binary
-from twisted.python import runtime, log
+# (checked without twisted.python.runtime, twisted is not imported until bootstrap())
 __file__ = os.path.normpath(os.path.abspath(__file__))
 __path__ = os.path.dirname(__file__)
-if runtime.platform.isWindows():
+if os.name == 'nt':
     libs_path = os.path.join(__path__, 'libs', 'win', platform.architecture()[0])
     if libs_path not in sys.path:
         sys.path.insert(0, libs_path)
-elif runtime.platform.isLinux():
+elif sys.platform.startswith('linux'):
     libs_path = os.path.join(__path__, 'libs', 'linux', platform.architecture()[0])
     if libs_path not in sys.path:
         sys.path.insert(0, libs_path)
-elif runtime.platform.isMacOSX():
+elif sys.platform == 'darwin':
     libs_path = os.path.join(__path__, 'libs', 'mac', platform.architecture()[0])
     if libs_path not in sys.path:
         sys.path.insert(0, libs_path)
@@ -59,53 +59,76 @@ logging.config.fileConfig('logging.cfg', disable_existing_loggers=False)
 logger = logging.getLogger("SubliminalCollaborator")
 
 import sublime
+import sublime_plugin
+from sub_collab import registry, status_bar
+import shutil, fileinput, re, functools, time
 
 # wrapper function to the entrypoint into the sublime main loop
 def callInSublimeLoop(funcToCall):
     sublime.set_timeout(funcToCall, 0)
 
-# --- install and start the twisted reactor, if it hasn't already be started --- #
-from twisted.internet.error import ReactorAlreadyInstalledError, ReactorAlreadyRunning, ReactorNotRestartable
-
-reactorAlreadyInstalled = False
-try:
-    from twisted.internet import _threadedselect
-    _threadedselect.install()
-except ReactorAlreadyInstalledError:
-    reactorAlreadyInstalled = True
-
-from twisted.internet import reactor
-
-try:
-    reactor.interleave(callInSublimeLoop, installSignalHandlers=False)
-except ReactorAlreadyRunning:
-    reactorAlreadyInstalled = True
-except ReactorNotRestartable:
-    reactorAlreadyInstalled = True
-
-if reactorAlreadyInstalled:
-    logger.debug('twisted reactor already installed')
-    if type(reactor) != _threadedselect.ThreadedSelectReactor:
-        logger.warn('unexpected reactor type installed: %s, it is best to use twisted.internet._threadedselect!' % type(reactor))
-else:
-    logger.debug('twisted reactor installed and running')
-# --- --------------------------------------------------------------------- --- #
-
-import sublime_plugin
-from sub_collab.negotiator import irc
-from sub_collab.peer import base as pi
-from sub_collab import common, registry, status_bar
-from sub_collab import event as collab_event
-from sub_collab.peer import base
-from twisted.internet import reactor
-from zope.interface import implements
-import threading, logging, time, shutil, fileinput, re, functools
 
+def installReactor():
+    """
+    Install and start the twisted reactor, if it hasn't already be started.
+    """
+    from twisted.internet.error import ReactorAlreadyInstalledError, ReactorAlreadyRunning, ReactorNotRestartable
+
+    reactorAlreadyInstalled = False
+    try:
+        from twisted.internet import _threadedselect
+        _threadedselect.install()
+    except ReactorAlreadyInstalledError:
+        reactorAlreadyInstalled = True
+
+    from twisted.internet import reactor
+
+    try:
+        reactor.interleave(callInSublimeLoop, installSignalHandlers=False)
+    except ReactorAlreadyRunning:
+        reactorAlreadyInstalled = True
+    except ReactorNotRestartable:
+        reactorAlreadyInstalled = True
+
+    if reactorAlreadyInstalled:
+        logger.debug('twisted reactor already installed')
+        if type(reactor) != _threadedselect.ThreadedSelectReactor:
+            logger.warn('unexpected reactor type installed: %s, it is best to use twisted.internet._threadedselect!' % type(reactor))
+    else:
+        logger.debug('twisted reactor installed and running')
+
+
+# twisted, zope and the session modules are imported by bootstrap(), along with
+# the reactor and negotiators, when first needed unless lazy_startup is false
+BOOTSTRAPPED = False
+# map of protocol name to negotiator constructor, filled in by bootstrap()
+NEGOTIATOR_CONSTRUCTOR_MAP = {}
+
+
+def bootstrap():
+    """
+    Start the reactor, import the modules the sessions need and create the negotiators
+    of all configured accounts.  Run by every CollaborateCommand task, incoming
+    session requests can only arrive through a negotiator so do not need it.
+    """
+    global BOOTSTRAPPED, reactor, task, irc, pi, basic, broadcast, stats, common, collab_event
+    if BOOTSTRAPPED:
+        return
+    startedAt = time.time()
+    installReactor()
+    from twisted.internet import reactor, task
+    from zope.interface import classImplements
+    from sub_collab.negotiator import irc
+    from sub_collab.peer import base as pi
+    from sub_collab.peer import basic, broadcast, stats
+    from sub_collab import common
+    from sub_collab import event as collab_event
+    classImplements(CollaborateCommand, common.Observer)
+    NEGOTIATOR_CONSTRUCTOR_MAP['irc'] = irc.IRCNegotiator
+    BOOTSTRAPPED = True
+    loadConfig()
+    logger.info('started in %.0f ms' % ((time.time() - startedAt) * 1000))
 
-# map of protocol name to negotiator constructor
-NEGOTIATOR_CONSTRUCTOR_MAP = {
-    'irc': irc.IRCNegotiator
-}
 
 #*** globals for preferences and session variables ***#
 # config dictionary, key is protocol:host:username, value is config dict
@@ -117,34 +140,55 @@ CONNECT_ALL_ON_STARTUP = False
 # sessions = {}
 # # sessions by view id
 # sessionsByViewId = {}
-sessionsLock = threading.Lock()
 # global for the current active view... because sublime.active_window().active_view() ignores the console view
 globalActiveView = None
 
 
-class SessionCleanupThread(threading.Thread):
-    def __init__(self):
-        threading.Thread.__init__(self)
+def cleanupDeadSession(session, previousState, state):
+    """
+    Registry state callback, drops sessions as soon as they are disconnected.
+    """
+    if (state == pi.STATE_DISCONNECTED) and registry.isRegistered(session):
+        logger.info('Cleaning up dead session: %s' % session.str())
+        registry.removeSession(session)
 
-    def run(self):
-        global sessions
-        global sessionsByViewId
-        global sessionsLock
-        time.sleep(5.0)
-        # runs for as long as the reactor is running
-        while reactor.running:
-            sessionsLock.acquire()
-            for session in registry.listSessions():
-                if session.state == pi.STATE_DISCONNECTED:
-                    logger.info('Cleaning up dead session: %s' % session.str())
-                    registry.removeSession(session)
-            sessionsLock.release()
-            time.sleep(5.0)
-
-
-if not 'SESSION_CLEANUP_THREAD' in globals():
-    SESSION_CLEANUP_THREAD = SessionCleanupThread()
-    SESSION_CLEANUP_THREAD.start()
+# registered by name, so reloading this module replaces rather than adds the callback
+registry.addStateCallback('session_cleanup', cleanupDeadSession)
+
+# periodically writes the stats of all sessions to a JSON file, see configureStatsDump()
+if not 'STATS_DUMP' in globals():
+    STATS_DUMP = None
+
+
+def collectSessionStats():
+    """
+    @return: C{dict} of session label to the stats of that session
+    """
+    sessionStats = {}
+    for session in registry.listSessions():
+        if hasattr(session, 'getStats'):
+            sessionStats['%s -> %s' % (session.getParentNegotiatorKey(), session.str())] = session.getStats()
+    return sessionStats
+
+
+def dumpSessionStats(path):
+    try:
+        stats.dump(path, collectSessionStats())
+    except (IOError, OSError), e:
+        logger.error('Failed to write session stats to %s: %s' % (path, e))
+
+
+def configureStatsDump(settings):
+    global STATS_DUMP
+    if (STATS_DUMP is not None) and STATS_DUMP.running:
+        STATS_DUMP.stop()
+    STATS_DUMP = None
+    path = settings.get('stats_dump_file')
+    if path:
+        interval = float(settings.get('stats_dump_interval', 60))
+        logger.info('Writing session stats to %s every %d seconds' % (path, interval))
+        STATS_DUMP = task.LoopingCall(dumpSessionStats, os.path.expanduser(path))
+        STATS_DUMP.start(interval, now=False)
 
 
 def loadConfig():
@@ -162,6 +206,13 @@ def loadConfig():
         if protocol == 'connect_all_on_startup':
             CONNECT_ALL_ON_STARTUP = acctDetails
             continue
+        if protocol == 'lazy_startup':
+            continue
+        if protocol == 'session':
+            basic.configure(acctDetails)
+            broadcast.configure(acctDetails)
+            configureStatsDump(acctDetails)
+            continue
         for acctDetail in acctDetails:
             negotiator = registry.addOrUpdateNegotiator(protocol, acctDetail, NEGOTIATOR_CONSTRUCTOR_MAP)
             loadedNegotiators[negotiator[0]] = negotiator[1]
@@ -179,12 +230,6 @@ def connectAllChat():
             negotiator.connect()
 
 
-loadConfig()
-
-if CONNECT_ALL_ON_STARTUP:
-    connectAllChat()
-
-
 # ===== OpenSublimeSettingsCommand ===== #
 
 
@@ -271,8 +316,9 @@ class UninstallMenuProxyCommand(sublime_plugin.WindowCommand):
 
 
 class CollaborateCommand(sublime_plugin.ApplicationCommand, sublime_plugin.EventListener):
-
-    implements(common.Observer)
+    """
+    Declared an implementation of common.Observer by bootstrap().
+    """
 
     def __init__(self):
         sublime_plugin.ApplicationCommand.__init__(self)
@@ -283,6 +329,7 @@ class CollaborateCommand(sublime_plugin.ApplicationCommand, sublime_plugin.Event
     def run(self, task):
         method = getattr(self, task, None)
         try:
+            bootstrap()
             if method is not None:
                 # logger.debug('running collaborate task %s' % task)
                 method()
@@ -353,15 +400,15 @@ class CollaborateCommand(sublime_plugin.ApplicationCommand, sublime_plugin.Event
             # someone wants to collaborate with you! do you want to accept?
             acceptRequest = sublime.ok_cancel_dialog(username + ' wants to collaborate with you!')
             if acceptRequest == True:
-                producer.acceptSessionRequest(data[0], data[1], data[2])
+                producer.acceptSessionRequest(data[0], data[1], data[2], data[3], data[4])
             else:
-                producer.rejectSessionRequest(data[0])
+                producer.rejectSessionRequest(data[0], data[4])
         elif event == collab_event.ESTABLISHED_SESSION:
             logger.debug('session established, opening view selector')
             self.chooseView(session=producer)
         elif event == collab_event.FAILED_SESSION:
-            pass
-            #todo error window popup
+            logger.debug('session failed: ' + str(data))
+            sublime.error_message('Could not connect to %s to share' % data)
 
 
     def openSession(self):
@@ -459,6 +506,106 @@ class CollaborateCommand(sublime_plugin.ApplicationCommand, sublime_plugin.Event
             chosenSession.startCollab(chosenView)
             
 
+    def startBroadcast(self, negotiatorKeyIdx=None):
+        if negotiatorKeyIdx is None:
+            self.negotiatorKeys = registry.listNegotiatorKeys()
+            sublime.active_window().show_quick_panel(self.negotiatorKeys, self.startBroadcast)
+            return
+        negotiatorKeys = self.negotiatorKeys
+        del self.negotiatorKeys
+        if negotiatorKeyIdx < 0:
+            return
+        session = broadcast.BroadcastPeer(registry.getNegotiator(negotiatorKeys[negotiatorKeyIdx]))
+        session.hostConnect()
+        registry.registerSession(session)
+        self.chooseView(session=session)
+
+
+    def inviteWatcher(self, idx=None):
+        if idx == None:
+            self.broadcasts = [session for session in registry.listSessions() \
+                if isinstance(session, broadcast.BroadcastPeer) and (session.state == pi.STATE_CONNECTED)]
+            if len(self.broadcasts) == 0:
+                del self.broadcasts
+                sublime.status_message('No broadcasts to invite watchers to')
+                return
+            sessionList = ['%s -> %s (%s)' % (session.getParentNegotiatorKey(), session.str(), session.viewName()) for session in self.broadcasts]
+            sublime.active_window().show_quick_panel(sessionList, self.inviteWatcher)
+        else:
+            broadcasts = self.broadcasts
+            del self.broadcasts
+            if idx > -1:
+                self.invitingTo = broadcasts[idx]
+                negotiator = registry.getNegotiator(self.invitingTo.getParentNegotiatorKey())
+                self.peerList = negotiator.listUsers()
+                sublime.active_window().show_quick_panel(self.peerList, self.chooseWatcher)
+
+
+    def chooseWatcher(self, peerIdx=None):
+        session = self.invitingTo
+        peerList = self.peerList
+        del self.invitingTo
+        del self.peerList
+        if (peerIdx is None) or (peerIdx < 0):
+            return
+        registry.getNegotiator(session.getParentNegotiatorKey()).inviteToSession(peerList[peerIdx], session.port)
+
+
+    def shareThroughRelay(self, negotiatorKeyIdx=None):
+        self.chooseRelayRoom(pi.HOST_ROLE, negotiatorKeyIdx, self.shareThroughRelay)
+
+
+    def joinRelayRoom(self, negotiatorKeyIdx=None):
+        self.chooseRelayRoom(pi.PARTNER_ROLE, negotiatorKeyIdx, self.joinRelayRoom)
+
+
+    def chooseRelayRoom(self, role, negotiatorKeyIdx, callback):
+        if not basic.RELAY_ADDRESS:
+            sublime.error_message('No relay configured, see the "session" section of Accounts.sublime-settings')
+            return
+        if negotiatorKeyIdx is None:
+            self.negotiatorKeys = registry.listNegotiatorKeys()
+            sublime.active_window().show_quick_panel(self.negotiatorKeys, callback)
+            return
+        negotiatorKeys = self.negotiatorKeys
+        del self.negotiatorKeys
+        if negotiatorKeyIdx < 0:
+            return
+        negotiator = registry.getNegotiator(negotiatorKeys[negotiatorKeyIdx])
+        sublime.active_window().show_input_panel('Relay room name:', '', \
+            functools.partial(self.connectToRelay, role, negotiator), None, None)
+
+
+    def connectToRelay(self, role, negotiator, room):
+        host, port = basic.RELAY_ADDRESS.rsplit(':', 1)
+        session = basic.BasicPeer('relay:%s' % room, negotiator)
+        session.relayConnect(host, int(port), room, role)
+        registry.registerSession(session)
+        if role == pi.HOST_ROLE:
+            self.chooseView(session=session)
+
+
+    def shareAnotherView(self, idx=None):
+        if idx == None:
+            # channels are opened on the connection of a session, not within another channel
+            self.channelSessions = [session for session in registry.listSessions() \
+                if (not hasattr(session, 'parentPeer')) and (session.state == pi.STATE_CONNECTED) \
+                and (pi.FEATURE_CHANNELS in session.features)]
+            if len(self.channelSessions) == 0:
+                del self.channelSessions
+                sublime.status_message('No connected sessions to share another view over')
+                return
+            sessionList = ['%s -> %s' % (session.getParentNegotiatorKey(), session.str()) for session in self.channelSessions]
+            sublime.active_window().show_quick_panel(sessionList, self.shareAnotherView)
+        else:
+            channelSessions = self.channelSessions
+            del self.channelSessions
+            if idx > -1:
+                channel = channelSessions[idx].openChannel()
+                if channel:
+                    self.chooseView(session=channel)
+
+
     def showSessions(self, idx=None, sessionCallback=None):
         if idx == None:
             self.activeSessions = registry.listSessions()
@@ -528,6 +675,24 @@ class CollaborateCommand(sublime_plugin.ApplicationCommand, sublime_plugin.Event
         swapping_session.swapRole()
 
 
+    def showSessionStats(self):
+        sessionStats = collectSessionStats()
+        if len(sessionStats) == 0:
+            sublime.status_message('No active sessions')
+            return
+        lines = []
+        for sessionLabel in sorted(sessionStats.keys()):
+            lines.extend(stats.formatSnapshot(sessionLabel, sessionStats[sessionLabel]))
+            lines.append('')
+        window = sublime.active_window()
+        panel = window.get_output_panel('collab_stats')
+        panelEdit = panel.begin_edit()
+        panel.erase(panelEdit, sublime.Region(0, panel.size()))
+        panel.insert(panelEdit, 0, '\n'.join(lines))
+        panel.end_edit(panelEdit)
+        window.run_command('show_panel', {'panel': 'output.collab_stats'})
+
+
     def on_selection_modified(self, view):
         # if view.file_name():
         # print('new selection: %s' % view.sel())
@@ -538,41 +703,41 @@ class CollaborateCommand(sublime_plugin.ApplicationCommand, sublime_plugin.Event
                 session.sendSelectionUpdate(view.sel())
 
 
+    def on_activated(self, view):
+        # the status is kept per view, show it on the newly active one
+        status_bar.republish()
+
+
     def on_modified(self, view):
-        # print(view.command_history(0, False))
-        # print(view.command_history(-1, False))
         session = registry.getSessionByView(view)
         if session:
-            if (session.state == pi.STATE_CONNECTED) and (session.role == pi.HOST_ROLE):
-                command = view.command_history(0, False)
-                lastCommand = session.lastViewCommand
-                session.lastViewCommand = command
-                payload = ''
-                # handle history-capturable edit commands on this view
-                if command[0] == 'insert':
-                    # because of the way the insert commands are captured in the command_history
-                    # this seems to be the most sensible way to handle this... grab latest character
-                    # inserted and send it... not most efficient but it is a start
-                    if command[0] == lastCommand[0]:
-                        chars = command[1]['characters']
-                        lastChars = lastCommand[1]['characters']
-                        if chars.startswith(lastChars):
-                            payload = chars.replace(lastChars, '', 1)
-                        else:
-                            payload = chars
-                    else:
-                        payload = command[1]['characters']
-                    session.sendEdit(pi.EDIT_TYPE_INSERT, payload)
-                elif command[0] ==  'insert_snippet':
-                    payload = command[1]['contents']
-                    session.sendEdit(pi.EDIT_TYPE_INSERT_SNIPPET, payload)
-                elif command[0] == 'left_delete':
-                    session.sendEdit(pi.EDIT_TYPE_LEFT_DELETE, payload)
-                elif command[0] == 'right_delete':
-                    session.sendEdit(pi.EDIT_TYPE_RIGHT_DELETE, payload)
-                elif command[0] == 'paste':
-                    payload = sublime.get_clipboard()
-                    session.sendEdit(pi.EDIT_TYPE_PASTE, payload)
+            if (session.state == pi.STATE_CONNECTED) \
+                    and ((session.role == pi.HOST_ROLE) or (pi.FEATURE_OT in session.features)):
+                session.sendViewEdits()
+                if view.command_history(0, False)[0] == 'paste':
+                    # no point in waiting for more keystrokes after a paste
+                    session.flushEdits()
+
+
+# ===== startup ===== #
+
+
+def readStartupConfig():
+    """
+    @return: tuple of the lazy_startup and connect_all_on_startup account settings
+    """
+    accts = sublime.load_settings('Accounts.sublime-settings').get('subliminal_collaborator') or {}
+    return (accts.get('lazy_startup', True), accts.get('connect_all_on_startup', False))
+
+
+LAZY_STARTUP, CONNECT_ALL_ON_STARTUP = readStartupConfig()
+
+# negotiators in the registry mean this is a reload of an already running plugin
+if (not LAZY_STARTUP) or CONNECT_ALL_ON_STARTUP or (len(registry.listNegotiatorKeys()) > 0):
+    bootstrap()
+
+if CONNECT_ALL_ON_STARTUP:
+    connectAllChat()
 
 
 # ===== EditCommandProxyCommand ===== #
@@ -0,0 +1,182 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+from twisted.internet import defer, threads
+import logging, socket, time
+
+# Discovery of the ip addresses this machine offers to peers, without any Sublime Text
+# dependencies.  Resolving the host name can block for seconds on a slow or broken
+# resolver, so it is done on a thread of the reactor thread pool and the result is
+# cached until the network changes.
+
+logger = logging.getLogger('SubliminalCollaborator.addresses')
+
+# in seconds, the discovered addresses are looked up again after this long regardless
+MAX_AGE = 600
+
+# any address outside of this machine, only used to ask which local address is routed to it
+ROUTE_PROBE_ADDRESS = ('192.0.2.1', 9)
+
+# ranks of addresses, lower ranks are offered first
+RANK_DEFAULT_ROUTE = 0
+RANK_LAN = 1
+RANK_PUBLIC = 2
+RANK_SHARED = 3
+RANK_DOCKER = 4
+RANK_LINK_LOCAL = 5
+RANK_LOOPBACK = 6
+
+
+def defaultRouteAddress():
+    """
+    Address of the interface the default route goes through, found without sending
+    anything or resolving any names so it is cheap enough to call on the reactor thread.
+
+    @return: C{str} ip address, or None without a default route
+    """
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        try:
+            probe.connect(ROUTE_PROBE_ADDRESS)
+            return probe.getsockname()[0]
+        except socket.error:
+            return None
+    finally:
+        probe.close()
+
+
+def rankAddress(address, defaultRoute=None):
+    """
+    @return: C{int} rank of the given ip address, one of the RANK_ values
+    """
+    if address == defaultRoute:
+        return RANK_DEFAULT_ROUTE
+    try:
+        octets = [int(octet) for octet in address.split('.')]
+    except ValueError:
+        return RANK_PUBLIC
+    if octets[0] == 127:
+        return RANK_LOOPBACK
+    if (octets[0] == 169) and (octets[1] == 254):
+        return RANK_LINK_LOCAL
+    if (octets[0] == 172) and (octets[1] == 17):
+        # docker0, the default bridge of docker containers
+        return RANK_DOCKER
+    if (octets[0] == 10) or ((octets[0] == 172) and (16 <= octets[1] <= 31)) or ((octets[0] == 192) and (octets[1] == 168)):
+        return RANK_LAN
+    if (octets[0] == 100) and (64 <= octets[1] <= 127):
+        # carrier grade NAT, also used by some VPNs
+        return RANK_SHARED
+    return RANK_PUBLIC
+
+
+def rankAddresses(addresses, defaultRoute=None):
+    """
+    @return: C{list} of the given addresses without duplicates, in order of rank
+    """
+    unique = []
+    for address in addresses:
+        if not address in unique:
+            unique.append(address)
+    # sorting is stable, so addresses of the same rank keep their order
+    return sorted(unique, key=lambda address: rankAddress(address, defaultRoute))
+
+
+def discoverAddresses():
+    """
+    Blocking lookup of the addresses of this machine, run on a thread by C{AddressCache}.
+
+    @return: C{tuple} of the default route address (or None) and the C{list} of ranked addresses
+    """
+    defaultRoute = defaultRouteAddress()
+    addresses = []
+    if defaultRoute is not None:
+        addresses.append(defaultRoute)
+    try:
+        addresses.extend(socket.gethostbyname_ex(socket.gethostname())[2])
+    except socket.error, e:
+        logger.warn('Could not look up the addresses of %s: %s' % (socket.gethostname(), e))
+    if len(addresses) == 0:
+        addresses.append('127.0.0.1')
+    return (defaultRoute, rankAddresses(addresses, defaultRoute))
+
+
+class AddressCache(object):
+    """
+    Addresses of this machine, discovered off the reactor thread and kept until
+    the address the default route goes through changes or MAX_AGE has passed.
+    Must be used from the reactor thread.
+    """
+
+    def __init__(self, maxAge=MAX_AGE):
+        self.maxAge = maxAge
+        self.addresses = None
+        self.defaultRoute = None
+        self.discoveredAt = 0
+        # callers waiting on a discovery in progress
+        self.waiting = None
+
+
+    def isStale(self):
+        if self.addresses is None:
+            return True
+        if time.time() - self.discoveredAt > self.maxAge:
+            return True
+        # the network changed, such as joining another wifi network or a vpn
+        return defaultRouteAddress() != self.defaultRoute
+
+
+    def get(self):
+        """
+        @return: C{Deferred} firing with the C{list} of addresses, best first
+        """
+        if not self.isStale():
+            return defer.succeed(list(self.addresses))
+        waiting = defer.Deferred()
+        if self.waiting is None:
+            self.waiting = [waiting]
+            threads.deferToThread(discoverAddresses).addCallbacks(self.discovered, self.failed)
+        else:
+            self.waiting.append(waiting)
+        return waiting
+
+
+    def invalidate(self):
+        self.addresses = None
+
+
+    def discovered(self, result):
+        self.defaultRoute, self.addresses = result
+        self.discoveredAt = time.time()
+        logger.debug('Discovered addresses %s' % ','.join(self.addresses))
+        waiting, self.waiting = self.waiting, None
+        for deferred in waiting:
+            deferred.callback(list(self.addresses))
+
+
+    def failed(self, failure):
+        waiting, self.waiting = self.waiting, None
+        for deferred in waiting:
+            deferred.errback(failure)
+
+
+# shared by all negotiators
+cache = AddressCache()
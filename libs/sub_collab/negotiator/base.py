@@ -57,13 +57,14 @@ class INegotiator(Interface):
         Disconnect from the instant messaging server.
         """
 
-    def listUsers():
+    def listUsers(prefix=''):
         """
         List the users available for establishing a peer-to-peer session.
         Depending on the implementing class this could either be a "friends list",
         the users within a certain chat room or channel, or
         a previously stored local list of known users.
 
+        @param prefix: C{str} only list the users whose names start with this
         @return: C{Array} of usernames
         """
 
@@ -92,27 +93,48 @@ class INegotiator(Interface):
         @return: C{peer.Peer} with or without a connection to another C{peer.Peer}
         """
 
-    def acceptSessionRequest(username, host, port):
+    def acceptSessionRequest(username, host, port, hostAddresses=None, nonce=None):
         """
         *Reciever responding to requester*
 
         Accept a session request made by the given peer on the given host and port.
+        If the peer offered more addresses than the given host, connections to all
+        of them are raced and the first one the peer answers on is kept.  The nonce
+        the request came with, if any, identifies it in any later reply.
         """
 
-    def rejectSessionRequest(username):
+    def rejectSessionRequest(username, nonce=None):
         """
         *Reciever responding to requester*
 
-        Reject a session request made by the given peer.
+        Reject a session request made by the given peer, identified by the
+        nonce it came with if any.
         """
 
-    def retrySessionRequest(username):
+    def retrySessionRequest(username, nonce=None):
         """
         *Reciever responding to requester*
 
         A session failed to be established, inform the initial requester to try again.
         """
 
+    def failedSessionRequest(username, nonce=None):
+        """
+        *Reciever responding to requester*
+
+        Connecting to every address offered with a session request failed, inform
+        the initial requester so it stops waiting for us.
+        """
+
+    def inviteToSession(username, port):
+        """
+        *Requester calling reciever*
+
+        Invite the user with the given username to connect to a session already
+        listening on the given port, such as a broadcast.  The invitation is answered
+        like one made by negotiateSession().
+        """
+
 
 class BaseNegotiator(object):
     """
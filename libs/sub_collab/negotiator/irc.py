@@ -20,15 +20,33 @@
 #   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 #   THE SOFTWARE.
 from zope.interface import implements
-from sub_collab.negotiator import base
+from sub_collab.negotiator import addresses, base, roster
+from sub_collab.peer import base as pi
 from sub_collab.peer import basic
 from sub_collab import common, event, registry, status_bar
 from twisted.words.protocols import irc
 from twisted.internet import reactor, ssl, protocol, error, defer
-import logging, sys, socket, functools
+import logging, os, sys, functools, random
 import sublime
 
 
+# in seconds, how long a peer has to connect to a session offered to them
+NEGOTIATION_TIMEOUT = 120
+
+
+class PendingSession(object):
+    """
+    Session offered to a peer that has not connected to it yet.  The nonce
+    is carried in the DCC CHAT offer and in the replies of the peer to it.
+    """
+
+    def __init__(self, username, nonce, session, timeoutCall):
+        self.username = username
+        self.nonce = nonce
+        self.session = session
+        self.timeoutCall = timeoutCall
+
+
 class IRCNegotiator(base.BaseNegotiator, common.Observable, protocol.ClientFactory, base.PatchedIRCClient):
     """
     IRC client implementation of the Negotiator interface.
@@ -71,13 +89,16 @@ class IRCNegotiator(base.BaseNegotiator, common.Observable, protocol.ClientFacto
             # default to false
             self.useSSL = False
         self.channel = self.config['channel'].encode()
-        self.peerUsers = []
-        self.unverifiedUsers = None
+        # None until the channel has been joined
+        self.roster = None
+        self.versionProber = roster.VersionProber(self.sendVersionProbe, float(self.config.get('version_probe_rate', roster.PROBE_RATE)))
+        peerCacheFile = self.config.get('peer_cache_file', os.path.join(sublime.packages_path(), 'User', 'SubliminalCollaborator.peers.json'))
+        if peerCacheFile:
+            peerCacheFile = os.path.expanduser(peerCacheFile)
+        self.peerCache = roster.PeerCache(peerCacheFile, '%s:%d/%s' % (self.host, self.port, self.channel))
         self.connectionFailed = False
-        # holder for the session currently being negotiated
-        # this limits session handling to one at a time, which makes sense right now
-        self.pendingSession = None
-        self.hostAddressToTryQueue = None
+        # sessions being negotiated, peer username -> list of PendingSession, oldest first
+        self.pendingSessions = {}
 
     #*** Negotiator method implementations ***#
 
@@ -128,7 +149,6 @@ class IRCNegotiator(base.BaseNegotiator, common.Observable, protocol.ClientFacto
             if self.clientConnection.state == 'disconnected':
                 self.clientConnection = None
                 self._registered = False
-                self.peerUsers = None
             else:
                 self.clientConnection.disconnect()
                 # reactor.callFromThread(self.clientConnection.disconnect)
@@ -136,27 +156,25 @@ class IRCNegotiator(base.BaseNegotiator, common.Observable, protocol.ClientFacto
                 status_bar.status_message('disconnected from %s' % self.str())
             self.clientConnection = None
         self._registered = False
-        self.peerUsers = None
-        self.unverifiedUsers = None
+        self.roster = None
+        self.versionProber.stop()
+        self.peerCache.flush()
 
 
-    def listUsers(self):
+    def listUsers(self, prefix=''):
         """
         List the users available for establishing a peer-to-peer session.
         Depending on the implementing class this could either be a "friends list",
         the users within a certain chat room or channel, or
         a previously stored local list of known users.
 
-        @return: C{list} of usernames, or None if we are not connected yet
+        @param prefix: C{str} only list the users whose names start with this
+        @return: C{list} of usernames, verified peers first, unverified ones marked with a *
         """
-        fullList = []
-        if self.peerUsers:
-            for peer in self.peerUsers:
-                fullList.append(peer)
-        if self.unverifiedUsers:
-            for unverified in self.unverifiedUsers:
-                fullList.append('*' + unverified)
-        return fullList
+        if self.roster is None:
+            return []
+        verified, unverified = self.roster.listMembers(prefix)
+        return verified + ['*' + username for username in unverified]
 
 
     def getUserName(self):
@@ -180,37 +198,53 @@ class IRCNegotiator(base.BaseNegotiator, common.Observable, protocol.ClientFacto
         by listUsers(), the expectation is that successful execution of this function
         will result in the given username being added to the list of known users.
         """
-        if (not username in self.peerUsers) and (not username in self.unverifiedUsers):
-            self.addUserToLists(username)
-        if self.hostAddressToTryQueue == None or len(self.hostAddressToTryQueue) == 0:
-            self.hostAddressToTryQueue = socket.gethostbyname_ex(socket.gethostname())[2]
-        ipaddress = self.hostAddressToTryQueue.pop()
+        if (self.roster is not None) and (not username in self.roster):
+            self.addUserToLists(username, roster.PRIORITY_REQUESTED)
         session = basic.BasicPeer(username, self)
         port = session.hostConnect()
-        self.logger.debug('attempting to start session with %s at %s:%d' % (username, ipaddress, port))
-        status_bar.status_message('trying to share with %s@%s' % (username, ipaddress))
-        self.pendingSession = session
+        status_bar.status_message('trying to share with %s' % username)
+        nonce = self.addPendingSession(username, session)
         registry.registerSession(session)
-        self.ctcpMakeQuery(username, [('DCC CHAT', '%s %s %d' % (base.DCC_PROTOCOL_COLLABORATE, ipaddress, port))])
+        d = addresses.cache.get()
+        d.addCallback(self.sendSessionOffer, username, port, session, nonce)
+        d.addErrback(self.sessionOfferFailed, username, session)
+
+
+    def inviteToSession(self, username, port):
+        """
+        Invite the user with the given username to connect to a session already
+        listening on the given port, such as a broadcast.
+        """
+        if (self.roster is not None) and (not username in self.roster):
+            self.addUserToLists(username, roster.PRIORITY_REQUESTED)
+        status_bar.status_message('inviting %s' % username)
+        d = addresses.cache.get()
+        d.addCallback(self.sendSessionOffer, username, port)
+        d.addErrback(self.sessionOfferFailed, username)
 
 
-    def acceptSessionRequest(self, username, host, port):
+    def acceptSessionRequest(self, username, host, port, hostAddresses=None, nonce=None):
         self.logger.debug('accepted session request from %s at %s:%d)' % (username, host, port))
         status_bar.status_message('accepted session request from %s, trying to connect to %s:%d' % (username, host, port))
-        self.logger.info('Establishing session with %s at %s:%d' % (username, host, port))
+        self.logger.info('Establishing session with %s at %s:%d' % (username, ','.join(hostAddresses or [host]), port))
         session = basic.BasicPeer(username, self)
-        session.clientConnect(host, port)
+        session.clientConnect(host, port, hostAddresses, nonce)
         registry.registerSession(session)
 
 
-    def rejectSessionRequest(self, username):
+    def rejectSessionRequest(self, username, nonce=None):
         self.logger.debug('rejected session request from %s' % username)
-        self.msg(username, base.SESSION_REJECTED)
+        self.msg(username, self.sessionReply(base.SESSION_REJECTED, nonce))
 
 
-    def retrySessionRequest(self, username):
+    def retrySessionRequest(self, username, nonce=None):
         self.logger.debug('request to retry from %s' % username)
-        self.msg(username, base.SESSION_RETRY)
+        self.msg(username, self.sessionReply(base.SESSION_RETRY, nonce))
+
+
+    def failedSessionRequest(self, username, nonce=None):
+        self.logger.debug('failed to connect to the session of %s' % username)
+        self.msg(username, self.sessionReply(base.SESSION_FAILED, nonce))
 
 
     #*** protocol.ClientFactory method implementations ***#
@@ -248,6 +282,8 @@ class IRCNegotiator(base.BaseNegotiator, common.Observable, protocol.ClientFacto
         # join the channel after we have connected
         # part of the Negotiator connection process
         status_bar.status_message('connected to ' + self.str())
+        # have our addresses ready by the time a session is started, failures are reported then
+        addresses.cache.get().addErrback(lambda failure: None)
         self.logger.info('Joining channel ' + self.channel)
         self.join(self.channel)
 
@@ -259,17 +295,24 @@ class IRCNegotiator(base.BaseNegotiator, common.Observable, protocol.ClientFacto
 
     def channelNames(self, channel, names):
         assert self.channel == channel.lstrip(irc.CHANNEL_PREFIXES)
-        names.remove(self.nickname)
-        self.logger.debug('Received initial user list %s' % names)
-        self.unverifiedUsers = []
-        self.peerUsers = []
+        self.logger.debug('Received user list of %d users' % len(names))
+        if self.roster is None:
+            self.roster = roster.Roster()
+        # sync with the list rather than start over, members already known are not probed again
+        listed = set()
         for name in names:
-            self.addUserToLists(name)
+            if roster.nickKey(name) != roster.nickKey(self.nickname):
+                listed.add(roster.nickKey(name))
+                self.addUserToLists(name, roster.PRIORITY_LISTED)
+        for key in self.roster.nicks.keys():
+            if not key in listed:
+                self.dropUserFromLists(self.roster.nicks[key])
+        self.logger.debug('%d users to probe' % self.versionProber.pending())
 
 
     def userJoined(self, user, channel):
         assert self.channel == channel.lstrip(irc.CHANNEL_PREFIXES)
-        self.addUserToLists(user)
+        self.addUserToLists(user, roster.PRIORITY_JOINED)
 
 
     def userLeft(self, user, channel):
@@ -283,13 +326,19 @@ class IRCNegotiator(base.BaseNegotiator, common.Observable, protocol.ClientFacto
 
     def userKicked(self, kickee, channel, kicker, message):
         assert self.channel == channel.lstrip(irc.CHANNEL_PREFIXES)
-        self.dropUserFromLists(user)
+        self.dropUserFromLists(kickee)
 
 
     def userRenamed(self, oldname, newname):
-        assert self.channel == channel.lstrip(irc.CHANNEL_PREFIXES)
-        self.dropUserFromLists(oldname)
-        self.addUserToLists(newname)
+        if (self.roster is None) or (not oldname in self.roster):
+            return
+        self.versionProber.cancel(oldname)
+        if self.roster.rename(oldname, newname):
+            self.peerCache.remember(newname, True)
+        else:
+            # still to be verified under the new name
+            self.roster.remove(newname)
+            self.addUserToLists(newname, roster.PRIORITY_JOINED)
 
 
     def privmsg(self, user, channel, message):
@@ -302,36 +351,47 @@ class IRCNegotiator(base.BaseNegotiator, common.Observable, protocol.ClientFacto
         if '!' in username:
             username = username.split('!', 1)[0]
         self.logger.debug('Received %s from %s' % (message, username))
-        if message == base.SESSION_RETRY:
-            registry.removeSession(self.pendingSession)
-            self.pendingSession.disconnect();
-            self.pendingSession = None
+        # replies to a session offer carry its nonce, except those of older versions
+        reply = message.split(' ', 1)
+        nonce = None
+        if len(reply) > 1:
+            nonce = reply[1].strip()
+        if not reply[0] in (base.SESSION_RETRY, base.SESSION_FAILED, base.SESSION_REJECTED):
+            return
+        pending = self.popPendingSession(username, nonce)
+        if pending is None:
+            self.logger.debug('No pending session with %s for %s' % (username, message))
+            return
+        # cleanup the half-made session
+        registry.removeSession(pending.session)
+        pending.session.disconnect()
+        if reply[0] == base.SESSION_RETRY:
             self.negotiateSession(username)
-        elif message == base.SESSION_FAILED:
-            # client recvd from server... report error and cleanup any half-made sessions
-            self.logger.warn('All connections to all possible host ip addresses failed.')
-            registry.removeSession(self.pendingSession)
-            self.pendingSession.disconnect();
-            self.pendingSession = None
-        elif message == base.SESSION_REJECTED:
-            # server recvd from client... report rejected and cleanup any half-made sessions
+        elif reply[0] == base.SESSION_FAILED:
+            # client recvd from server... report error
+            self.logger.warn('All connections to all possible host ip addresses of %s failed.' % username)
+            status_bar.status_message('%s could not connect to share' % username)
+        else:
+            # server recvd from client... report rejected
             self.logger.info('Request to share with user %s was rejected.' % username)
-            registry.removeSession(self.pendingSession)
-            self.pendingSession.disconnect();
-            self.pendingSession = None
+            status_bar.status_message('%s declined to share' % username)
 
 
     def ctcpReply_VERSION(self, user, channel, data):
         username = user.lstrip(self.getNickPrefixes())
         if '!' in username:
             username = username.split('!', 1)[0]
+        if (self.roster is None) or (not username in self.roster):
+            # left in the meantime
+            return
         if (data == ('%s:%s:%s' % (self.versionName, self.versionNum, self.versionEnv))) or ((self.versionName in data) and (self.versionNum in data) and (self.versionEnv in data)):
             self.logger.debug('Verified peer %s' % username)
-            self.peerUsers.append(username)
-            self.unverifiedUsers.remove(username)
+            self.roster.verify(username)
+            self.peerCache.remember(username, True)
         else:
             # other client type, forget this user entirely
-            self.unverifiedUsers.remove(username)
+            self.roster.remove(username)
+            self.peerCache.remember(username, False)
 
 
     def dccDoChat(self, user, channel, protocol, address, port, data):
@@ -346,24 +406,148 @@ class IRCNegotiator(base.BaseNegotiator, common.Observable, protocol.ClientFacto
         if '!' in username:
             username = username.split('!', 1)[0]
         self.logger.debug('Received dcc chat from %s, protocol %s, address %s, port %d' % (username, protocol, address, port))
+        nonce = None
+        if len(data) > 4:
+            nonce = data[4]
+        hostAddresses = [address]
+        if len(data) > 3:
+            # every address the peer can be reached at, offered in addition by newer versions
+            for offered in data[3].split(','):
+                try:
+                    offered = irc.dccParseAddress(offered)
+                except irc.IRCBadMessage:
+                    self.logger.warn('Ignoring malformed address %r offered by %s' % (offered, username))
+                    continue
+                if not offered in hostAddresses:
+                    hostAddresses.append(offered)
         if protocol == base.DCC_PROTOCOL_COLLABORATE or protocol == base.DCC_PROTOCOL_RETRY:
-            self.notify(event.INCOMING_SESSION_REQUEST, self, (username, address, port))
+            self.notify(event.INCOMING_SESSION_REQUEST, self, (username, address, port, hostAddresses, nonce))
 
     #*** helper functions ***#
 
+    def sendSessionOffer(self, hostAddresses, username, port, session=None, nonce=None):
+        """
+        Offer the session at the given port of all of our addresses to the given user,
+        once they have been discovered (see sub_collab.negotiator.addresses).
+        Only the first address is used by versions that do not race connections to all of them.
+        """
+        if (session is not None) and (session.state != pi.STATE_CONNECTING):
+            # given up on in the meantime
+            return
+        self.logger.debug('offering a session to %s at %s:%d' % (username, ','.join(hostAddresses), port))
+        offer = '%s %s %d %s' % (base.DCC_PROTOCOL_COLLABORATE, hostAddresses[0], port, ','.join(hostAddresses))
+        if nonce is not None:
+            offer = '%s %s' % (offer, nonce)
+        self.ctcpMakeQuery(username, [('DCC CHAT', offer)])
+
+
+    def sessionOfferFailed(self, failure, username, session=None):
+        self.logger.error('Could not offer a session to %s: %s' % (username, failure.getErrorMessage()))
+        status_bar.status_message('failed to share with %s' % username)
+        if session is not None:
+            self.dropPendingSession(session)
+            registry.removeSession(session)
+            session.disconnect()
+
+
+    def sessionReply(self, reply, nonce):
+        if nonce is None:
+            return reply
+        return '%s %s' % (reply, nonce)
+
+
+    def addPendingSession(self, username, session):
+        """
+        Keep track of a session offered to the given user until they connect to it,
+        reply to the offer or NEGOTIATION_TIMEOUT passes.
+
+        @return: C{str} nonce identifying the offer
+        """
+        pendingSessions = self.pendingSessions.setdefault(username, [])
+        nonce = '%08x' % random.getrandbits(32)
+        while nonce in [pending.nonce for pending in pendingSessions]:
+            nonce = '%08x' % random.getrandbits(32)
+        timeoutCall = reactor.callLater(NEGOTIATION_TIMEOUT, self.pendingSessionTimedOut, username, nonce)
+        pendingSessions.append(PendingSession(username, nonce, session, timeoutCall))
+        # dropped once the session stops connecting, one way or another
+        registry.addStateCallback('pending sessions of %s' % self.getId(), self.pendingSessionStateChanged)
+        return nonce
+
+
+    def popPendingSession(self, username, nonce=None):
+        """
+        @param nonce: C{str} of the offer, or None for the oldest one made to the given user
+        @return: C{PendingSession} no longer tracked, or None if there is no such offer
+        """
+        pendingSessions = self.pendingSessions.get(username, [])
+        found = None
+        for pending in pendingSessions:
+            if (nonce is None) or (pending.nonce == nonce):
+                found = pending
+                break
+        if found is None:
+            return None
+        pendingSessions.remove(found)
+        if len(pendingSessions) == 0:
+            del self.pendingSessions[username]
+        if len(self.pendingSessions) == 0:
+            registry.removeStateCallback('pending sessions of %s' % self.getId())
+        if found.timeoutCall.active():
+            found.timeoutCall.cancel()
+        return found
+
+
+    def dropPendingSession(self, session):
+        for pendingSessions in self.pendingSessions.values():
+            for pending in pendingSessions:
+                if pending.session is session:
+                    self.popPendingSession(pending.username, pending.nonce)
+                    return
+
+
+    def pendingSessionStateChanged(self, session, previousState, state):
+        """
+        Registry state callback, the peer connected to an offered session or it was given up on.
+        """
+        if (previousState == pi.STATE_CONNECTING) and (state != pi.STATE_CONNECTING):
+            self.dropPendingSession(session)
+
+
+    def pendingSessionTimedOut(self, username, nonce):
+        pending = self.popPendingSession(username, nonce)
+        if (pending is None) or (pending.session.state != pi.STATE_CONNECTING):
+            return
+        self.logger.info('%s did not answer the request to share within %d seconds' % (username, NEGOTIATION_TIMEOUT))
+        status_bar.status_message('no answer from %s' % username)
+        registry.removeSession(pending.session)
+        pending.session.disconnect()
+
+
     def dropUserFromLists(self, user):
         username = user.lstrip(self.getNickPrefixes())
-        if username in self.peerUsers:
-            self.peerUsers.remove(username)
-        if username in self.unverifiedUsers:
-            self.unverifiedUsers.remove(username)
+        self.versionProber.cancel(username)
+        if self.roster is not None:
+            self.roster.remove(username)
 
 
-    def addUserToLists(self, user):
+    def addUserToLists(self, user, priority=roster.PRIORITY_LISTED):
         username = user.lstrip(self.getNickPrefixes())
-        self.unverifiedUsers.append(username)
-        self.ctcpMakeQuery(user, [('VERSION', None)])
-        # reactor.callFromThread(self.ctcpMakeQuery, user, [('VERSION', None)])
+        if self.roster is None:
+            self.roster = roster.Roster()
+        isPeer = self.peerCache.lookup(username)
+        if isPeer is False:
+            # other client type, known from an earlier probe
+            return
+        if not self.roster.add(username):
+            return
+        if isPeer:
+            self.roster.verify(username)
+        else:
+            self.versionProber.probe(username, priority)
+
+
+    def sendVersionProbe(self, username):
+        self.ctcpMakeQuery(username, [('VERSION', None)])
 
 
     def getNickPrefixes(self):
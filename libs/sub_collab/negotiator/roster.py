@@ -0,0 +1,318 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+from twisted.internet import reactor
+import heapq, json, logging, os, time
+
+# Channel membership of an IRC negotiator, without any Sublime Text dependencies.
+# Channels can have thousands of members, so membership is kept in sets, the CTCP
+# VERSION probes that tell peers from other clients apart are rate limited, and their
+# answers are cached on disk so members are only probed again once the cached answer is old.
+
+logger = logging.getLogger('SubliminalCollaborator.roster')
+
+# probe priorities, lower priorities are probed first
+PRIORITY_REQUESTED = 0
+PRIORITY_JOINED = 1
+PRIORITY_LISTED = 2
+
+# default for the most VERSION probes sent per second
+PROBE_RATE = 2.0
+
+# in seconds, how long cached answers to VERSION probes are trusted
+PEER_MAX_AGE = 30 * 24 * 60 * 60
+# other clients may be replaced by this plugin at any time, so they are probed again sooner
+OTHER_MAX_AGE = 24 * 60 * 60
+
+# in seconds, answers are written to the cache file together after this long
+SAVE_DELAY = 5
+
+
+def nickKey(nick):
+    """
+    @return: C{str} key of the given nick, nicks are case insensitive
+    """
+    return nick.lower()
+
+
+class Roster(object):
+    """
+    Members of a channel, either verified peers or not verified yet.
+    Members found to use other clients are not kept at all.
+    """
+
+    def __init__(self):
+        # nick key -> nick as last seen
+        self.nicks = {}
+        self.verified = set()
+
+
+    def __contains__(self, nick):
+        return nickKey(nick) in self.nicks
+
+
+    def __len__(self):
+        return len(self.nicks)
+
+
+    def add(self, nick):
+        """
+        @return: True if the nick was not a member yet
+        """
+        key = nickKey(nick)
+        if key in self.nicks:
+            self.nicks[key] = nick
+            return False
+        self.nicks[key] = nick
+        return True
+
+
+    def remove(self, nick):
+        """
+        @return: True if the nick was a member
+        """
+        key = nickKey(nick)
+        if not key in self.nicks:
+            return False
+        del self.nicks[key]
+        self.verified.discard(key)
+        return True
+
+
+    def rename(self, oldNick, newNick):
+        """
+        Keep whether a member is verified across a nick change.
+
+        @return: True if the member was verified
+        """
+        wasVerified = self.isVerified(oldNick)
+        self.remove(oldNick)
+        self.add(newNick)
+        if wasVerified:
+            self.verify(newNick)
+        return wasVerified
+
+
+    def verify(self, nick):
+        key = nickKey(nick)
+        if key in self.nicks:
+            self.verified.add(key)
+
+
+    def isVerified(self, nick):
+        return nickKey(nick) in self.verified
+
+
+    def clear(self):
+        self.nicks.clear()
+        self.verified.clear()
+
+
+    def listMembers(self, prefix=''):
+        """
+        @return: C{tuple} of the C{list}s of verified and unverified nicks starting
+            with the given prefix, both sorted
+        """
+        prefix = nickKey(prefix)
+        verified = []
+        unverified = []
+        # only asked for when choosing a peer, sorting then is cheaper than keeping an index
+        for key in sorted([key for key in self.nicks if key.startswith(prefix)]):
+            if key in self.verified:
+                verified.append(self.nicks[key])
+            else:
+                unverified.append(self.nicks[key])
+        return (verified, unverified)
+
+
+class VersionProber(object):
+    """
+    Sends CTCP VERSION probes at most C{rate} per second, in order of priority
+    and then of request, so a channel listing does not flood the server or the
+    line queue of the irc client.
+    """
+
+    def __init__(self, send, rate=PROBE_RATE):
+        """
+        @param send: C{callable} sending a probe to the nick it is given
+        """
+        self.send = send
+        self.interval = 1.0 / rate
+        # heap of (priority, sequence, nick key, nick)
+        self.queue = []
+        # nick key -> priority it is queued with, entries of the heap not in here are dropped
+        self.queued = {}
+        self.sequence = 0
+        self.lastSent = 0
+        self.sendCall = None
+
+
+    def probe(self, nick, priority=PRIORITY_LISTED):
+        key = nickKey(nick)
+        if self.queued.get(key, priority + 1) <= priority:
+            return
+        # a higher priority supersedes the queued entry
+        self.queued[key] = priority
+        self.sequence += 1
+        heapq.heappush(self.queue, (priority, self.sequence, key, nick))
+        self.schedule()
+
+
+    def cancel(self, nick):
+        self.queued.pop(nickKey(nick), None)
+
+
+    def pending(self):
+        return len(self.queued)
+
+
+    def schedule(self):
+        if (self.sendCall is not None) or (len(self.queued) == 0):
+            return
+        delay = max(0, self.lastSent + self.interval - time.time())
+        self.sendCall = reactor.callLater(delay, self.sendNext)
+
+
+    def sendNext(self):
+        self.sendCall = None
+        while len(self.queue) > 0:
+            priority, sequence, key, nick = heapq.heappop(self.queue)
+            if self.queued.get(key) == priority:
+                del self.queued[key]
+                self.lastSent = time.time()
+                self.send(nick)
+                break
+        self.schedule()
+
+
+    def stop(self):
+        if (self.sendCall is not None) and self.sendCall.active():
+            self.sendCall.cancel()
+        self.sendCall = None
+        self.queue = []
+        self.queued.clear()
+
+
+class PeerCache(object):
+    """
+    Answers to VERSION probes of the members of one channel, kept in a JSON file
+    shared with the other channels so they survive reconnects and restarts.
+    """
+
+    def __init__(self, path, channelKey):
+        """
+        @param path: C{str} JSON file, or None to only cache in memory
+        @param channelKey: C{str} section of the file for this channel
+        """
+        self.path = path
+        self.channelKey = channelKey
+        # nick key -> time of the answer
+        self.peers = {}
+        self.others = {}
+        self.saveCall = None
+        self.load()
+
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            cacheFile = open(self.path, 'r')
+            try:
+                section = json.load(cacheFile).get(self.channelKey, {})
+            finally:
+                cacheFile.close()
+        except (IOError, OSError, ValueError), e:
+            logger.warn('Ignoring the peer cache %s: %s' % (self.path, e))
+            return
+        now = time.time()
+        for key, answeredAt in section.get('peers', {}).iteritems():
+            if now - answeredAt < PEER_MAX_AGE:
+                self.peers[key] = answeredAt
+        for key, answeredAt in section.get('others', {}).iteritems():
+            if now - answeredAt < OTHER_MAX_AGE:
+                self.others[key] = answeredAt
+        logger.debug('Loaded %d peers and %d other clients of %s from %s' % \
+            (len(self.peers), len(self.others), self.channelKey, self.path))
+
+
+    def lookup(self, nick):
+        """
+        @return: True for a peer, False for another client, None if the nick has to be probed
+        """
+        key = nickKey(nick)
+        now = time.time()
+        if now - self.peers.get(key, 0) < PEER_MAX_AGE:
+            return True
+        if now - self.others.get(key, 0) < OTHER_MAX_AGE:
+            return False
+        return None
+
+
+    def remember(self, nick, isPeer):
+        key = nickKey(nick)
+        if isPeer:
+            self.peers[key] = time.time()
+            self.others.pop(key, None)
+        else:
+            self.others[key] = time.time()
+            self.peers.pop(key, None)
+        if self.path and (self.saveCall is None):
+            self.saveCall = reactor.callLater(SAVE_DELAY, self.save)
+
+
+    def flush(self):
+        if (self.saveCall is not None) and self.saveCall.active():
+            self.saveCall.cancel()
+            self.save()
+
+
+    def save(self):
+        """
+        Write this channel's section of the cache file, keeping the other sections.
+        """
+        self.saveCall = None
+        if not self.path:
+            return
+        try:
+            sections = {}
+            if os.path.exists(self.path):
+                try:
+                    cacheFile = open(self.path, 'r')
+                    try:
+                        sections = json.load(cacheFile)
+                    finally:
+                        cacheFile.close()
+                except ValueError:
+                    sections = {}
+            sections[self.channelKey] = {'peers': self.peers, 'others': self.others}
+            tmpPath = self.path + '.tmp'
+            cacheFile = open(tmpPath, 'w')
+            try:
+                json.dump(sections, cacheFile, indent=2, sort_keys=True)
+            finally:
+                cacheFile.close()
+            if os.name == 'nt' and os.path.exists(self.path):
+                # rename does not replace on windows
+                os.remove(self.path)
+            os.rename(tmpPath, self.path)
+        except (IOError, OSError), e:
+            logger.error('Failed to write the peer cache %s: %s' % (self.path, e))
@@ -20,7 +20,7 @@
 #   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 #   THE SOFTWARE.
 from zope.interface import Interface, implements
-from sub_collab import common
+from sub_collab import common, registry
 
 
 #################################################################################
@@ -35,14 +35,35 @@ HOST_ROLE = 'host'
 # states #
 STATE_CONNECTING = 'connecting'
 STATE_CONNECTED = 'connected'
+# the connection was lost, waiting for the session to be resumed over a new one
+STATE_RESUMING = 'resuming'
 STATE_REJECT_TRIGGERED_DISCONNECTING = 'disconnecting-on-rejected'
 STATE_DISCONNECTING = 'disconnecting'
 STATE_DISCONNECTED = 'disconnected'
 
+#*** session features, negotiated with the CONNECTED handshake ***#
+# VIEW_CHUNK payloads of a (re)share form a single zlib stream
+FEATURE_ZLIB        = 'zlib'
+# EDIT payloads form a single zlib stream for the life of the connection
+FEATURE_ZLIB_EDITS  = 'zlib-edits'
+# VIEW_SYNC carries the state of a hash tree of the view, see sub_collab.peer.hashtree
+FEATURE_MERKLE      = 'merkle'
+# SELECTION and POSITION payloads are packed region sets, see sub_collab.peer.regions
+FEATURE_PACKED_REGIONS = 'packed-regions'
+# further views can be shared over the same connection in CHANNEL messages
+FEATURE_CHANNELS    = 'channels'
+# both sides edit the view, with EDIT_TYPE_OT operations transformed against each other, see sub_collab.peer.ot
+FEATURE_OT          = 'ot'
+# messages are sequenced so that a lost connection can be resumed, see sub_collab.peer.resume
+FEATURE_RESUME      = 'resume'
+# round trip times are measured with PING messages, see sub_collab.peer.stats
+FEATURE_PING        = 'ping'
+
 #*** constants representing message types and sub-types ***#
 
 #--- message types ---#
 # sent by client-peer on connection, sent back by server as ACK
+# payload is a comma separated list of offered (client) or agreed upon (server) features
 CONNECTED       = 0
 # sent by client-peer prior to disconnect, sent back by server as ACK
 DISCONNECT      = 1
@@ -52,7 +73,7 @@ SHARE_VIEW      = 2
 SHARE_VIEW_ACK  = 3
 # chunk of view data
 VIEW_CHUNK      = 4
-# sent in reply to a VIEW_CHUNK, with payloadSize indicating what was received
+# sent in reply to a VIEW_CHUNK once it is in the view, with payloadSize indicating what was received
 VIEW_CHUNK_ACK  = 5
 # sent to signal to the peer that the entire view has been sent
 END_OF_VIEW     = 6
@@ -61,9 +82,9 @@ END_OF_VIEW_ACK = 7
 BAD_VIEW_SEND   = 8
 # send the syntax config associated with the shared file
 SYNTAX          = 9
-# view selection payload
+# view selection payload, str() of the selected regions or a packed selection if FEATURE_PACKED_REGIONS was agreed
 SELECTION       = 10
-# view position payload
+# view position payload, str() of the center region or a packed region set if FEATURE_PACKED_REGIONS was agreed
 POSITION        = 11
 # swap session roles
 SWAP_ROLE       = 12
@@ -71,12 +92,35 @@ SWAP_ROLE       = 12
 SWAP_ROLE_ACK   = 13
 # sent if the peer denies the swap role request
 SWAP_ROLE_NACK  = 14
-# view sync message (payload is host view size)
+# view sync message (payload is host view size, or the host hash tree state if FEATURE_MERKLE was agreed,
+# preceded by the host edit counts if FEATURE_OT was agreed)
 VIEW_SYNC       = 15
 # view resync request (client-to-host... need to resend the view as it is now)
+# payload is either empty (resend everything) or a block signature of the client view (send a delta)
 VIEW_RESYNC     = 16
 # view reshare request, like SHARE_VIEW but refreshes the buffer instead of creating a new buffer
 RESHARE_VIEW    = 17
+# reply to a VIEW_RESYNC with a block signature, payload is a delta against the signed view contents
+VIEW_DELTA      = 18
+# partner-to-host, payload is a list of hash tree node ids the partner wants the children of
+VIEW_TREE_QUERY = 19
+# reply to a VIEW_TREE_QUERY, payload is the host hash tree state and the requested child hashes
+VIEW_TREE_NODES = 20
+# partner-to-host, payload is a list of hash tree leaves the partner wants the contents of
+VIEW_RANGE_QUERY = 21
+# reply to a VIEW_RANGE_QUERY, payload is the host hash tree state and the requested leaf contents
+VIEW_RANGE      = 22
+# payload is a 2 byte channel id followed by a complete message of the session on that channel
+CHANNEL         = 23
+# sent to a relay hub ahead of CONNECTED, payload is the role and the room name separated by a |
+RELAY_JOIN      = 24
+# sent by client-peer instead of CONNECTED on reconnecting to resume a session, sent back by server as ACK
+# payload is the number of messages received and the sequence number of the oldest message that can be replayed
+RESUME          = 25
+RESUME_ACK      = 26
+# round trip probe, payload is the send time of the sender, sent back unchanged in a PONG
+PING            = 27
+PONG            = 28
 # edit event payload
 EDIT            = 100
 
@@ -94,6 +138,12 @@ EDIT_TYPE_REDO              = 129
 EDIT_TYPE_REDO_OR_REPEAT    = 130
 EDIT_TYPE_SOFT_UNDO         = 131
 EDIT_TYPE_SOFT_REDO         = 132
+# payload is a sequence of offset-addressed edit operations, see sub_collab.peer.editops
+EDIT_TYPE_OPS               = 133
+# payload is the edit counts of the sender followed by an operation, see sub_collab.peer.ot
+EDIT_TYPE_OT                = 134
+# payload is the edit counts of the sender only, acknowledging the operations received
+EDIT_TYPE_OT_ACK            = 135
 
 symbolic_to_numeric = {
     'CONNECTED':                0,
@@ -114,6 +164,17 @@ symbolic_to_numeric = {
     'VIEW_SYNC':                15,
     'VIEW_RESYNC':              16,
     'RESHARE_VIEW':             17,
+    'VIEW_DELTA':               18,
+    'VIEW_TREE_QUERY':          19,
+    'VIEW_TREE_NODES':          20,
+    'VIEW_RANGE_QUERY':         21,
+    'VIEW_RANGE':               22,
+    'CHANNEL':                  23,
+    'RELAY_JOIN':               24,
+    'RESUME':                   25,
+    'RESUME_ACK':               26,
+    'PING':                     27,
+    'PONG':                     28,
     'EDIT':                     100,
     'EDIT_TYPE_NA':             120,
     'EDIT_TYPE_INSERT':         121,
@@ -127,7 +188,10 @@ symbolic_to_numeric = {
     'EDIT_TYPE_REDO':           129,
     'EDIT_TYPE_REDO_OR_REPEAT': 130,
     'EDIT_TYPE_SOFT_UNDO':      131,
-    'EDIT_TYPE_SOFT_REDO':      132
+    'EDIT_TYPE_SOFT_REDO':      132,
+    'EDIT_TYPE_OPS':            133,
+    'EDIT_TYPE_OT':             134,
+    'EDIT_TYPE_OT_ACK':         135
 }
 
 # tyvm twisted/words/protocols/irc.py for this handy dandy trick!
@@ -154,13 +218,15 @@ class IPeer(Interface):
         @return: the connected port number
         """
 
-    def clientConnect(host, port):
+    def clientConnect(host, port, addresses=None, nonce=None):
         """
         Initiate a peer-to-peer session as the partner by connecting to the
         host peer with the given host and port.
 
         @param host: ip address of the host Peer
         @param port: C{int} port number of the host Peer
+        @param addresses: C{list} of all ip addresses the host Peer offered
+        @param nonce: C{str} identifying the session offer of the host Peer, if any
 
         @return: True on success
         """
@@ -185,6 +251,14 @@ class IPeer(Interface):
         Resync the shared editor contents between the host and the partner.
         """
 
+    def resyncDeltaCollab(signature):
+        """
+        Resync the shared editor contents by sending the partner only the differences
+        to its copy of the view, as described by a block signature of that copy.
+
+        @param signature: C{str} encoded block signature, see C{sub_collab.peer.delta}
+        """
+
     def onStartCollab():
         """
         Callback method informing the peer to recieve the contents of a view.
@@ -267,6 +341,45 @@ class IPeer(Interface):
         @param content: C{Array} contents of the edit (None if delete editType)
         """
 
+    def sendViewEdits():
+        """
+        Send all changes made to the shared view since the last call as
+        offset-addressed edit operations.  Implementations may hold the
+        changes back for a short while to send bursts of edits together.
+        """
+
+    def flushEdits():
+        """
+        Send any edits held back by sendViewEdits() right away.
+        """
+
+    def recvEditOps(ops):
+        """
+        Callback method for handling offset-addressed edit operations from the peer.
+
+        @param ops: C{list} of (offset, deleteLength, insertText) tuples to apply in order
+        """
+
+    def onResumed(complete):
+        """
+        Callback method informing the peer that the session was resumed over a new connection.
+
+        @param complete: C{bool} False if messages sent by either side were lost with the old connection
+        """
+
+    def getStats():
+        """
+        @return: C{dict} of the traffic and timings of the session, see C{sub_collab.peer.stats}
+        """
+
+    def openChannel():
+        """
+        Open a new session with the same peer over the connection of this session,
+        to share another view as the host.
+
+        @return: C{IPeer} of the new session, or None if the peer does not support it
+        """
+
 
 class BasePeer(common.Observable):
     """
@@ -286,6 +399,20 @@ class BasePeer(common.Observable):
         self.addAllObservers(parentNegotiator.observers)
 
 
+    def getState(self):
+        return self.__dict__.get('_state')
+
+
+    def setState(self, state):
+        previousState = self.__dict__.get('_state')
+        self._state = state
+        if state != previousState:
+            registry.sessionStateChanged(self, previousState, state)
+
+    # every change of state is reported to the registry state callbacks
+    state = property(getState, setState)
+
+
     def getParentNegotiatorKey(self):
         return self.parentNegotiatorKey
 
@@ -20,20 +20,142 @@
 #   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 #   THE SOFTWARE.
 from zope.interface import implements
-from sub_collab.peer import base
+from sub_collab.peer import base, delta, editops, hashtree, ot, race, recorder, regions, resume, shadow, stats, stream
 from twisted.internet import reactor, protocol, error, interfaces
 from twisted.protocols import basic
 from sub_collab import registry, status_bar
 from sub_collab import event as collab_event
 import sublime
-import logging, threading, sys, socket, struct, os, re, time, functools
+import logging, threading, sys, socket, struct, os, re, time, functools, zlib, collections
 
 
-# in bytes
-MAX_CHUNK_SIZE = 1024
+# in bytes, larger edits are split across several EDIT messages
+MAX_EDIT_PAYLOAD_SIZE = 65536
 
 REGION_PATTERN = re.compile('(\d+), (\d+)')
 
+# queued view changes where only the last of a batch needs to be applied
+SUPERSEDED_VIEW_CHANGES = (base.SELECTION, base.POSITION, base.VIEW_SYNC)
+
+# outgoing edits are held back for this many milliseconds so that bursts of
+# keystrokes are sent as a single EDIT message, 0 sends every modification right away
+EDIT_COALESCE_WINDOW_MS = 20
+# pending edits are sent early once they have grown the view by this many characters
+EDIT_COALESCE_MAX_BYTES = 1024
+# or once they are spread over this many separate ranges of the view
+EDIT_COALESCE_MAX_SPANS = 64
+# commands whose changes all lie next to the selection they leave behind, only the
+# view range around it is diffed for them, see modifiedSpan()
+SPANNED_EDIT_COMMANDS = ('insert', 'left_delete', 'right_delete', 'delete_word', 'paste')
+# characters on either side of that range diffed along, for the indentation
+# added or trimmed by the editor when inserting newlines
+EDIT_SPAN_SLACK = 256
+# most SELECTION and POSITION updates sent per second, later ones replace those not yet sent
+REGION_UPDATE_RATE = 30
+
+# offer zlib compression of the view stream during the CONNECTED handshake
+COMPRESSION_ENABLED = True
+# also offer compression of the EDIT payload stream
+COMPRESS_EDITS = False
+COMPRESSION_LEVEL = 6
+
+# offer editing the view on both sides at the same time during the CONNECTED handshake
+CONCURRENT_EDITING = True
+
+# in bytes, latest messages kept to replay when resuming a lost connection, 0 to not offer resuming
+RESUME_BUFFER_SIZE = 1048576
+# in seconds, how long to wait for a lost connection to be resumed
+RESUME_TIMEOUT = 60
+# in seconds, between attempts of the client-peer to reconnect
+RESUME_RETRY_DELAY = 2
+
+# in seconds, between PING messages measuring the round trip time, 0 to not offer them
+PING_INTERVAL = 10
+
+# in milliseconds, how long a connection attempt to one of the addresses offered by the
+# host gets before the next address is tried as well, see sub_collab.peer.race
+CONNECT_ATTEMPT_DELAY_MS = 250
+
+# messages sent outside of the sequence of messages of a connection, see sub_collab.peer.resume,
+# a replayed PING would measure the outage rather than the connection
+UNSEQUENCED_MESSAGES = (base.CONNECTED, base.RELAY_JOIN, base.RESUME, base.RESUME_ACK, base.PING, base.PONG)
+
+# hash tree comparisons finding more differing nodes than this fall back to a delta resync
+MAX_TREE_REPAIR_NODES = 16
+
+# host:port of the relay hub to share views through, see sub_collab.relay
+RELAY_ADDRESS = None
+
+# directory to record the messages of every connection to, None to not record, see sub_collab.peer.recorder
+RECORD_DIR = None
+# in bytes, recordings are rotated once they reach this size
+RECORD_MAX_BYTES = 4194304
+# most files kept per recording, including the latest one
+RECORD_MAX_FILES = 4
+
+
+def configure(settings):
+    """
+    Apply the "session" section of the Accounts.sublime-settings configuration.
+
+    @param settings: C{dict} of session settings
+    """
+    global EDIT_COALESCE_WINDOW_MS
+    global EDIT_COALESCE_MAX_BYTES
+    global REGION_UPDATE_RATE
+    global COMPRESSION_ENABLED
+    global COMPRESS_EDITS
+    global RELAY_ADDRESS
+    global CONCURRENT_EDITING
+    global RESUME_BUFFER_SIZE
+    global RESUME_TIMEOUT
+    global PING_INTERVAL
+    global CONNECT_ATTEMPT_DELAY_MS
+    global RECORD_DIR
+    global RECORD_MAX_BYTES
+    global RECORD_MAX_FILES
+    EDIT_COALESCE_WINDOW_MS = int(settings.get('edit_coalesce_window_ms', EDIT_COALESCE_WINDOW_MS))
+    EDIT_COALESCE_MAX_BYTES = int(settings.get('edit_coalesce_max_bytes', EDIT_COALESCE_MAX_BYTES))
+    REGION_UPDATE_RATE = max(1, int(settings.get('region_update_rate', REGION_UPDATE_RATE)))
+    COMPRESSION_ENABLED = bool(settings.get('compression', COMPRESSION_ENABLED))
+    COMPRESS_EDITS = bool(settings.get('compress_edits', COMPRESS_EDITS))
+    RELAY_ADDRESS = settings.get('relay', RELAY_ADDRESS)
+    CONCURRENT_EDITING = bool(settings.get('concurrent_editing', CONCURRENT_EDITING))
+    RESUME_BUFFER_SIZE = int(settings.get('resume_buffer_size', RESUME_BUFFER_SIZE))
+    RESUME_TIMEOUT = int(settings.get('resume_timeout', RESUME_TIMEOUT))
+    PING_INTERVAL = int(settings.get('ping_interval', PING_INTERVAL))
+    CONNECT_ATTEMPT_DELAY_MS = int(settings.get('connect_attempt_delay_ms', CONNECT_ATTEMPT_DELAY_MS))
+    RECORD_DIR = settings.get('record_dir', RECORD_DIR)
+    RECORD_MAX_BYTES = int(settings.get('record_max_bytes', RECORD_MAX_BYTES))
+    RECORD_MAX_FILES = int(settings.get('record_max_files', RECORD_MAX_FILES))
+
+
+def parseFeatures(payload):
+    """
+    Parse the comma separated feature list carried by a CONNECTED message.
+
+    @return: C{set} of feature names
+    """
+    return set([feature for feature in payload.split(',') if feature])
+
+
+class ViewText(object):
+    """
+    The contents of a view as a text that can be sliced, for reading only the
+    ranges that are needed of a large view.
+    """
+
+    def __init__(self, view):
+        self.view = view
+
+
+    def __len__(self):
+        return self.view.size()
+
+
+    def __getitem__(self, index):
+        return self.view.substr(sublime.Region(index.start, index.stop))
+
 
 class ViewMonitorThread(threading.Thread):
 
@@ -45,6 +167,8 @@ class ViewMonitorThread(threading.Thread):
         self.peer = peer
         self.lastViewCenterLine = None
         self.shutdown = False
+        # set while grabAndSendViewPosition() waits to run on the main thread
+        self.positionCheckScheduled = False
 
 
     def grabAndSendViewPosition(self):
@@ -52,6 +176,9 @@ class ViewMonitorThread(threading.Thread):
         Separate function to be called from the sublime main thread...
         because the view.visible_region() function demands that.
         """
+        self.positionCheckScheduled = False
+        if self.shutdown:
+            return
         # calculate the center-most line in the view
         # this will match most closely with the true center of the view
         viewRegionLines = self.peer.view.split_by_newlines(self.peer.view.visible_region())
@@ -65,7 +192,24 @@ class ViewMonitorThread(threading.Thread):
 
 
     def sendViewSize(self):
-        self.peer.sendMessage(base.VIEW_SYNC, payload=str(self.peer.view.size()))
+        if self.shutdown:
+            # stopped after scheduling this, the peer may no longer be the host
+            return
+        if self.peer.heldEdits is not None:
+            # the partner is behind until the view stream is acknowledged
+            return
+        # the partner compares against its view after applying everything sent so far
+        self.peer.flushEdits()
+        if base.FEATURE_OT in self.peer.features:
+            # the partner can only compare once it has applied the same edits
+            self.peer.viewTree.update(self.peer.shadowText)
+            editCounts = struct.pack(self.peer.editCountsFmt, self.peer.editState.sent, self.peer.editState.received)
+            self.peer.sendMessage(base.VIEW_SYNC, payload=editCounts + self.peer.viewTree.state())
+        elif base.FEATURE_MERKLE in self.peer.features:
+            self.peer.viewTree.update(self.peer.shadowText)
+            self.peer.sendMessage(base.VIEW_SYNC, payload=self.peer.viewTree.state())
+        else:
+            self.peer.sendMessage(base.VIEW_SYNC, payload=str(self.peer.view.size()))
 
 
     def run(self):
@@ -73,11 +217,18 @@ class ViewMonitorThread(threading.Thread):
         count = 0
         # we must be the host and connected
         while (self.peer.role == base.HOST_ROLE) \
-                and (self.peer.state == base.STATE_CONNECTED) \
+                and (self.peer.state in (base.STATE_CONNECTED, base.STATE_RESUMING)) \
                 and (not self.shutdown):
             if not self.peer.view == None:
-                sublime.set_timeout(self.grabAndSendViewPosition, 0)
-                if count == 10:
+                # a busy main thread should not build up a backlog of position checks
+                if not self.positionCheckScheduled:
+                    self.positionCheckScheduled = True
+                    sublime.set_timeout(self.grabAndSendViewPosition, 0)
+                # hash tree checks are cheap enough to run every second
+                syncCount = 10
+                if base.FEATURE_MERKLE in self.peer.features:
+                    syncCount = 2
+                if count >= syncCount:
                     count = 0
                     sublime.set_timeout(self.sendViewSize, 0)
             time.sleep(0.5)
@@ -107,6 +258,18 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
     # - messageSubType: see constants below, 0 in all but edit-messages
     messageHeaderFmt = '!HBB'
     messageHeaderSize = struct.calcsize(messageHeaderFmt)
+    # CHANNEL message payloads start with the channel id
+    channelIdFmt = '!H'
+    channelIdSize = struct.calcsize(channelIdFmt)
+    # EDIT_TYPE_OT payloads and VIEW_SYNC payloads with FEATURE_OT start with the
+    # number of operations sent and received by the sender, see sub_collab.peer.ot
+    editCountsFmt = '!II'
+    editCountsSize = struct.calcsize(editCountsFmt)
+    # PING and PONG payloads are the time the PING was sent
+    pingFmt = '!d'
+
+    # resync deltas can be considerably larger than the Int32StringReceiver default
+    MAX_LENGTH = 16 * 1024 * 1024
 
 
     def __init__(self, username, parentNegotiator):
@@ -123,12 +286,84 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
         self.state = None
         self.view = None
         # queue of 2 or 3 part tuples
-        self.toDoToViewQueue = []
+        self.toDoToViewQueue = collections.deque()
         self.toDoToViewQueueLock = threading.Lock()
+        # set while a call to handleViewChanges() is scheduled
+        self.viewChangesScheduled = False
+        # time the first change of the scheduled batch was queued
+        self.viewChangesQueuedAt = None
+        # partner-side view edit shared by all changes applied in one batch
+        self.viewEdit = None
         # thread for polling host-side view and periodically checking view sync state
         self.viewMonitorThread = ViewMonitorThread(self)
-        # last collected command tuple (str, dict, int)
-        self.lastViewCommand = ('', {}, 0)
+        # host-side copy of the view contents as last sent to the partner,
+        # with FEATURE_OT also partner-side copy of the view contents as last sent to the host,
+        # C{shadow.ShadowText} kept up to date edit by edit
+        self.shadowText = None
+        # state of the concurrent edits if FEATURE_OT was agreed
+        self.editState = None
+        # host-side flag, cleared while partner edits made before a (re)share may still arrive
+        self.peerEditsAccepted = True
+        # set while sendEditAck() is scheduled
+        self.editAckScheduled = False
+        # edit coalescing state, see sendViewEdits()
+        self.hasPendingEdits = False
+        self.pendingEditSize = 0
+        self.pendingEditViewSize = 0
+        self.pendingEditGeneration = 0
+        # view ranges holding all pending edits, see editops.addSpan(), None for anywhere in the view
+        self.pendingEditSpans = None
+        # latest selection, C{list} of (a, b) tuples, and view position, (a, b) tuple,
+        # not yet sent, see flushRegionUpdates()
+        self.pendingSelection = None
+        self.pendingPosition = None
+        self.regionUpdateScheduled = False
+        self.lastRegionUpdateTime = 0
+        # last selection sent and received, packed selections are sent as a difference to them
+        self.lastSentSelection = None
+        self.lastRecvdSelection = None
+        # features agreed on with the peer during the CONNECTED handshake
+        self.features = set()
+        # zlib stream state, view streams are reset with every (re)share
+        self.viewCompressor = None
+        self.viewDecompressor = None
+        self.editCompressor = None
+        self.editDecompressor = None
+        # host-side producer of the view stream of a (re)share in progress
+        self.viewStreamProducer = None
+        # view streams of this connection, registered with its transport
+        self.streamProducers = stream.StreamProducerGroup()
+        # room joined through a relay hub, None if connected to the peer directly
+        self.relayRoom = None
+        # client-side nonce of the session offer we connect for, None if it came without one
+        self.sessionNonce = None
+        # sessions multiplexed over this connection, by channel id
+        self.channels = {}
+        # ids of channels we open, odd on the client side and even on the server side
+        self.nextChannelId = None
+        # messages sent and received if FEATURE_RESUME was agreed
+        self.replayBuffer = None
+        # gives up on resuming a lost connection
+        self.resumeTimer = None
+        # server-side count of replaced connections whose connectionLost() is still to come
+        self.abandonedTransports = 0
+        # traffic and timings of the session, see getStats()
+        self.stats = stats.SessionStats()
+        # sends the next PING if FEATURE_PING was agreed
+        self.pingTimer = None
+        # records the messages of the connection if RECORD_DIR is set
+        self.recorder = None
+        # (messageType, payload, onFinished, snapshot) of a (re)share waiting for the connection
+        self.pendingViewStream = None
+        # host-side EDIT payloads made while the view is being (re)shared, None if not sharing
+        self.heldEdits = None
+        # partner-side (text, blockSize) of the view contents signed for a pending delta resync,
+        # (None, None) while waiting on a reshare with FEATURE_OT
+        self.resyncBasis = None
+        # hash tree of shadowText as host, of the view contents as partner
+        self.viewTree = hashtree.HashTree()
+        # partner-side flag, set while descending the host hash tree
+        self.treeQueryPending = False
         # flag to inform EventListener if Proxy plugin is sending events
         # relates to a selection update issue around the cut command
         self.isProxyEventPublishing = False
@@ -146,33 +381,88 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
         self.peerType = base.SERVER
         self.role = base.HOST_ROLE
         self.state = base.STATE_CONNECTING
-        self.connection = reactor.listenTCP(port, self, backlog=1, interface=ipaddress)
+        # a partner racing connections to several of our addresses may reach us on more than one
+        self.connection = reactor.listenTCP(port, race.AcceptGate(self), backlog=1, interface=ipaddress)
         self.port = self.connection.getHost().port
         self.logger.info('Listening for peers at %s:%d' % (ipaddress, self.port))
         return self.port
 
 
-    def clientConnect(self, host, port):
+    def clientConnect(self, host, port, addresses=None, nonce=None):
         """
         Initiate a peer-to-peer session as the partner by connecting to the
         host peer with the given host and port.
 
         @param host: ip address of the host Peer
         @param port: C{int} port number of the host Peer
+        @param addresses: C{list} of all ip addresses the host Peer offered, if more than
+        the one given, connections to all of them are raced (see sub_collab.peer.race)
+        @param nonce: C{str} identifying the session offer of the host Peer, if any
         """
-        self.logger.info('Connecting to peer at %s:%d' % (host, port))
         self.host = host
         self.port = port
+        self.sessionNonce = nonce
         self.peerType = base.CLIENT
         self.role = base.PARTNER_ROLE
         self.state = base.STATE_CONNECTING
-        self.connection = reactor.connectTCP(self.host, self.port, self, timeout=5)
+        candidates = [host]
+        for address in addresses or []:
+            if not address in candidates:
+                candidates.append(address)
+        if len(candidates) > 1:
+            self.connection = race.ConnectionRace(self, candidates, port, CONNECT_ATTEMPT_DELAY_MS / 1000.0)
+            self.connection.start()
+            return
+        self.logger.info('Connecting to peer at %s:%d' % (host, port))
+        self.connection = reactor.connectTCP(self.host, self.port, self, timeout=race.CONNECT_TIMEOUT)
+
+
+    def raceWon(self, connector, transport, received):
+        """
+        Take over the connection the host answered first, of those made by a
+        C{race.ConnectionRace}.  Our CONNECTED handshake was sent on it already.
+
+        @param connector: C{IConnector} of the connection, we are its factory from now on
+        @param transport: C{ITransport} of the connection
+        @param received: C{str} all data received on the connection so far
+        """
+        self.host = transport.getPeer().host
+        self.logger.info('Connected to peer at %s:%d' % (self.host, self.port))
+        self.connection = connector
+        connector.factory = self
+        self.doStart()
+        transport.protocol = self
+        self.makeConnection(transport)
+        frame = self.connectedFrame()
+        self.stats.countSent(base.CONNECTED, len(frame))
+        if self.recorder is not None:
+            self.recorder.record(recorder.OUTGOING, frame)
+        self.dataReceived(received)
+
+
+    def relayConnect(self, host, port, room, role):
+        """
+        Initiate a session through a relay hub, connecting to it as the host or
+        as a partner of the given room.
+
+        @param host: ip address of the relay hub
+        @param port: C{int} port number of the relay hub
+        @param room: C{str} name of the room shared by the host and its partners
+        @param role: C{str} HOST_ROLE or PARTNER_ROLE
+        """
+        self.relayRoom = room
+        self.clientConnect(host, port)
+        self.role = role
 
 
     def disconnect(self):
         """
         Disconnect from the peer-to-peer session.
         """
+        if (self.role == base.HOST_ROLE) and (self.state == base.STATE_CONNECTED):
+            self.flushEdits()
+        for channel in self.channels.values():
+            channel.disconnect()
         self.stopCollab()
         if self.state == base.STATE_DISCONNECTED:
             # already disconnected!
@@ -210,34 +500,21 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
         Send the provided C{sublime.View} contents to the connected peer.
         """
         self.view = view
-        self.view.set_read_only(True)
         viewName = self.view.file_name()
         if not viewName == None:
             viewName = os.path.basename(viewName)
         else:
             viewName = 'NONAME'
         totalToSend = self.view.size()
-        begin = 0
-        end = MAX_CHUNK_SIZE
-        # now we make sure we are connected... better way to do this?
-        while not self.state == base.STATE_CONNECTED:
-            time.sleep(1.0)
-            if (self.state == base.STATE_DISCONNECTING) or (self.state == base.STATE_DISCONNECTED):
-                self.logger.error('While waiting to share view over a connection the peer was disconnected!')
-                self.disconnect()
-                return
         self.logger.info('Sharing view %s with %s' % (self.view.file_name(), self.sharingWithUser))
-        self.toAck = []
-        self.sendMessage(base.SHARE_VIEW, payload=('%s|%s' % (viewName, totalToSend)))
-        while begin < totalToSend:
-            chunkToSend = self.view.substr(sublime.Region(begin, end))
-            self.toAck.append(len(chunkToSend))
-            self.sendMessage(base.VIEW_CHUNK, payload=chunkToSend)
-            begin = begin + MAX_CHUNK_SIZE
-            end = end + MAX_CHUNK_SIZE
-            status_bar.progress_message("sending view to %s" % self.sharingWithUser, begin, totalToSend)
-        self.sendMessage(base.END_OF_VIEW, payload=view.settings().get('syntax'))
-        self.view.set_read_only(False)
+        self.streamView(base.SHARE_VIEW, '%s|%s' % (viewName, totalToSend), self.onViewShared)
+
+
+    def onViewShared(self):
+        """
+        Callback method informing the host that the view has been sent.
+        """
+        self.endViewStream()
         # start the view monitoring thread
         self.viewMonitorThread.start()
 
@@ -247,32 +524,20 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
         Resync the shared editor contents between the host and the partner.
         """
         status_bar.status_message('RESYNCING VIEW CONTENT WITH PEER')
-        self.view.set_read_only(True)
         totalToSend = self.view.size()
-        begin = 0
-        end = MAX_CHUNK_SIZE
-        # now we make sure we are connected... better way to do this?
-        while not self.state == base.STATE_CONNECTED:
-            time.sleep(1.0)
-            if (self.state == base.STATE_DISCONNECTING) or (self.state == base.STATE_DISCONNECTED):
-                self.logger.error('While waiting to resync view over a connection the peer was disconnected!')
-                self.disconnect()
-                return
         view_name = self.view.file_name()
         if not view_name:
             view_name = self.view.name()
         self.logger.info('Resyncing view %s with %s' % (view_name, self.sharingWithUser))
-        self.toAck = []
-        self.sendMessage(base.RESHARE_VIEW, payload=str(totalToSend))
-        while begin < totalToSend:
-            chunkToSend = self.view.substr(sublime.Region(begin, end))
-            self.toAck.append(len(chunkToSend))
-            self.sendMessage(base.VIEW_CHUNK, payload=chunkToSend)
-            begin = begin + MAX_CHUNK_SIZE
-            end = end + MAX_CHUNK_SIZE
-            status_bar.progress_message("sending view to %s" % self.sharingWithUser, begin, totalToSend)
-        self.sendMessage(base.END_OF_VIEW, payload=self.view.settings().get('syntax'))
-        self.view.set_read_only(False)
+        self.stats.resyncs += 1
+        self.streamView(base.RESHARE_VIEW, str(totalToSend), self.onViewResynced)
+
+
+    def onViewResynced(self):
+        """
+        Callback method informing the host that the view has been resent.
+        """
+        self.endViewStream()
         # send view position as it stands now so the partner view is positioned appropriately post-resync
         viewRegionLines = self.view.split_by_newlines(self.view.visible_region())
         lineIdx = len(viewRegionLines) / 2 - 1
@@ -285,6 +550,168 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
             self.viewMonitorThread.start()
 
 
+    def streamView(self, messageType, payload, onFinished):
+        """
+        Stream a snapshot of the view contents to the peer, announced with a SHARE_VIEW
+        or RESHARE_VIEW message, as soon as we are connected.  The view stays editable,
+        edits made in the meantime are held back until the partner acknowledges the
+        END_OF_VIEW and are then sent on top of the snapshot.
+
+        @param messageType: C{int} SHARE_VIEW or RESHARE_VIEW
+        @param payload: C{str} payload of the announcing message
+        @param onFinished: callable invoked on the reactor thread once END_OF_VIEW has been sent
+        """
+        if self.heldEdits is not None:
+            self.logger.info('Already sending the view to %s' % self.sharingWithUser)
+            return
+        # coalesced edits belong before the snapshot
+        self.flushEdits()
+        self.shadowText = shadow.ShadowText(self.view.substr(sublime.Region(0, self.view.size())))
+        self.viewTree.invalidate()
+        if self.editState is not None:
+            # both sides start over from the snapshot, see handleViewChanges()
+            self.editState.reset()
+            self.peerEditsAccepted = False
+        self.heldEdits = []
+        self.pendingViewStream = (messageType, payload, onFinished, self.shadowText.snapshot())
+        if self.state == base.STATE_CONNECTED:
+            self.startViewStream()
+
+
+    def startViewStream(self):
+        """
+        Start sending the pending view snapshot.
+        """
+        messageType, payload, onFinished, snapshot = self.pendingViewStream
+        self.pendingViewStream = None
+        chunkSize = self.beginViewStream()
+        self.sendMessage(messageType, payload=payload)
+        self.viewStreamProducer = stream.ViewStreamProducer(self, snapshot, chunkSize, self.view.settings().get('syntax'), onFinished)
+        # queued behind the announcing message
+        reactor.callFromThread(self.viewStreamProducer.start)
+
+
+    def beginViewStream(self):
+        """
+        Reset the outgoing view stream state before (re)sharing the view.
+
+        @return: C{int} number of characters to send per VIEW_CHUNK
+        """
+        self.toAck = []
+        if base.FEATURE_ZLIB in self.features:
+            self.viewCompressor = zlib.compressobj(COMPRESSION_LEVEL)
+            return stream.MAX_COMPRESSED_CHUNK_SIZE
+        self.viewCompressor = None
+        return stream.MAX_CHUNK_SIZE
+
+
+    def endViewStream(self):
+        """
+        Reset the outgoing view stream state once the view has been sent.
+        """
+        self.viewStreamProducer = None
+        self.viewCompressor = None
+
+
+    def sendHeldEdits(self):
+        """
+        Send the edits made while the view was being sent, once the partner has it,
+        followed by the selection and position updates held back behind them.
+        """
+        heldEdits = self.heldEdits
+        self.heldEdits = None
+        if len(heldEdits) > 0:
+            self.logger.debug('sending %d edits held back during the view stream' % len(heldEdits))
+        editType = base.EDIT_TYPE_OPS
+        if base.FEATURE_OT in self.features:
+            editType = base.EDIT_TYPE_OT
+        for payload in heldEdits:
+            self.sendMessage(base.EDIT, editType, payload=payload)
+        self.scheduleRegionUpdates()
+
+
+    def sendViewChunk(self, chunk):
+        """
+        Send a chunk of the view contents, compressed as part of the view stream if
+        negotiated with the peer.  Each chunk is flushed so that the partner can
+        apply it as soon as it arrives.  Must be called from the reactor thread.
+
+        @param chunk: C{unicode} view contents
+
+        @return: C{int} size of the sent payload
+        """
+        payload = chunk.encode('utf-8')
+        if self.viewCompressor is not None:
+            payload = self.viewCompressor.compress(payload) + self.viewCompressor.flush(zlib.Z_SYNC_FLUSH)
+        # acks report the received payload size
+        self.toAck.append(len(payload))
+        self.writeMessage(base.VIEW_CHUNK, payload=payload)
+        return len(payload)
+
+
+    def viewStreamProgress(self, sent, total):
+        status_bar.progress_message("sending view to %s" % self.sharingWithUser, sent, total)
+
+
+    def resyncDeltaCollab(self, signature):
+        """
+        Resync the shared editor contents by sending the partner only the differences
+        to its copy of the view, as described by a block signature of that copy.
+        Unlike resyncCollab() the view stays editable throughout.
+
+        @param signature: C{str} encoded block signature, see C{sub_collab.peer.delta}
+        """
+        # make sure the partner-side copy we keep is up to date
+        self.flushEdits()
+        textLength, blockSize, sigs = delta.decodeSignature(signature)
+        payload = delta.encodeDelta(delta.computeDelta(self.shadowText.text(), textLength, blockSize, sigs))
+        if base.FEATURE_ZLIB in self.features:
+            payload = zlib.compress(payload, COMPRESSION_LEVEL)
+        if len(payload) > self.MAX_LENGTH - self.messageHeaderSize:
+            self.resyncCollab()
+            return
+        self.logger.info('Resyncing view with %s using a %d byte delta' % (self.sharingWithUser, len(payload)))
+        self.stats.resyncs += 1
+        self.sendMessage(base.VIEW_DELTA, payload=payload)
+
+
+    def requestResync(self):
+        """
+        Ask the host to resync the view, sending a block signature of our copy
+        so that only the differences have to be sent back.
+        """
+        if self.resyncBasis is not None:
+            # still waiting on the last one
+            return
+        self.stats.resyncs += 1
+        if base.FEATURE_OT in self.features:
+            # edits rebuilt from a delta would bypass the transforms, have the view reshared instead
+            self.resyncBasis = (None, None)
+            self.logger.info('Requesting a reshare of the view from %s' % self.sharingWithUser)
+            self.sendMessage(base.VIEW_RESYNC)
+            return
+        text = self.view.substr(sublime.Region(0, self.view.size()))
+        blockSize = delta.blockSizeFor(len(text))
+        self.resyncBasis = (text, blockSize)
+        self.logger.info('Requesting resync of %d characters from %s' % (len(text), self.sharingWithUser))
+        self.sendMessage(base.VIEW_RESYNC, payload=delta.encodeSignature(len(text), blockSize, delta.signature(text, blockSize)))
+
+
+    def applyResyncDelta(self, payload):
+        """
+        Rebuild the host view contents from a resync delta and apply the result
+        to our view as a minimal set of edits.
+        """
+        if self.resyncBasis is None:
+            self.logger.warn('Received a view delta from %s without asking for one' % self.sharingWithUser)
+            return
+        basis, blockSize = self.resyncBasis
+        self.resyncBasis = None
+        newText = delta.applyDelta(basis, blockSize, delta.decodeDelta(payload))
+        currentText = self.view.substr(sublime.Region(0, self.view.size()))
+        self.recvEditOps(editops.diffText(currentText, newText))
+
+
     def onStartCollab(self):
         """
         Callback method informing the peer that we have received the view.
@@ -301,6 +728,10 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
         if (self.peerType == base.CLIENT) and (self.view != None):
             self.view.set_read_only(False)
             self.view = None
+            # view changes still queued have no view left to apply to
+            self.toDoToViewQueueLock.acquire()
+            self.toDoToViewQueue.clear()
+            self.toDoToViewQueueLock.release()
         status_bar.status_message('stopped sharing with %s' % self.str())
 
 
@@ -318,10 +749,13 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
         if self.view is None:
             self.logger.warn('Request to swap role when no view is being shared!')
             return
+        if base.FEATURE_OT in self.features:
+            status_bar.status_message('%s and you can both edit already' % self.str())
+            return
         if self.role == base.HOST_ROLE:
+            self.flushEdits()
             self.logger.debug('Stopping ViewMonitorThread until role swap is decided')
             self.viewMonitorThread.destroy()
-            self.viewMonitorThread.join()
         self.sendMessage(base.SWAP_ROLE)
 
 
@@ -332,10 +766,14 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
         if self.view is None:
             self.logger.warn('Request from %s to swap role when no view is being shared!' % self.str())
             return
+        if base.FEATURE_OT in self.features:
+            # both sides edit already, the roles only say who shares the view
+            self.sendMessage(base.SWAP_ROLE_NACK)
+            return
         if self.role == base.HOST_ROLE:
+            self.flushEdits()
             self.logger.debug('Stopping ViewMonitorThread until role swap is decided')
             self.viewMonitorThread.destroy()
-            self.viewMonitorThread.join()
         message = None
         view_name = self.view.file_name()
         if not view_name or (len(view_name) == 0):
@@ -351,18 +789,23 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
         if swapping_roles:
             if self.role == base.HOST_ROLE:
                 self.role = base.PARTNER_ROLE
+                self.shadowText = None
+                self.viewTree.invalidate()
                 self.view.set_read_only(True)
             else:
                 self.role = base.HOST_ROLE
+                self.shadowText = shadow.ShadowText(self.view.substr(sublime.Region(0, self.view.size())))
+                self.viewTree.invalidate()
                 self.view.set_read_only(False)
                 self.viewMonitorThread = ViewMonitorThread(self)
                 self.viewMonitorThread.start()
             self.sendMessage(base.SWAP_ROLE_ACK)
         else:
+            if self.role == base.HOST_ROLE:
+                self.viewMonitorThread = ViewMonitorThread(self)
+                self.viewMonitorThread.start()
             self.sendMessage(base.SWAP_ROLE_NACK)
         self.logger.info('session %s with %s role now changed to %s' % (view_name, self.str(), self.role))
-        # wait for the swap to complete on the client side... 0.5 second because the message is tiny
-        time.sleep(0.5)
 
 
     def onSwapRoleAck(self):
@@ -372,9 +815,13 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
         """
         if self.role == base.HOST_ROLE:
             self.role = base.PARTNER_ROLE
+            self.shadowText = None
+            self.viewTree.invalidate()
             self.view.set_read_only(True)
         else:
             self.role = base.HOST_ROLE
+            self.shadowText = shadow.ShadowText(self.view.substr(sublime.Region(0, self.view.size())))
+            self.viewTree.invalidate()
             self.view.set_read_only(False)
             self.viewMonitorThread = ViewMonitorThread(self)
             self.viewMonitorThread.start()
@@ -392,7 +839,7 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
         The caller of swapRole() may have this called if the connected peer rejects a swap role request.
         """
         if self.role == base.HOST_ROLE:
-            self.viewMonitorThread = ViewMonitorThread()
+            self.viewMonitorThread = ViewMonitorThread(self)
             self.viewMonitorThread.start()
         sublime.message_dialog('%s sharing %s did not want to swap roles' % (self.str(), self.view.file_name()))
 
@@ -400,12 +847,12 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
     def sendViewPositionUpdate(self, centerOnRegion):
         """
         Send a window view position update to the peer so they know what
-        we are looking at.
+        we are looking at.  Only the latest position is kept until it is sent.
 
         @param centerOnRegion: C{sublime.Region} of the central-most line of the current visible portion of the view to send to the peer.
         """
-        status_bar.heartbeat_message('sharing with %s' % self.str())
-        self.sendMessage(base.POSITION, payload=str(centerOnRegion))
+        self.pendingPosition = (centerOnRegion.a, centerOnRegion.b)
+        self.scheduleRegionUpdates()
 
 
     def recvViewPositionUpdate(self, centerOnRegion):
@@ -419,12 +866,59 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
 
     def sendSelectionUpdate(self, selectedRegions):
         """
-        Send currently selected regions to the peer.
+        Send currently selected regions to the peer.  Only the latest selection
+        is kept until it is sent, see flushRegionUpdates().
 
         @param selectedRegions: C{sublime.RegionSet} of all selected regions in the current view.
         """
-        status_bar.heartbeat_message('sharing with %s' % self.str())
-        self.sendMessage(base.SELECTION, payload=str(selectedRegions))
+        self.pendingSelection = [(region.a, region.b) for region in selectedRegions]
+        if self.hasPendingEdits:
+            for region in selectedRegions:
+                if not region.empty():
+                    # an actual selection, not just carets moved along by typing
+                    self.flushEdits()
+                    break
+        self.scheduleRegionUpdates()
+
+
+    def scheduleRegionUpdates(self):
+        """
+        Schedule flushRegionUpdates(), no more than REGION_UPDATE_RATE times per second.
+        """
+        if self.regionUpdateScheduled:
+            return
+        self.regionUpdateScheduled = True
+        delay = self.lastRegionUpdateTime + 1000.0 / REGION_UPDATE_RATE - time.time() * 1000
+        sublime.set_timeout(self.flushRegionUpdates, int(max(0, delay)))
+
+
+    def flushRegionUpdates(self):
+        """
+        Send the latest selection and view position updates.  A selection stays held
+        back while there are edits it may refer to that have not been sent yet.
+        """
+        self.regionUpdateScheduled = False
+        if (self.state != base.STATE_CONNECTED) or (self.heldEdits is not None):
+            return
+        self.lastRegionUpdateTime = time.time() * 1000
+        if (self.pendingSelection is not None) and (not self.hasPendingEdits):
+            selection = self.pendingSelection
+            self.pendingSelection = None
+            status_bar.heartbeat_message('sharing with %s' % self.str())
+            if base.FEATURE_PACKED_REGIONS in self.features:
+                payload = regions.encodeSelection(selection, self.lastSentSelection)
+                self.lastSentSelection = selection
+            else:
+                payload = '[%s]' % ', '.join(['(%d, %d)' % region for region in selection])
+            self.sendMessage(base.SELECTION, payload=payload)
+        if self.pendingPosition is not None:
+            centerOn = self.pendingPosition
+            self.pendingPosition = None
+            status_bar.heartbeat_message('sharing with %s' % self.str())
+            if base.FEATURE_PACKED_REGIONS in self.features:
+                self.sendMessage(base.POSITION, payload=regions.encodeRegions([centerOn]))
+            else:
+                self.sendMessage(base.POSITION, payload='(%d, %d)' % centerOn)
 
 
     def recvSelectionUpdate(self, selectedRegions):
@@ -453,6 +947,235 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
             self.sendMessage(base.EDIT, editType)
 
 
+    def sendViewEdits(self):
+        """
+        Send all changes made to the shared view since the last call as
+        offset-addressed edit operations, computed against the copy of the
+        view contents the partner is known to have.
+
+        Modifications are coalesced for up to EDIT_COALESCE_WINDOW_MS milliseconds,
+        until they grow the view by EDIT_COALESCE_MAX_BYTES or until they are spread
+        over EDIT_COALESCE_MAX_SPANS ranges of the view, and are then sent as a single
+        EDIT message by flushEdits().  Only the view ranges holding the modifications
+        are diffed, see modifiedSpan().
+        """
+        if (self.shadowText is None) or (self.viewEdit is not None):
+            # nothing shared yet, or the modification is an edit of the peer being applied
+            return
+        viewSize = self.view.size()
+        if self.hasPendingEdits:
+            lastViewSize = self.pendingEditViewSize
+        else:
+            lastViewSize = len(self.shadowText)
+        span = self.modifiedSpan(viewSize, viewSize - lastViewSize)
+        if not self.hasPendingEdits:
+            self.pendingEditSpans = []
+        if (span is None) or (self.pendingEditSpans is None):
+            self.pendingEditSpans = None
+        else:
+            self.pendingEditSpans = editops.addSpan(self.pendingEditSpans, span[0], span[1], viewSize - lastViewSize)
+        self.pendingEditViewSize = viewSize
+        if EDIT_COALESCE_WINDOW_MS <= 0:
+            self.hasPendingEdits = True
+            self.flushEdits()
+            return
+        if not self.hasPendingEdits:
+            self.hasPendingEdits = True
+            self.pendingEditSize = 0
+            sublime.set_timeout(functools.partial(self.flushEditsAfterWindow, self.pendingEditGeneration), EDIT_COALESCE_WINDOW_MS)
+        self.pendingEditSize += max(1, abs(viewSize - lastViewSize))
+        if (self.pendingEditSize >= EDIT_COALESCE_MAX_BYTES) \
+                or ((self.pendingEditSpans is not None) and (len(self.pendingEditSpans) >= EDIT_COALESCE_MAX_SPANS)):
+            self.flushEdits()
+
+
+    def modifiedSpan(self, viewSize, sizeDelta):
+        """
+        Find the view range changed by the modification just made, from the command
+        that made it and the selection it left behind: typing, deleting and pasting
+        change the text right in front of or behind the carets.
+
+        @param viewSize: C{int} size of the view after the modification
+        @param sizeDelta: C{int} change of the view size made by the modification
+
+        @return: C{tuple} (begin, end) view range holding all changes of the modification,
+        or None if they may be anywhere in the view
+        """
+        if self.view.command_history(1, True)[0] is not None:
+            # an undo, which restores the selection of an older edit
+            return None
+        command, args, repeat = self.view.command_history(0, True)
+        if (command not in SPANNED_EDIT_COMMANDS) or (len(self.view.sel()) == 0):
+            return None
+        inserted = 0
+        if command == 'insert':
+            inserted = len((args or {}).get('characters', u'')) * max(1, repeat)
+        elif command == 'paste':
+            inserted = len(sublime.get_clipboard() or u'') * max(1, repeat)
+        reach = abs(sizeDelta) + inserted + EDIT_SPAN_SLACK
+        begin = min([region.begin() for region in self.view.sel()])
+        end = max([region.end() for region in self.view.sel()])
+        return (max(0, begin - reach), min(viewSize, end + reach))
+
+
+    def flushEditsAfterWindow(self, generation):
+        """
+        Timer callback closing a coalescing window, ignored if the edits of that
+        window were already flushed.
+        """
+        if generation == self.pendingEditGeneration:
+            self.flushEdits()
+
+
+    def flushEdits(self):
+        """
+        Send any coalesced edits right away, the selection update held back
+        behind them follows with the next flushRegionUpdates().
+        """
+        self.pendingEditGeneration += 1
+        hadPendingEdits = self.hasPendingEdits
+        self.hasPendingEdits = False
+        self.pendingEditSize = 0
+        spans = self.pendingEditSpans
+        self.pendingEditSpans = None
+        if hadPendingEdits and (self.shadowText is not None) and (self.view is not None):
+            shadowLength = len(self.shadowText)
+            viewSize = self.view.size()
+            if (spans is None) or (len(spans) == 0) or (spans[-1][1] > viewSize) \
+                    or (sum([span[2] for span in spans]) != viewSize - shadowLength):
+                spans = [[0, viewSize, viewSize - shadowLength]]
+            ops = []
+            shift = viewSize - shadowLength
+            # back to front, so that the operations address the shadow as it is then, where each range
+            # starts earlier or later by the change of the view size made in front of it
+            for begin, end, sizeDelta in reversed(spans):
+                shift -= sizeDelta
+                ops.extend(editops.diffText(self.shadowText[begin - shift:end - shift - sizeDelta],
+                    self.view.substr(sublime.Region(begin, end)), begin - shift))
+            # ops are in descending offset order, so each deleted range is unaffected by the ones before it
+            for offset, deleteLength, insertText in ops:
+                self.viewTree.markEdit(offset, self.shadowText[offset:offset + deleteLength], insertText)
+                self.shadowText.edit(offset, deleteLength, insertText)
+            if len(ops) > 0:
+                status_bar.heartbeat_message('sharing with %s' % self.str())
+                self.logger.debug('sending %d edit operations' % len(ops))
+                if base.FEATURE_OT in self.features:
+                    editType = base.EDIT_TYPE_OT
+                    payloads = self.packEditOperations(ops, shadowLength)
+                else:
+                    editType = base.EDIT_TYPE_OPS
+                    payloads = editops.packOps(ops, MAX_EDIT_PAYLOAD_SIZE)
+                for payload in payloads:
+                    if self.heldEdits is not None:
+                        self.heldEdits.append(payload)
+                    else:
+                        self.sendMessage(base.EDIT, editType, payload=payload)
+        if self.pendingSelection is not None:
+            self.scheduleRegionUpdates()
+
+
+    def packEditOperations(self, ops, length):
+        """
+        Pack edit operations of the shared text into EDIT_TYPE_OT payloads, recording
+        each as an operation of ours for transforming the peer edits against.
+
+        @param ops: C{list} of (offset, deleteLength, insertText) tuples to apply in order
+        @param length: C{int} length of the text the edit operations apply to
+
+        @return: C{list} of C{str} binary payloads
+        """
+        payloads = []
+        for group in editops.splitOps(ops, MAX_EDIT_PAYLOAD_SIZE):
+            operation = ot.fromOps(group, length)
+            length = ot.targetLength(operation)
+            editCounts = self.editState.local(operation)
+            payloads.append(struct.pack(self.editCountsFmt, *editCounts) + ot.encodeOperation(operation))
+        return payloads
+
+
+    def recvEditOperation(self, editType, payload):
+        """
+        Callback method for handling an EDIT_TYPE_OT or EDIT_TYPE_OT_ACK message from the peer.
+        Edits of ours the peer had not seen when making the operation are sent first, and
+        the operation is then transformed against them before it is applied to the view.
+
+        @param editType: C{int} EDIT_TYPE_OT or EDIT_TYPE_OT_ACK
+        @param payload: C{str} edit counts of the peer, followed by the operation
+        """
+        if ((self.role == base.HOST_ROLE) and not self.peerEditsAccepted) or (self.shadowText is None):
+            # made before the partner had the view being (re)shared, which replaces them
+            return
+        peerSent, peerReceived = struct.unpack(self.editCountsFmt, payload[:self.editCountsSize])
+        if editType == base.EDIT_TYPE_OT_ACK:
+            self.editState.acknowledge(peerReceived)
+            return
+        self.flushEdits()
+        try:
+            operation = self.editState.remote(ot.decodeOperation(payload[self.editCountsSize:]), peerSent, peerReceived)
+        except ValueError:
+            operation = None
+        if (operation is None) or (ot.baseLength(operation) != len(self.shadowText)) or (len(self.shadowText) != self.view.size()):
+            self.logger.info('edit operation does not fit the view, view out of sync!')
+            if self.role == base.HOST_ROLE:
+                self.resyncCollab()
+            else:
+                self.requestResync()
+            return
+        ops = ot.toOps(operation)
+        self.recvEditOps(ops)
+        self.shadowText.applyOps(ops)
+        self.scheduleEditAck()
+
+
+    def scheduleEditAck(self):
+        """
+        Schedule sendEditAck(), giving edits of ours the chance to carry the acknowledgement.
+        """
+        if self.editAckScheduled:
+            return
+        self.editAckScheduled = True
+        sublime.set_timeout(self.sendEditAck, EDIT_COALESCE_WINDOW_MS)
+
+
+    def sendEditAck(self):
+        """
+        Acknowledge the operations received from the peer, so it can drop the operations
+        it kept for transforming ours against.
+        """
+        self.editAckScheduled = False
+        if (self.state != base.STATE_CONNECTED) or (self.editState is None):
+            return
+        self.flushEdits()
+        if self.editState.needsAck():
+            self.sendMessage(base.EDIT, base.EDIT_TYPE_OT_ACK, payload=struct.pack(self.editCountsFmt, *self.editState.ack()))
+
+
+    def recvEditOps(self, ops):
+        """
+        Callback method for handling offset-addressed edit operations from the peer.
+        Operations are applied directly to the view, regardless of the local selection,
+        as part of the view edit of the batch being handled by handleViewChanges().
+
+        @param ops: C{list} of (offset, deleteLength, insertText) tuples to apply in order
+        """
+        opsEdit = self.beginViewEdit()
+        for offset, deleteLength, insertText in ops:
+            if offset + deleteLength > self.view.size():
+                self.logger.info('edit operation out of view bounds, view out of sync!')
+                self.requestResync()
+                break
+            deletedText = u''
+            if deleteLength > 0:
+                deletedText = self.view.substr(sublime.Region(offset, offset + deleteLength))
+            self.viewTree.markEdit(offset, deletedText, insertText)
+            if deleteLength == 0:
+                self.view.insert(opsEdit, offset, insertText)
+            elif len(insertText) == 0:
+                self.view.erase(opsEdit, sublime.Region(offset, offset + deleteLength))
+            else:
+                self.view.replace(opsEdit, sublime.Region(offset, offset + deleteLength), insertText)
+
+
     def recvEdit(self, editType, content):
         """
         Callback method for handling edit events from the peer.
@@ -460,6 +1183,7 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
         @param editType: C{str} edit type (see above)
         @param content: C{Array} contents of the edit (None if delete editType)
         """
+        self.viewTree.invalidate()
         self.view.set_read_only(False)
         if editType == base.EDIT_TYPE_INSERT:
             self.view.run_command('insert', { 'characters': content })
@@ -496,79 +1220,176 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
         self.view.set_read_only(True)
 
 
+    def queueViewChange(self, *toDo):
+        """
+        Queue a change to the shared view, to be applied with the next batch
+        on the main UI event loop.
+        """
+        self.toDoToViewQueueLock.acquire()
+        self.toDoToViewQueue.append(toDo)
+        scheduled = self.viewChangesScheduled
+        self.viewChangesScheduled = True
+        if not scheduled:
+            self.viewChangesQueuedAt = time.time()
+        self.toDoToViewQueueLock.release()
+        if not scheduled:
+            sublime.set_timeout(self.handleViewChanges, 0)
+
+
+    def beginViewEdit(self):
+        """
+        @return: the view edit of the batch being applied, begun on first use
+        """
+        if self.viewEdit is None:
+            self.view.set_read_only(False)
+            self.viewEdit = self.view.begin_edit()
+        return self.viewEdit
+
+
+    def endViewEdit(self):
+        if self.viewEdit is not None:
+            self.view.end_edit(self.viewEdit)
+            self.viewEdit = None
+            # only views whose edits are shared with the peer stay editable
+            self.view.set_read_only(self.shadowText is None)
+
+
     def handleViewChanges(self):
         """
         Runs on the main UI event loop.
-        Goes through the list of events queued up to modify the shared view
-        and applies them to the associated view.
+        Goes through the batch of events queued up to modify the shared view since the
+        last call and applies them to the associated view in a single view edit.
+        Consecutive view chunks and edit operations are applied together, and only the
+        last selection, position and sync state of the batch are applied.
         """
+        started = time.time()
         self.toDoToViewQueueLock.acquire()
-        while len(self.toDoToViewQueue) > 0:
-            toDo = self.toDoToViewQueue.pop(0)
-            if len(toDo) == 2:
-                self.logger.debug('Handling view change %s with size %d payload' % (base.numeric_to_symbolic[toDo[0]], len(toDo[1])))
-                if (toDo[0] == base.SHARE_VIEW) or (toDo[0] == base.RESHARE_VIEW):
-                    self.totalNewViewSize = 0
-                    if toDo[0] == base.SHARE_VIEW:
-                        self.view = sublime.active_window().new_file()
-                        payloadBits = toDo[1].split('|')
-                        if payloadBits[0] == 'NONAME':
-                            self.view.set_name('SHARING-WITH-%s' % self.sharingWithUser)
+        queued = self.toDoToViewQueue
+        self.toDoToViewQueue = collections.deque()
+        self.viewChangesScheduled = False
+        queuedAt = self.viewChangesQueuedAt
+        self.toDoToViewQueueLock.release()
+        latest = {}
+        keep = set()
+        for idx, toDo in enumerate(queued):
+            if toDo[0] in SUPERSEDED_VIEW_CHANGES:
+                latest[toDo[0]] = idx
+            elif (toDo[0] == base.EDIT) and (toDo[1] < base.EDIT_TYPE_OPS) and (base.SELECTION in latest):
+                # replayed edit commands act on the selection sent before them
+                keep.add(latest[base.SELECTION])
+        batch = collections.deque([toDo for idx, toDo in enumerate(queued) if (idx in keep) or (latest.get(toDo[0], idx) == idx)])
+        try:
+            while len(batch) > 0:
+                toDo = batch.popleft()
+                if len(toDo) == 2:
+                    self.logger.debug('Handling view change %s with size %d payload' % (base.numeric_to_symbolic[toDo[0]], len(toDo[1])))
+                    if (toDo[0] == base.SHARE_VIEW) or (toDo[0] == base.RESHARE_VIEW):
+                        # local edits are no longer shared until the view has been received
+                        self.shadowText = None
+                        self.hasPendingEdits = False
+                        self.endViewEdit()
+                        self.totalNewViewSize = 0
+                        if toDo[0] == base.SHARE_VIEW:
+                            self.view = sublime.active_window().new_file()
+                            payloadBits = toDo[1].split('|')
+                            if payloadBits[0] == 'NONAME':
+                                self.view.set_name('SHARING-WITH-%s' % self.sharingWithUser)
+                            else:
+                                self.view.set_name(payloadBits[0])
+                            self.totalNewViewSize = int(payloadBits[1])
                         else:
-                            self.view.set_name(payloadBits[0])
-                        self.totalNewViewSize = int(payloadBits[1])
-                    else:
-                        # resync event, purge the old view in preparation for the fresh content
-                        self.logger.debug('resyncing view')
-                        self.lastResyncdPosition = 0
-                        self.totalNewViewSize = int(toDo[1])
-                    self.view.set_read_only(True)
-                    self.view.set_scratch(True)
-                    status_bar.progress_message("receiving view from %s" % self.sharingWithUser, self.view.size(), self.totalNewViewSize)
-                elif toDo[0] == base.VIEW_CHUNK:
-                    self.view.set_read_only(False)
-                    self.viewPopulateEdit = self.view.begin_edit()
-                    # if we are a resync chunk...
-                    if hasattr(self, 'lastResyncdPosition'):
-                        self.view.replace(self.viewPopulateEdit,  \
-                            sublime.Region(self.lastResyncdPosition, self.lastResyncdPosition + len(toDo[1])), \
-                            toDo[1])
-                        self.lastResyncdPosition += len(toDo[1])
-                    else:
-                        self.view.insert(self.viewPopulateEdit, self.view.size(), toDo[1])
-                    self.view.end_edit(self.viewPopulateEdit)
-                    self.viewPopulateEdit = None
-                    self.view.set_read_only(True)
-                    status_bar.progress_message("receiving view from %s" % self.sharingWithUser, self.view.size(), self.totalNewViewSize)
-                elif toDo[0] == base.END_OF_VIEW:
-                    self.view.set_syntax_file(toDo[1])
-                    if hasattr(self, 'lastResyncdPosition'):
-                        del self.lastResyncdPosition
-                    status_bar.progress_message("receiving view from %s" % self.sharingWithUser, self.view.size(), self.totalNewViewSize)
-                    # view is populated and configured, lets share!
-                    self.onStartCollab()
-                elif toDo[0] == base.SELECTION:
-                    status_bar.heartbeat_message('sharing with %s' % self.str())
-                    regions = []
-                    for regionMatch in REGION_PATTERN.finditer(toDo[1]):
-                        regions.append(sublime.Region(int(regionMatch.group(1)), int(regionMatch.group(2))))
-                    self.recvSelectionUpdate(regions)
-                elif toDo[0] == base.POSITION:
+                            # resync event, purge the old view in preparation for the fresh content
+                            self.logger.debug('resyncing view')
+                            self.lastResyncdPosition = 0
+                            self.totalNewViewSize = int(toDo[1])
+                        self.view.set_read_only(True)
+                        self.view.set_scratch(True)
+                        status_bar.progress_message("receiving view from %s" % self.sharingWithUser, self.view.size(), self.totalNewViewSize)
+                    elif toDo[0] == base.VIEW_CHUNK:
+                        # (text, received payload size) of each chunk
+                        chunks = [toDo[1]]
+                        while (len(batch) > 0) and (batch[0][0] == base.VIEW_CHUNK):
+                            chunks.append(batch.popleft()[1])
+                        chunk = u''.join([text for text, receivedSize in chunks])
+                        self.viewTree.invalidate()
+                        viewPopulateEdit = self.beginViewEdit()
+                        # if we are a resync chunk...
+                        if hasattr(self, 'lastResyncdPosition'):
+                            self.view.replace(viewPopulateEdit,  \
+                                sublime.Region(self.lastResyncdPosition, self.lastResyncdPosition + len(chunk)), \
+                                chunk)
+                            self.lastResyncdPosition += len(chunk)
+                        else:
+                            self.view.insert(viewPopulateEdit, self.view.size(), chunk)
+                        for text, receivedSize in chunks:
+                            self.sendMessage(base.VIEW_CHUNK_ACK, payload=str(receivedSize))
+                        status_bar.progress_message("receiving view from %s" % self.sharingWithUser, self.view.size(), self.totalNewViewSize)
+                    elif toDo[0] == base.VIEW_DELTA:
+                        self.applyResyncDelta(toDo[1])
+                    elif toDo[0] == base.VIEW_TREE_NODES:
+                        self.compareViewTree(toDo[1])
+                    elif toDo[0] == base.VIEW_RANGE:
+                        self.repairViewRanges(toDo[1])
+                    elif toDo[0] == base.VIEW_SYNC:
+                        if base.FEATURE_OT in self.features:
+                            self.checkConcurrentViewState(toDo[1])
+                        elif base.FEATURE_MERKLE in self.features:
+                            self.checkViewTreeState(toDo[1])
+                        else:
+                            self.checkViewSyncState(int(toDo[1]))
+                    elif toDo[0] == base.END_OF_VIEW:
+                        if hasattr(self, 'lastResyncdPosition'):
+                            if self.lastResyncdPosition < self.view.size():
+                                # the resent view is shorter than what we had
+                                self.viewTree.invalidate()
+                                self.view.erase(self.beginViewEdit(), sublime.Region(self.lastResyncdPosition, self.view.size()))
+                            del self.lastResyncdPosition
+                        self.endViewEdit()
+                        self.view.set_syntax_file(toDo[1])
+                        status_bar.progress_message("receiving view from %s" % self.sharingWithUser, self.view.size(), self.totalNewViewSize)
+                        # view is populated and configured, lets share!
+                        self.onStartCollab()
+                        if base.FEATURE_OT in self.features:
+                            # both sides start over from the view as it was sent
+                            self.shadowText = shadow.ShadowText(self.view.substr(sublime.Region(0, self.view.size())))
+                            self.viewTree.invalidate()
+                            self.editState.reset()
+                            self.view.set_read_only(False)
+                        # sent once applied, edits we make from now on follow it
+                        self.sendMessage(base.END_OF_VIEW_ACK)
+                    elif toDo[0] == base.END_OF_VIEW_ACK:
+                        # partner edits arriving from now on were made on the view as (re)shared
+                        self.peerEditsAccepted = True
+                    elif toDo[0] == base.SELECTION:
+                        status_bar.heartbeat_message('sharing with %s' % self.str())
+                        self.recvSelectionUpdate([sublime.Region(a, b) for a, b in toDo[1]])
+                    elif toDo[0] == base.POSITION:
+                        status_bar.heartbeat_message('sharing with %s' % self.str())
+                        self.recvViewPositionUpdate(sublime.Region(toDo[1][0], toDo[1][1]))
+                elif len(toDo) == 3:
                     status_bar.heartbeat_message('sharing with %s' % self.str())
-                    regionMatch = REGION_PATTERN.search(toDo[1])
-                    if regionMatch:
-                        self.recvViewPositionUpdate(sublime.Region(int(regionMatch.group(1)), int(regionMatch.group(2))))
-            elif len(toDo) == 3:
-                status_bar.heartbeat_message('sharing with %s' % self.str())
-                # edit event
-                assert toDo[0] == base.EDIT
-                # make the shared selection the ACTUAL selection
-                self.view.sel().clear()
-                for region in self.view.get_regions(self.sharingWithUser):
-                    self.view.sel().add(region)
-                self.view.erase_regions(self.sharingWithUser)
-                self.recvEdit(toDo[1], toDo[2])
-        self.toDoToViewQueueLock.release()
+                    # edit event
+                    assert toDo[0] == base.EDIT
+                    if (toDo[1] == base.EDIT_TYPE_OT) or (toDo[1] == base.EDIT_TYPE_OT_ACK):
+                        self.recvEditOperation(toDo[1], toDo[2])
+                        continue
+                    if toDo[1] == base.EDIT_TYPE_OPS:
+                        ops = editops.decodeOps(toDo[2])
+                        while (len(batch) > 0) and (batch[0][0] == base.EDIT) and (batch[0][1] == base.EDIT_TYPE_OPS):
+                            ops.extend(editops.decodeOps(batch.popleft()[2]))
+                        self.recvEditOps(ops)
+                        continue
+                    # commands run against the selection, outside of the batch view edit
+                    self.endViewEdit()
+                    # make the shared selection the ACTUAL selection
+                    self.view.sel().clear()
+                    for region in self.view.get_regions(self.sharingWithUser):
+                        self.view.sel().add(region)
+                    self.view.erase_regions(self.sharingWithUser)
+                    self.recvEdit(toDo[1], toDo[2])
+        finally:
+            self.endViewEdit()
+            self.stats.recordBatch(started - queuedAt, time.time() - started, len(queued))
 
 
     def checkViewSyncState(self, peerViewSize):
@@ -578,7 +1399,109 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
         """
         if self.view.size() != peerViewSize:
             self.logger.info('view out of sync!')
-            self.sendMessage(base.VIEW_RESYNC)
+            self.requestResync()
+
+
+    def checkConcurrentViewState(self, payload):
+        """
+        Compares the received host hash tree state with the hash tree of the view contents
+        as we last shared them, once both sides have applied the same edits.  Anything
+        else triggers a reshare, which resets the concurrent edits of both sides.
+        """
+        if (self.resyncBasis is not None) or (self.shadowText is None):
+            return
+        hostSent, hostReceived = struct.unpack(self.editCountsFmt, payload[:self.editCountsSize])
+        if self.hasPendingEdits or (self.editState.received != hostSent) or (self.editState.sent != hostReceived):
+            # edits are in flight, the next one will tell
+            return
+        self.viewTree.update(self.shadowText)
+        if self.viewTree.state() != payload[self.editCountsSize:]:
+            self.logger.info('view out of sync!')
+            self.requestResync()
+
+
+    def checkViewTreeState(self, peerTreeState):
+        """
+        Compares the received host hash tree state with the hash tree of this sides' view.
+        Differing contents of the same size are located by descending the host tree
+        with VIEW_TREE_QUERY messages, anything else triggers a resync event.
+        """
+        if (self.resyncBasis is not None) or self.treeQueryPending:
+            return
+        self.viewTree.update(ViewText(self.view))
+        if self.viewTree.state() == peerTreeState:
+            return
+        textLength, leafCount, root = hashtree.decodeState(peerTreeState)
+        if (textLength != self.viewTree.textLength) or (leafCount != self.viewTree.leafCount()):
+            self.logger.info('view out of sync!')
+            self.requestResync()
+            return
+        self.logger.info('view contents out of sync, locating the differences')
+        self.treeQueryPending = True
+        if self.viewTree.height() == 0:
+            self.sendMessage(base.VIEW_RANGE_QUERY, payload=hashtree.encodeLeafIndexes([0]))
+        else:
+            self.sendMessage(base.VIEW_TREE_QUERY, payload=hashtree.encodeNodeIds([(self.viewTree.height(), 0)]))
+
+
+    def compareViewTree(self, payload):
+        """
+        Compares the host child hashes of the nodes we asked for with our own, and
+        asks for the children of those that differ, or the contents of differing leaves.
+        """
+        (textLength, leafCount, root), nodes = hashtree.decodeNodes(payload)
+        self.treeQueryPending = False
+        if self.resyncBasis is not None:
+            return
+        self.viewTree.update(ViewText(self.view))
+        if root == self.viewTree.root():
+            # back in sync since the query was sent
+            return
+        if (textLength != self.viewTree.textLength) or (leafCount != self.viewTree.leafCount()):
+            self.requestResync()
+            return
+        differing = []
+        for (level, index), childHashes in nodes:
+            ours = self.viewTree.children(level, index)
+            for idx in range(len(childHashes)):
+                if (idx >= len(ours)) or (ours[idx] != childHashes[idx]):
+                    differing.append((level - 1, index * hashtree.FANOUT + idx))
+        if len(differing) == 0:
+            return
+        if len(differing) > MAX_TREE_REPAIR_NODES:
+            self.requestResync()
+            return
+        self.treeQueryPending = True
+        if differing[0][0] == 0:
+            self.sendMessage(base.VIEW_RANGE_QUERY, payload=hashtree.encodeLeafIndexes([leaf for level, leaf in differing]))
+        else:
+            self.sendMessage(base.VIEW_TREE_QUERY, payload=hashtree.encodeNodeIds(differing))
+
+
+    def repairViewRanges(self, payload):
+        """
+        Replaces the contents of differing hash tree leaves with the host contents.
+        """
+        (textLength, leafCount, root), leaves = hashtree.decodeLeaves(payload)
+        self.treeQueryPending = False
+        if self.resyncBasis is not None:
+            return
+        text = ViewText(self.view)
+        self.viewTree.update(text)
+        if root == self.viewTree.root():
+            return
+        if (textLength != self.viewTree.textLength) or (leafCount != self.viewTree.leafCount()):
+            self.requestResync()
+            return
+        self.logger.info('Repairing %d blocks of the view' % len(leaves))
+        self.stats.repairs += len(leaves)
+        ops = []
+        # highest leaf first, so that each repair leaves the offsets of the next untouched
+        for leaf, leafText in sorted(leaves, reverse=True):
+            begin, end = self.viewTree.leafRange(leaf)
+            for offset, deleteLength, insertText in editops.diffText(text[begin:end], leafText):
+                ops.append((begin + offset, deleteLength, insertText))
+        self.recvEditOps(ops)
 
 
     def recvd_CONNECTED(self, messageSubType, payload):
@@ -588,17 +1511,252 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
         """
         if self.peerType == base.CLIENT:
             if self.state == base.STATE_CONNECTING:
+                self.setFeatures(self.offeredFeatures() & parseFeatures(payload))
                 self.state = base.STATE_CONNECTED
                 self.logger.info('Connected to peer: %s' % self.sharingWithUser)
+                if self.pendingViewStream is not None:
+                    self.startViewStream()
             else:
                 self.logger.error('Received CONNECTED message from server-peer when in state %s' % self.state)
+        elif self.state == base.STATE_RESUMING:
+            self.logger.warn('Received CONNECTED message while waiting to resume the session with %s' % self.sharingWithUser)
         else:
             ## server/initiator side of the wire...
-            # client is connected, send ACK and set our state to be connected
-            self.sendMessage(base.CONNECTED)
+            # client is connected, send ACK with the features we both support and set our state to be connected
+            self.setFeatures(self.offeredFeatures() & parseFeatures(payload))
+            self.sendMessage(base.CONNECTED, payload=','.join(sorted(self.features)))
             self.state = base.STATE_CONNECTED
             self.logger.info('Connected to peer: %s' % self.sharingWithUser)
             self.notify(collab_event.ESTABLISHED_SESSION, self)
+            if self.pendingViewStream is not None:
+                self.startViewStream()
+
+
+    def connectedFrame(self):
+        """
+        @return: C{str} frame of the CONNECTED message opening the handshake as the partner
+        """
+        return struct.pack(self.messageHeaderFmt, base.MAGIC_NUMBER, base.CONNECTED, base.EDIT_TYPE_NA) \
+            + ','.join(sorted(self.offeredFeatures()))
+
+
+    def offeredFeatures(self):
+        """
+        @return: C{set} of the features this side offers during the CONNECTED handshake
+        """
+        features = set([base.FEATURE_MERKLE, base.FEATURE_PACKED_REGIONS, base.FEATURE_CHANNELS])
+        if COMPRESSION_ENABLED:
+            features.add(base.FEATURE_ZLIB)
+            if COMPRESS_EDITS:
+                features.add(base.FEATURE_ZLIB_EDITS)
+        if CONCURRENT_EDITING:
+            features.add(base.FEATURE_OT)
+        if RESUME_BUFFER_SIZE > 0:
+            features.add(base.FEATURE_RESUME)
+        if PING_INTERVAL > 0:
+            features.add(base.FEATURE_PING)
+        return features
+
+
+    def setFeatures(self, features):
+        """
+        Apply the features agreed on with the peer.
+        """
+        self.features = features
+        self.logger.debug('Session features with %s: %s' % (self.sharingWithUser, ', '.join(sorted(features))))
+        if base.FEATURE_ZLIB_EDITS in features:
+            self.editCompressor = zlib.compressobj(COMPRESSION_LEVEL)
+            self.editDecompressor = zlib.decompressobj()
+        if base.FEATURE_OT in features:
+            self.editState = ot.EditState(self.peerType == base.SERVER)
+        if base.FEATURE_RESUME in features:
+            self.replayBuffer = resume.ReplayBuffer(RESUME_BUFFER_SIZE)
+        if (base.FEATURE_PING in features) and (self.pingTimer is None):
+            self.pingTimer = reactor.callLater(PING_INTERVAL, self.sendPing)
+        if base.FEATURE_CHANNELS in features:
+            if self.peerType == base.CLIENT:
+                self.nextChannelId = 1
+            else:
+                self.nextChannelId = 2
+
+
+    def sendPing(self):
+        """
+        Measure the round trip time of the connection, every PING_INTERVAL seconds
+        for as long as the session lasts.
+        """
+        if self.state == base.STATE_DISCONNECTED:
+            self.pingTimer = None
+            return
+        if self.state == base.STATE_CONNECTED:
+            self.writeMessage(base.PING, payload=struct.pack(self.pingFmt, time.time()))
+        self.pingTimer = reactor.callLater(PING_INTERVAL, self.sendPing)
+
+
+    def getStats(self):
+        """
+        @return: C{dict} of the traffic and timings of the session, see C{sub_collab.peer.stats}
+        """
+        snapshot = self.stats.snapshot()
+        snapshot['role'] = self.role
+        snapshot['state'] = self.state
+        snapshot['features'] = sorted(self.features)
+        snapshot['toDoToViewQueue'] = len(self.toDoToViewQueue)
+        return snapshot
+
+
+    def openChannel(self):
+        """
+        Open a new session with the same peer over the connection of this session,
+        to share another view as the host.
+
+        @return: C{ChannelPeer} of the new session, or None if the peer does not support it
+        """
+        if (self.state != base.STATE_CONNECTED) or (base.FEATURE_CHANNELS not in self.features):
+            return None
+        channelId = self.nextChannelId
+        self.nextChannelId += 2
+        channel = ChannelPeer(self, channelId, base.HOST_ROLE)
+        self.channels[channelId] = channel
+        registry.registerSession(channel)
+        self.logger.info('Opened channel %d with %s' % (channelId, self.sharingWithUser))
+        return channel
+
+
+    def closeChannels(self):
+        """
+        Close all channels of this connection, which is gone.
+        """
+        for channel in self.channels.values():
+            channel.onDisconnect()
+
+
+    def awaitResume(self):
+        """
+        Keep the session around after losing its connection, for the client-peer
+        to reconnect and resume it.  Messages sent in the meantime are only kept
+        for replay.  Must be called from the reactor thread.
+        """
+        if self.state != base.STATE_RESUMING:
+            self.state = base.STATE_RESUMING
+            self.logger.info('Lost connection to %s, waiting to resume the session' % self.sharingWithUser)
+            status_bar.status_message('lost connection to %s, resuming...' % self.str())
+            self.resumeTimer = reactor.callLater(RESUME_TIMEOUT, self.resumeTimedOut)
+        if self.peerType == base.CLIENT:
+            reactor.callLater(RESUME_RETRY_DELAY, self.retryResume)
+
+
+    def retryResume(self):
+        if self.state == base.STATE_RESUMING:
+            self.logger.debug('Reconnecting to peer at %s:%d' % (self.host, self.port))
+            self.connection.connect()
+
+
+    def resumeTimedOut(self):
+        """
+        Give up on resuming the session, the same as if the connection was lost for good.
+        """
+        self.resumeTimer = None
+        if self.state != base.STATE_RESUMING:
+            return
+        self.logger.info('Could not resume the session with %s' % self.sharingWithUser)
+        registry.removeSession(self)
+        self.closeChannels()
+        self.state = base.STATE_DISCONNECTED
+        self.stopCollab()
+        if self.peerType == base.SERVER:
+            self.connection.stopListening()
+        else:
+            self.connection.disconnect()
+        status_bar.status_message('lost share session with %s' % self.str())
+
+
+    def resumeConnection(self, peerReceived, peerOldest):
+        """
+        Resume the session over the new connection, replaying the messages the peer
+        did not receive.  If either side no longer has all the messages the other
+        is missing, nothing is replayed and the sessions of the connection recover
+        by resharing their views instead.  Must be called from the reactor thread.
+
+        @param peerReceived: C{int} number of messages the peer received
+        @param peerOldest: C{int} sequence number of the oldest message the peer can replay
+        """
+        if (self.resumeTimer is not None) and self.resumeTimer.active():
+            self.resumeTimer.cancel()
+        self.resumeTimer = None
+        missing = self.replayBuffer.since(peerReceived)
+        complete = (missing is not None) and (self.replayBuffer.received >= peerOldest)
+        if self.peerType == base.SERVER:
+            self.writeMessage(base.RESUME_ACK, payload=resume.encodeResume(self.replayBuffer.received, self.replayBuffer.oldest()))
+        self.state = base.STATE_CONNECTED
+        if complete:
+            self.logger.info('Resumed session with %s, replaying %d messages' % (self.sharingWithUser, len(missing)))
+            for frame in missing:
+                self.sendString(frame)
+        else:
+            self.logger.info('Resumed session with %s, messages were lost' % self.sharingWithUser)
+        status_bar.status_message('resumed sharing with %s' % self.str())
+        for peer in [self] + self.channels.values():
+            sublime.set_timeout(functools.partial(peer.onResumed, complete), 0)
+
+
+    def onResumed(self, complete):
+        """
+        Callback method informing the peer that the session was resumed over a new connection.
+        Runs on the main UI event loop.
+
+        @param complete: C{bool} False if messages sent by either side were lost with the old connection
+        """
+        if self.view is None:
+            return
+        if self.shadowText is not None:
+            # edits made while reconnecting
+            self.hasPendingEdits = True
+            self.pendingEditSpans = None
+            self.flushEdits()
+        if self.role == base.HOST_ROLE:
+            # a view stream is stopped along with the connection
+            viewStream = self.viewStreamProducer
+            if (not complete) or ((viewStream is not None) and viewStream.done):
+                if viewStream is not None:
+                    self.streamProducers.remove(viewStream)
+                    viewStream.stopProducing()
+                self.viewStreamProducer = None
+                self.heldEdits = None
+                self.resyncCollab()
+        elif not complete:
+            # the host reshares the view, answers to our queries may be lost
+            self.resyncBasis = None
+            self.treeQueryPending = False
+
+
+    def recvd_RESUME(self, messageSubType, payload):
+        if (self.state != base.STATE_RESUMING) or (self.replayBuffer is None):
+            self.logger.warn('Request to resume a session with %s that is %s' % (self.sharingWithUser, self.state))
+            return
+        self.resumeConnection(*resume.decodeResume(payload))
+
+
+    def recvd_RESUME_ACK(self, messageSubType, payload):
+        if (self.state != base.STATE_RESUMING) or (self.replayBuffer is None):
+            return
+        self.resumeConnection(*resume.decodeResume(payload))
+
+
+    def recvd_PING(self, messageSubType, payload):
+        self.writeMessage(base.PONG, payload=payload)
+
+
+    def recvd_PONG(self, messageSubType, payload):
+        sentAt = struct.unpack(self.pingFmt, payload)[0]
+        self.stats.roundTrip.record(time.time() - sentAt)
+
+
+    def resetViewDecompressor(self):
+        if base.FEATURE_ZLIB in self.features:
+            self.viewDecompressor = zlib.decompressobj()
+        else:
+            self.viewDecompressor = None
 
 
     def recvd_DISCONNECT(self, messageSubType=None, payload=''):
@@ -606,19 +1764,18 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
 
 
     def recvd_SHARE_VIEW(self, messageSubType, payload):
-        self.toDoToViewQueueLock.acquire()
-        self.toDoToViewQueue.append((base.SHARE_VIEW, payload))
-        self.toDoToViewQueueLock.release()
+        self.resetViewDecompressor()
         self.sendMessage(base.SHARE_VIEW_ACK)
-        self.handleViewChanges()
+        self.queueViewChange(base.SHARE_VIEW, payload)
 
 
     def recvd_RESHARE_VIEW(self, messageSubType, payload):
-        self.toDoToViewQueueLock.acquire()
-        self.toDoToViewQueue.append((base.RESHARE_VIEW, payload))
-        self.toDoToViewQueueLock.release()
+        self.resetViewDecompressor()
+        # a full resync replaces any delta or hash tree queries we asked for
+        self.resyncBasis = None
+        self.treeQueryPending = False
         self.sendMessage(base.SHARE_VIEW_ACK)
-        self.handleViewChanges()
+        self.queueViewChange(base.RESHARE_VIEW, payload)
 
 
     def recvd_SHARE_VIEW_ACK(self, messageSubType, payload):
@@ -626,30 +1783,34 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
 
 
     def recvd_VIEW_CHUNK(self, messageSubType, payload):
-        self.toDoToViewQueueLock.acquire()
-        self.toDoToViewQueue.append((base.VIEW_CHUNK, payload))
-        self.toDoToViewQueueLock.release()
-        self.sendMessage(base.VIEW_CHUNK_ACK, payload=str(len(payload)))
-        self.handleViewChanges()
+        # acknowledged once inserted into the view, see handleViewChanges(), so a host
+        # streaming the view cannot get further ahead of us than its send window
+        receivedSize = len(payload)
+        if self.viewDecompressor is not None:
+            payload = self.viewDecompressor.decompress(payload)
+        self.queueViewChange(base.VIEW_CHUNK, (payload.decode('utf-8'), receivedSize))
 
 
     def recvd_VIEW_CHUNK_ACK(self, messageSubType, payload):
         ackdChunkSize = int(payload)
         self.ackdChunks.append(ackdChunkSize)
+        if self.viewStreamProducer is not None:
+            self.viewStreamProducer.chunkAcked(ackdChunkSize)
 
 
     def recvd_END_OF_VIEW(self, messageSubType, payload):
-        self.toDoToViewQueueLock.acquire()
-        self.toDoToViewQueue.append((base.END_OF_VIEW, payload))
-        self.toDoToViewQueueLock.release()
-        self.sendMessage(base.END_OF_VIEW_ACK)
-        self.handleViewChanges()
+        self.viewDecompressor = None
+        # acknowledged once the view is applied, see handleViewChanges()
+        self.queueViewChange(base.END_OF_VIEW, payload)
 
 
     def recvd_END_OF_VIEW_ACK(self, messageSubType, payload):
         if self.toAck == self.ackdChunks:
             self.toAck = None
             self.ackdChunks = None
+            self.sendHeldEdits()
+            if base.FEATURE_OT in self.features:
+                self.queueViewChange(base.END_OF_VIEW_ACK, payload)
         else:
             self.logger.error('Sent %s chunks of data to peer but peer received %s chunks of data' % (self.toAck, self.ackdChunks))
             self.toAck = None
@@ -660,24 +1821,28 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
 
     def recvd_SELECTION(self, messageSubType, payload):
         # self.logger.debug('selection change: %s' % payload)
-        self.toDoToViewQueueLock.acquire()
-        self.toDoToViewQueue.append((base.SELECTION, payload))
-        self.toDoToViewQueueLock.release()
-        self.handleViewChanges()
+        # decoded right away, the next packed selection may be a difference to this one
+        if base.FEATURE_PACKED_REGIONS in self.features:
+            selection = regions.decodeSelection(payload, self.lastRecvdSelection)
+        else:
+            selection = [(int(regionMatch.group(1)), int(regionMatch.group(2))) for regionMatch in REGION_PATTERN.finditer(payload)]
+        self.lastRecvdSelection = selection
+        self.queueViewChange(base.SELECTION, selection)
 
 
     def recvd_POSITION(self, messageSubType, payload):
-        self.toDoToViewQueueLock.acquire()
-        self.toDoToViewQueue.append((base.POSITION, payload))
-        self.toDoToViewQueueLock.release()
-        self.handleViewChanges()
+        if base.FEATURE_PACKED_REGIONS in self.features:
+            self.queueViewChange(base.POSITION, regions.decodeRegions(payload)[0])
+        else:
+            regionMatch = REGION_PATTERN.search(payload)
+            if regionMatch:
+                self.queueViewChange(base.POSITION, (int(regionMatch.group(1)), int(regionMatch.group(2))))
 
 
     def recvd_EDIT(self, messageSubType, payload):
-        self.toDoToViewQueueLock.acquire()
-        self.toDoToViewQueue.append((base.EDIT, messageSubType, payload))
-        self.toDoToViewQueueLock.release()
-        self.handleViewChanges()
+        if self.editDecompressor is not None:
+            payload = self.editDecompressor.decompress(payload)
+        self.queueViewChange(base.EDIT, messageSubType, payload)
 
 
     def recvd_SWAP_ROLE(self, messageSubType, payload):
@@ -693,15 +1858,76 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
 
 
     def recvd_VIEW_SYNC(self, messageSubType, payload):
-        self.toDoToViewQueueLock.acquire()
-        # no pending edits... safe to check
-        if len(self.toDoToViewQueue) == 0:
-            self.checkViewSyncState(int(payload))
-        self.toDoToViewQueueLock.release()
+        # checked once everything queued before it has been applied
+        self.queueViewChange(base.VIEW_SYNC, payload)
 
 
     def recvd_VIEW_RESYNC(self, messageSubType, payload):
-        self.resyncCollab()
+        if self.heldEdits is not None:
+            # sent before the partner saw the view being resent, which replaces the request
+            return
+        if (len(payload) > 0) and (self.shadowText is not None):
+            self.resyncDeltaCollab(payload)
+        else:
+            self.resyncCollab()
+
+
+    def recvd_VIEW_DELTA(self, messageSubType, payload):
+        if base.FEATURE_ZLIB in self.features:
+            payload = zlib.decompress(payload)
+        self.queueViewChange(base.VIEW_DELTA, payload)
+
+
+    def recvd_VIEW_TREE_QUERY(self, messageSubType, payload):
+        if self.shadowText is None:
+            return
+        if self.heldEdits is not None:
+            # as with VIEW_RESYNC, the view being resent replaces the query
+            return
+        # answer for the view contents as the partner will have them
+        self.flushEdits()
+        self.viewTree.update(self.shadowText)
+        self.sendMessage(base.VIEW_TREE_NODES, payload=hashtree.encodeNodes(self.viewTree, hashtree.decodeNodeIds(payload)))
+
+
+    def recvd_VIEW_TREE_NODES(self, messageSubType, payload):
+        self.queueViewChange(base.VIEW_TREE_NODES, payload)
+
+
+    def recvd_VIEW_RANGE_QUERY(self, messageSubType, payload):
+        if self.shadowText is None:
+            return
+        if self.heldEdits is not None:
+            return
+        self.flushEdits()
+        self.viewTree.update(self.shadowText)
+        payload = hashtree.encodeLeaves(self.viewTree, self.shadowText, hashtree.decodeLeafIndexes(payload))
+        if base.FEATURE_ZLIB in self.features:
+            payload = zlib.compress(payload, COMPRESSION_LEVEL)
+        self.sendMessage(base.VIEW_RANGE, payload=payload)
+
+
+    def recvd_VIEW_RANGE(self, messageSubType, payload):
+        if base.FEATURE_ZLIB in self.features:
+            payload = zlib.decompress(payload)
+        self.queueViewChange(base.VIEW_RANGE, payload)
+
+
+    def recvd_CHANNEL(self, messageSubType, payload):
+        channelId = struct.unpack(self.channelIdFmt, payload[:self.channelIdSize])[0]
+        data = payload[self.channelIdSize:]
+        channel = self.channels.get(channelId)
+        if channel is None:
+            magicNumber, msgTypeNum, msgSubTypeNum = struct.unpack(self.messageHeaderFmt, data[:self.messageHeaderSize])
+            if msgTypeNum != base.SHARE_VIEW:
+                # left over from a channel we already closed
+                return
+            # the peer shares another view with us
+            channel = ChannelPeer(self, channelId, base.PARTNER_ROLE)
+            self.channels[channelId] = channel
+            registry.registerSession(channel)
+            self.logger.info('Channel %d opened by %s' % (channelId, self.sharingWithUser))
+        channel.stringReceived(data)
 
 
     def recvdUnknown(self, messageType, messageSubType, payload):
@@ -709,11 +1935,21 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
 
 
     def stringReceived(self, data):
+        if self.recorder is not None:
+            self.recorder.record(recorder.INCOMING, data)
         magicNumber, msgTypeNum, msgSubTypeNum = struct.unpack(self.messageHeaderFmt, data[:self.messageHeaderSize])
-        assert magicNumber == base.MAGIC_NUMBER
+        if magicNumber == resume.SEQUENCED_MAGIC_NUMBER:
+            sequence = struct.unpack(resume.SEQUENCED_HEADER_FMT, data[:resume.SEQUENCED_HEADER_SIZE])[3]
+            if not self.replayBuffer.accept(sequence):
+                # replayed, but we already had it
+                return
+            payload = data[resume.SEQUENCED_HEADER_SIZE:]
+        else:
+            assert magicNumber == base.MAGIC_NUMBER
+            payload = data[self.messageHeaderSize:]
+        self.stats.countReceived(msgTypeNum, self.messageHeaderSize + len(payload))
         msgType = base.numeric_to_symbolic[msgTypeNum]
         msgSubType = base.numeric_to_symbolic[msgSubTypeNum]
-        payload = data[self.messageHeaderSize:]
         self.logger.debug('RECVD: %s-%s[%s]' % (msgType, msgSubType, payload))
         method = getattr(self, "recvd_%s" % msgType, None)
         if method is not None:
@@ -723,10 +1959,22 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
 
 
     def connectionLost(self, reason):
+        if self.abandonedTransports > 0:
+            # a connection replaced by a newer one, see buildProtocol()
+            self.abandonedTransports -= 1
+            return
+        if (self.replayBuffer is not None) and (self.state in (base.STATE_CONNECTED, base.STATE_RESUMING)):
+            # lost without either side disconnecting
+            if self.peerType == base.SERVER:
+                self.awaitResume()
+            # clientConnectionLost() below reconnects on the client side
+            return
         registry.removeSession(self)
+        self.closeChannels()
         if self.peerType == base.CLIENT:
             # ignore this, clientConnectionLost() below will also be called
             return
+        self.stopRecording()
         self.state = base.STATE_DISCONNECTED
         if error.ConnectionDone == reason.type:
             self.disconnect()
@@ -739,10 +1987,11 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
     #*** internet.base.BaseProtocol (via basic.Int32StringReceiver) method implementations ***#
 
     def connectionMade(self):
-        if self.peerType == base.CLIENT:
-            pass
-        else:
-            pass
+        # a partial message of a lost connection is not continued by the next one
+        self._unprocessed = ''
+        self.transport.registerProducer(self.streamProducers, True)
+        if (RECORD_DIR is not None) and (self.recorder is None):
+            self.startRecording()
 
     #*** protocol.Factory method implementations ***#
 
@@ -750,14 +1999,29 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
         self.logger.debug('building protocol for %s' % self.peerType)
         if self.peerType == base.CLIENT:
             self.logger.debug('Connected to peer at %s:%d' % (self.host, self.port))
-            self.sendMessage(base.CONNECTED)
+            if self.state == base.STATE_RESUMING:
+                self.sendMessage(base.RESUME, payload=resume.encodeResume(self.replayBuffer.received, self.replayBuffer.oldest()))
+                return self
+            if self.relayRoom is not None:
+                self.sendMessage(base.RELAY_JOIN, payload='%s|%s' % (self.role, self.relayRoom))
+            self.sendMessage(base.CONNECTED, payload=','.join(sorted(self.offeredFeatures())))
+        elif (self.state == base.STATE_CONNECTED) and (self.replayBuffer is not None):
+            # the client-peer reconnected before we noticed the connection was lost
+            self.abandonedTransports += 1
+            self.transport.abortConnection()
+            self.awaitResume()
         return self
 
 
     #*** protocol.ClientFactory method implementations ***#
 
     def clientConnectionLost(self, connector, reason):
+        if (self.replayBuffer is not None) and (self.state in (base.STATE_CONNECTED, base.STATE_RESUMING)):
+            self.awaitResume()
+            return
         registry.removeSession(self)
+        self.closeChannels()
+        self.stopRecording()
         self.state = base.STATE_DISCONNECTED
         if error.ConnectionDone == reason.type:
             self.disconnect()
@@ -768,17 +2032,168 @@ class BasicPeer(base.BasePeer, basic.Int32StringReceiver, protocol.ClientFactory
 
 
     def clientConnectionFailed(self, connector, reason):
+        if self.state == base.STATE_RESUMING:
+            # try again until resumeTimedOut()
+            reactor.callLater(RESUME_RETRY_DELAY, self.retryResume)
+            return
         self.logger.error('Connection failed: %s - %s' % (reason.type, reason.value))
         registry.removeSession(self)
         self.state = base.STATE_DISCONNECTED
-        if (error.ConnectionRefusedError == reason.type) or (error.TCPTimedOutError == reason.type) or (error.TimeoutError == reason.type):
-            if self.peerType == base.CLIENT:
-                self.notify(collab_event.FAILED_SESSION, self.sharingWithUser)
+        if self.peerType == base.CLIENT:
+            if (self.relayRoom is None) and registry.hasNegotiator(self.getParentNegotiatorKey()):
+                # the host waits for us until told otherwise or the offer times out
+                registry.getNegotiator(self.getParentNegotiatorKey()).failedSessionRequest(self.sharingWithUser, self.sessionNonce)
+            self.notify(collab_event.FAILED_SESSION, self.sharingWithUser)
         self.disconnect()
 
 
     #*** helper functions ***#
 
+    def startRecording(self):
+        """
+        Record the messages of this connection, and of any connection it is resumed over, to RECORD_DIR.
+        """
+        recordDir = os.path.expanduser(RECORD_DIR)
+        fileName = '%s-%s-%s.screc' % (re.sub(r'[^\w.-]', '_', self.sharingWithUser), time.strftime('%Y%m%d-%H%M%S'), self.peerType)
+        try:
+            if not os.path.isdir(recordDir):
+                os.makedirs(recordDir)
+            self.recorder = recorder.SessionRecorder(os.path.join(recordDir, fileName), self.describeRecording, \
+                RECORD_MAX_BYTES, RECORD_MAX_FILES)
+            self.logger.info('Recording session with %s to %s' % (self.sharingWithUser, self.recorder.path))
+        except (IOError, OSError), e:
+            self.logger.error('Failed to start recording session with %s: %s' % (self.sharingWithUser, e))
+
+
+    def describeRecording(self):
+        """
+        @return: C{dict} describing the session at the start of a recording file
+        """
+        return {
+            'peer': self.sharingWithUser,
+            'peerType': self.peerType,
+            'role': self.role,
+            'state': self.state,
+            'features': sorted(self.features),
+            'time': time.time()
+        }
+
+
+    def stopRecording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+
+    def sendString(self, string):
+        if self.recorder is not None:
+            self.recorder.record(recorder.OUTGOING, string)
+        basic.Int32StringReceiver.sendString(self, string)
+
+
     def sendMessage(self, messageType, messageSubType=base.EDIT_TYPE_NA, payload=''):
+        reactor.callFromThread(self.writeMessage, messageType, messageSubType, payload)
+
+
+    def writeMessage(self, messageType, messageSubType=base.EDIT_TYPE_NA, payload=''):
+        """
+        Write a message to the transport right away, must be called from the reactor thread.
+        """
         self.logger.debug('SEND: %s-%s[bytes: %d]' % (base.numeric_to_symbolic[messageType], base.numeric_to_symbolic[messageSubType], len(payload)))
-        reactor.callFromThread(self.sendString, struct.pack(self.messageHeaderFmt, base.MAGIC_NUMBER, messageType, messageSubType) + payload.encode())
+        if isinstance(payload, unicode):
+            payload = payload.encode('utf-8')
+        if (messageType == base.EDIT) and (self.editCompressor is not None):
+            payload = self.editCompressor.compress(payload) + self.editCompressor.flush(zlib.Z_SYNC_FLUSH)
+        self.writeFrame(struct.pack(self.messageHeaderFmt, base.MAGIC_NUMBER, messageType, messageSubType) + payload)
+
+
+    def writeFrame(self, frame):
+        self.stats.countSent(ord(frame[2]), len(frame))
+        if (self.replayBuffer is not None) and (ord(frame[2]) not in UNSEQUENCED_MESSAGES):
+            frame = self.replayBuffer.record(frame)
+            if self.state == base.STATE_RESUMING:
+                # replayed once the session is resumed
+                return
+        self.sendString(frame)
+
+
+class ChannelPeer(BasicPeer):
+    """
+    Session with the same peer as a parent session, multiplexed over its connection.
+    All messages of the channel are carried in CHANNEL messages of the parent session,
+    so sharing another view only costs the SHARE_VIEW.
+    """
+    logger = logging.getLogger('SubliminalCollaborator.ChannelPeer')
+
+
+    def __init__(self, parentPeer, channelId, role):
+        """
+        @param parentPeer: C{BasicPeer} owning the connection
+        @param channelId: C{int} channel id
+        @param role: C{str} HOST_ROLE if we opened the channel, PARTNER_ROLE if the peer did
+        """
+        BasicPeer.__init__(self, parentPeer.sharingWithUser, registry.getNegotiator(parentPeer.getParentNegotiatorKey()))
+        self.addAllObservers(parentPeer.observers)
+        self.parentPeer = parentPeer
+        self.channelId = channelId
+        self.role = role
+        # the partner side of a session is treated as its client
+        if role == base.HOST_ROLE:
+            self.peerType = base.SERVER
+        else:
+            self.peerType = base.CLIENT
+        self.transport = parentPeer.transport
+        self.streamProducers = parentPeer.streamProducers
+        self.state = base.STATE_CONNECTED
+        self.setFeatures(parentPeer.features - set([base.FEATURE_CHANNELS, base.FEATURE_RESUME, base.FEATURE_PING]))
+
+
+    def str(self):
+        return '%s#%d' % (self.sharingWithUser, self.channelId)
+
+
+    def disconnect(self):
+        """
+        Close the channel, leaving the connection of the parent session open.
+        """
+        if self.state == base.STATE_DISCONNECTED:
+            return
+        if self.role == base.HOST_ROLE:
+            self.flushEdits()
+        self.stopCollab()
+        self.sendMessage(base.DISCONNECT)
+        self.closeChannel()
+
+
+    def onDisconnect(self):
+        """
+        Callback method if the peer closed the channel, or the connection is gone.
+        """
+        if self.state == base.STATE_DISCONNECTED:
+            return
+        self.stopCollab()
+        self.closeChannel()
+        status_bar.status_message('Stopped sharing with %s' % self.str())
+
+
+    def closeChannel(self):
+        self.state = base.STATE_DISCONNECTED
+        self.viewMonitorThread.destroy()
+        self.parentPeer.channels.pop(self.channelId, None)
+        registry.removeSession(self)
+        self.logger.info('Closed channel %d with %s' % (self.channelId, self.sharingWithUser))
+
+
+    def getStats(self):
+        """
+        @return: C{dict} of the traffic and timings of the channel, with the round trip time of its connection
+        """
+        snapshot = BasicPeer.getStats(self)
+        snapshot['roundTrip'] = self.parentPeer.stats.roundTrip.snapshot()
+        return snapshot
+
+
+    def writeFrame(self, frame):
+        self.stats.countSent(ord(frame[2]), len(frame))
+        self.parentPeer.writeFrame(struct.pack(self.messageHeaderFmt, base.MAGIC_NUMBER, base.CHANNEL, base.EDIT_TYPE_NA) \
+            + struct.pack(self.channelIdFmt, self.channelId) + frame)
@@ -0,0 +1,363 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+from sub_collab.peer import base, basic, recorder, regions, shadow, stream
+from twisted.internet import reactor
+from sub_collab import registry, status_bar
+import sublime
+import logging, struct, os
+
+
+# in bytes, most broadcast data a watcher may fall behind by before it is sent a new snapshot instead
+MAX_WATCHER_BACKLOG = 1048576
+
+# watchers need to share the encoding state of the frames they are all sent
+REQUIRED_FEATURES = frozenset([base.FEATURE_MERKLE, base.FEATURE_PACKED_REGIONS])
+# features specific to a single connection, not offered to watchers
+WATCHER_EXCLUDED_FEATURES = frozenset([base.FEATURE_ZLIB_EDITS, base.FEATURE_CHANNELS, base.FEATURE_OT, base.FEATURE_RESUME, base.FEATURE_PING])
+
+
+def configure(settings):
+    """
+    Apply the "session" section of the Accounts.sublime-settings configuration.
+
+    @param settings: C{dict} of session settings
+    """
+    global MAX_WATCHER_BACKLOG
+    MAX_WATCHER_BACKLOG = int(settings.get('broadcast_max_backlog', MAX_WATCHER_BACKLOG))
+
+
+class BroadcastWatcher(basic.BasicPeer):
+    """
+    Host side of the connection to a single watcher of a broadcast.  The watcher
+    end is an ordinary partner-side C{BasicPeer}.
+
+    Frames sent to all watchers are encoded once by the C{BroadcastPeer} and handed
+    to each watcher as the same length-prefixed C{str}, see C{stream.FollowerStream}.
+    A watcher falling behind by more than MAX_WATCHER_BACKLOG is dropped from the
+    broadcast and rejoins with a new snapshot of the view, followed by the frames
+    broadcast since.
+    """
+    logger = logging.getLogger('SubliminalCollaborator.BroadcastWatcher')
+
+
+    def __init__(self, broadcast):
+        basic.BasicPeer.__init__(self, 'watcher', registry.getNegotiator(broadcast.getParentNegotiatorKey()))
+        # watchers are not sessions of their own, nobody needs to hear about them
+        self.observers = set()
+        self.broadcast = broadcast
+        self.peerType = base.SERVER
+        self.role = base.HOST_ROLE
+        self.state = base.STATE_CONNECTING
+        self.view = broadcast.view
+        # backlog, held back frames and snapshot state of the broadcast frames sent to this watcher
+        self.follower = stream.FollowerStream(self, MAX_WATCHER_BACKLOG)
+
+
+    def str(self):
+        return '%s@%s' % (self.sharingWithUser, self.broadcast.str())
+
+
+    def connectionMade(self):
+        self.sharingWithUser = self.transport.getPeer().host
+        basic.BasicPeer.connectionMade(self)
+        self.streamProducers.add(stream.BacklogProducer(self.follower))
+
+
+    def connectionLost(self, reason):
+        self.state = base.STATE_DISCONNECTED
+        self.follower.reset()
+        self.endViewStream()
+        self.stopRecording()
+        self.broadcast.removeWatcher(self)
+        self.logger.info('Watcher %s left the broadcast' % self.str())
+
+
+    def disconnect(self):
+        if self.state in (base.STATE_DISCONNECTING, base.STATE_DISCONNECTED):
+            return
+        self.state = base.STATE_DISCONNECTING
+        self.sendMessage(base.DISCONNECT)
+        reactor.callFromThread(self.transport.loseConnection)
+
+
+    def onDisconnect(self):
+        self.disconnect()
+
+
+    def offeredFeatures(self):
+        return basic.BasicPeer.offeredFeatures(self) - WATCHER_EXCLUDED_FEATURES
+
+
+    def recvd_CONNECTED(self, messageSubType, payload):
+        self.setFeatures(self.offeredFeatures() & basic.parseFeatures(payload))
+        self.sendMessage(base.CONNECTED, payload=','.join(sorted(self.features)))
+        if not REQUIRED_FEATURES.issubset(self.features):
+            self.logger.warn('Watcher %s does not support broadcasts' % self.str())
+            self.disconnect()
+            return
+        self.state = base.STATE_CONNECTED
+        self.logger.info('Watcher %s joined the broadcast' % self.str())
+        self.broadcast.addWatcher(self)
+
+
+    #*** broadcast frame handling ***#
+
+    def broadcastFrame(self, data):
+        """
+        Send a frame encoded once for all watchers.
+
+        @param data: C{str} length-prefixed frame
+        """
+        self.follower.sendFrame(data)
+
+
+    def writeFrame(self, frame):
+        self.stats.countSent(ord(frame[2]), len(frame))
+        self.writeData(struct.pack(self.structFormat, len(frame)) + frame)
+
+
+    def writeData(self, data):
+        """
+        Write length-prefixed data to the transport, or to the backlog if the
+        transport is full or there is a backlog already.
+        """
+        if self.state == base.STATE_DISCONNECTED:
+            return
+        if self.recorder is not None:
+            self.recorder.record(recorder.OUTGOING, data[self.prefixLength:])
+        self.follower.write(data)
+
+
+    def requestSnapshot(self):
+        self.broadcast.sendSnapshot(self, base.RESHARE_VIEW)
+
+
+    def beginSnapshot(self, messageType, snapshot, selection):
+        """
+        Start sending a snapshot of the view, broadcast frames are held back from
+        here on until the watcher acknowledges it.
+
+        @param messageType: C{int} SHARE_VIEW or RESHARE_VIEW
+        @param snapshot: C{shadow.ShadowText} view contents the following broadcast frames apply to
+        @param selection: C{list} of (a, b) tuples the following selection updates are a difference to, or None
+        """
+        if self.state != base.STATE_CONNECTED:
+            self.follower.snapshotPending = False
+            return
+        frames = []
+        if selection is not None:
+            frame = struct.pack(self.messageHeaderFmt, base.MAGIC_NUMBER, base.SELECTION, base.EDIT_TYPE_NA) \
+                + regions.encodeSelection(selection, None)
+            frames.append(struct.pack(self.structFormat, len(frame)) + frame)
+        if not self.follower.beginSnapshot(frames):
+            return
+        if messageType == base.SHARE_VIEW:
+            payload = '%s|%d' % (self.broadcast.viewName(), len(snapshot))
+        else:
+            payload = str(len(snapshot))
+        self.pendingViewStream = (messageType, payload, self.endViewStream, snapshot)
+        self.startViewStream()
+
+
+    def sendHeldEdits(self):
+        self.follower.endSnapshot()
+
+
+    #*** partner requests, answered from the broadcast view ***#
+
+    def recvd_VIEW_RESYNC(self, messageSubType, payload):
+        self.answerQuery(base.VIEW_RESYNC, payload)
+
+
+    def recvd_VIEW_TREE_QUERY(self, messageSubType, payload):
+        self.answerQuery(base.VIEW_TREE_QUERY, payload)
+
+
+    def recvd_VIEW_RANGE_QUERY(self, messageSubType, payload):
+        self.answerQuery(base.VIEW_RANGE_QUERY, payload)
+
+
+    def answerQuery(self, messageType, payload):
+        compressionLevel = None
+        if base.FEATURE_ZLIB in self.features:
+            compressionLevel = basic.COMPRESSION_LEVEL
+        reply = self.follower.answerQuery(messageType, payload, self.broadcast, compressionLevel, self.MAX_LENGTH - self.messageHeaderSize)
+        if reply is not None:
+            # queued behind the edits flushed for the answer
+            self.sendMessage(reply[0], payload=reply[1])
+
+
+    def recvd_SWAP_ROLE(self, messageSubType, payload):
+        self.sendMessage(base.SWAP_ROLE_NACK)
+
+
+    # watchers only watch
+    def recvd_EDIT(self, messageSubType, payload):
+        pass
+
+
+    def recvd_SELECTION(self, messageSubType, payload):
+        pass
+
+
+    def recvd_POSITION(self, messageSubType, payload):
+        pass
+
+
+class BroadcastPeer(basic.BasicPeer):
+    """
+    Session sharing a single host view with any number of watchers, each
+    connected to the port this session listens on.
+
+    Edits, selections, view positions and sync states are encoded once and the
+    same frame is written to every watcher, see C{BroadcastWatcher}.
+    """
+    logger = logging.getLogger('SubliminalCollaborator.BroadcastPeer')
+
+
+    def __init__(self, parentNegotiator):
+        basic.BasicPeer.__init__(self, 'broadcast', parentNegotiator)
+        self.watchers = set()
+
+
+    def str(self):
+        return 'broadcast to %d watchers' % len(self.watchers)
+
+
+    def viewName(self):
+        viewName = self.view.file_name()
+        if viewName is None:
+            return 'NONAME'
+        return os.path.basename(viewName)
+
+
+    def hostConnect(self, port=0, ipaddress=''):
+        """
+        Listen for watchers on the given port.
+
+        @param port: C{int} port number to listen on, defaults to 0 (system will pick one)
+
+        @return: the listening port number
+        """
+        self.peerType = base.SERVER
+        self.role = base.HOST_ROLE
+        self.state = base.STATE_CONNECTING
+        self.setFeatures(set(REQUIRED_FEATURES))
+        self.connection = reactor.listenTCP(port, self, interface=ipaddress)
+        self.port = self.connection.getHost().port
+        self.logger.info('Listening for watchers at %s:%d' % (ipaddress, self.port))
+        return self.port
+
+
+    def buildProtocol(self, addr):
+        return BroadcastWatcher(self)
+
+
+    def startCollab(self, view):
+        """
+        Start broadcasting the given C{sublime.View}, watchers are each sent a
+        snapshot of it as they join.
+        """
+        self.view = view
+        self.shadowText = shadow.ShadowText(self.view.substr(sublime.Region(0, self.view.size())))
+        self.viewTree.invalidate()
+        self.state = base.STATE_CONNECTED
+        self.logger.info('Broadcasting view %s' % self.viewName())
+        for watcher in self.watchers:
+            watcher.view = view
+            self.sendSnapshot(watcher, base.SHARE_VIEW)
+        self.viewMonitorThread.start()
+
+
+    def resyncCollab(self):
+        for watcher in self.watchers:
+            self.sendSnapshot(watcher, base.RESHARE_VIEW)
+
+
+    def swapRole(self):
+        self.logger.warn('Broadcasts cannot swap roles')
+
+
+    def disconnect(self):
+        if self.state == base.STATE_DISCONNECTED:
+            return
+        if self.state == base.STATE_CONNECTED:
+            self.flushEdits()
+        self.state = base.STATE_DISCONNECTED
+        self.viewMonitorThread.destroy()
+        for watcher in list(self.watchers):
+            watcher.disconnect()
+        reactor.callFromThread(self.connection.stopListening)
+        registry.removeSession(self)
+        status_bar.status_message('stopped broadcasting %s' % self.viewName())
+
+
+    def onDisconnect(self):
+        self.disconnect()
+
+
+    def addWatcher(self, watcher):
+        self.watchers.add(watcher)
+        if self.view is not None:
+            watcher.view = self.view
+            self.sendSnapshot(watcher, base.SHARE_VIEW)
+        status_bar.status_message('%s is watching' % watcher.sharingWithUser)
+
+
+    def removeWatcher(self, watcher):
+        self.watchers.discard(watcher)
+
+
+    def sendSnapshot(self, watcher, messageType):
+        """
+        Send a watcher the view contents as of now, it receives the broadcast frames
+        from here on once it has them.
+        """
+        if watcher.follower.snapshotPending:
+            return
+        watcher.follower.snapshotPending = True
+        snapshot = self.currentText().snapshot()
+        # after the frames already queued for writing, the last of which the snapshot includes
+        reactor.callFromThread(watcher.beginSnapshot, messageType, snapshot, self.lastSentSelection)
+
+
+    def currentText(self):
+        """
+        @return: C{shadow.ShadowText} view contents as the watchers will have them after the frames sent so far
+        """
+        self.flushEdits()
+        return self.shadowText
+
+
+    def currentTree(self):
+        """
+        @return: C{hashtree.HashTree} of the view contents as the watchers will have them
+        """
+        self.viewTree.update(self.currentText())
+        return self.viewTree
+
+
+    def writeFrame(self, frame):
+        self.stats.countSent(ord(frame[2]), len(frame))
+        data = struct.pack(self.structFormat, len(frame)) + frame
+        for watcher in list(self.watchers):
+            watcher.broadcastFrame(data)
@@ -0,0 +1,212 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+import hashlib, math, operator, struct
+
+# rsync-style delta transfer of view contents.
+#
+# The partner describes its copy of the view with a signature: a weak rolling
+# checksum and a strong hash for each fixed-size block of characters.  The host
+# scans its own copy with the rolling checksum and describes it as a list of
+# instructions, either copying a run of the partner's blocks or inserting literal text.
+
+# in characters
+MIN_BLOCK_SIZE = 256
+MAX_BLOCK_SIZE = 16384
+
+SIGNATURE_HEADER_FMT = '!II'
+SIGNATURE_HEADER_SIZE = struct.calcsize(SIGNATURE_HEADER_FMT)
+# weak checksum and truncated strong hash of one block
+BLOCK_SIGNATURE_FMT = '!I8s'
+BLOCK_SIGNATURE_SIZE = struct.calcsize(BLOCK_SIGNATURE_FMT)
+
+# instruction tags
+COPY = 'C'
+LITERAL = 'L'
+COPY_FMT = '!cII'
+COPY_SIZE = struct.calcsize(COPY_FMT)
+LITERAL_FMT = '!cI'
+LITERAL_SIZE = struct.calcsize(LITERAL_FMT)
+
+
+def blockSizeFor(length):
+    """
+    Pick a block size for a text of the given length, balancing the size of the
+    signature against the size of the literal text sent for a changed block.
+    """
+    return int(max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, 4 * math.sqrt(length))))
+
+
+def weakChecksum(block):
+    """
+    @return: C{tuple} of the two running sums of the rolling checksum of a block
+    """
+    values = map(ord, block)
+    return sum(values), sum(map(operator.mul, values, range(len(values), 0, -1)))
+
+
+def weakDigest(a, b):
+    return (a & 0xffff) | ((b & 0xffff) << 16)
+
+
+def strongDigest(block):
+    return hashlib.md5(block.encode('utf-8')).digest()[:8]
+
+
+def signature(text, blockSize):
+    """
+    @return: C{list} of (weak, strong) checksums of each block of the text
+    """
+    sigs = []
+    for begin in range(0, len(text), blockSize):
+        block = text[begin:begin + blockSize]
+        sigs.append((weakDigest(*weakChecksum(block)), strongDigest(block)))
+    return sigs
+
+
+def encodeSignature(textLength, blockSize, sigs):
+    packed = [struct.pack(SIGNATURE_HEADER_FMT, textLength, blockSize)]
+    for weak, strong in sigs:
+        packed.append(struct.pack(BLOCK_SIGNATURE_FMT, weak, strong))
+    return ''.join(packed)
+
+
+def decodeSignature(data):
+    """
+    @return: C{tuple} of the signed text length, the block size and the C{list} of block checksums
+    """
+    textLength, blockSize = struct.unpack(SIGNATURE_HEADER_FMT, data[:SIGNATURE_HEADER_SIZE])
+    sigs = []
+    for pos in range(SIGNATURE_HEADER_SIZE, len(data), BLOCK_SIGNATURE_SIZE):
+        sigs.append(struct.unpack(BLOCK_SIGNATURE_FMT, data[pos:pos + BLOCK_SIGNATURE_SIZE]))
+    return textLength, blockSize, sigs
+
+
+def computeDelta(text, textLength, blockSize, sigs):
+    """
+    Describe text in terms of the blocks of another text with the given signature.
+
+    @param textLength: C{int} length of the signed text, which may end in a short block
+    @return: C{list} of (COPY, firstBlock, blockCount) and (LITERAL, text) instructions
+    """
+    # only full blocks can match while scanning, a short last block can only match at the very end
+    fullBlocks = textLength // blockSize
+    blocksByWeak = {}
+    for idx in range(fullBlocks):
+        blocksByWeak.setdefault(sigs[idx][0], []).append(idx)
+    delta = []
+    length = len(text)
+    pos = 0
+    literalStart = 0
+    expected = 0
+    a = b = None
+    while pos + blockSize <= length:
+        match = None
+        if a is None:
+            # aligned with the previous match, blocks usually follow each other
+            if (expected < fullBlocks) and (strongDigest(text[pos:pos + blockSize]) == sigs[expected][1]):
+                match = expected
+            else:
+                a, b = weakChecksum(text[pos:pos + blockSize])
+        candidates = None
+        if match is None:
+            candidates = blocksByWeak.get(weakDigest(a, b))
+        if candidates:
+            strong = strongDigest(text[pos:pos + blockSize])
+            for idx in candidates:
+                if sigs[idx][1] == strong:
+                    match = idx
+                    break
+        if match is not None:
+            _addLiteral(delta, text[literalStart:pos])
+            _addCopy(delta, match)
+            pos += blockSize
+            literalStart = pos
+            expected = match + 1
+            a = None
+        else:
+            if pos + blockSize < length:
+                # roll the checksum one character forward
+                out = ord(text[pos])
+                a = a - out + ord(text[pos + blockSize])
+                b = b - blockSize * out + a
+            pos += 1
+    tail = text[literalStart:]
+    lastBlockSize = textLength - fullBlocks * blockSize
+    if (lastBlockSize > 0) and (len(tail) >= lastBlockSize) and \
+            (strongDigest(tail[-lastBlockSize:]) == sigs[fullBlocks][1]):
+        _addLiteral(delta, tail[:-lastBlockSize])
+        _addCopy(delta, fullBlocks)
+    else:
+        _addLiteral(delta, tail)
+    return delta
+
+
+def _addLiteral(delta, literal):
+    if len(literal) > 0:
+        delta.append((LITERAL, literal))
+
+
+def _addCopy(delta, idx):
+    if (len(delta) > 0) and (delta[-1][0] == COPY) and (delta[-1][1] + delta[-1][2] == idx):
+        delta[-1] = (COPY, delta[-1][1], delta[-1][2] + 1)
+    else:
+        delta.append((COPY, idx, 1))
+
+
+def encodeDelta(delta):
+    packed = []
+    for instruction in delta:
+        if instruction[0] == COPY:
+            packed.append(struct.pack(COPY_FMT, COPY, instruction[1], instruction[2]))
+        else:
+            encoded = instruction[1].encode('utf-8')
+            packed.append(struct.pack(LITERAL_FMT, LITERAL, len(encoded)))
+            packed.append(encoded)
+    return ''.join(packed)
+
+
+def decodeDelta(data):
+    delta = []
+    pos = 0
+    while pos < len(data):
+        if data[pos] == COPY:
+            delta.append(struct.unpack(COPY_FMT, data[pos:pos + COPY_SIZE]))
+            pos += COPY_SIZE
+        else:
+            tag, size = struct.unpack(LITERAL_FMT, data[pos:pos + LITERAL_SIZE])
+            pos += LITERAL_SIZE
+            delta.append((LITERAL, data[pos:pos + size].decode('utf-8')))
+            pos += size
+    return delta
+
+
+def applyDelta(basis, blockSize, delta):
+    """
+    Rebuild the text described by a delta from the signed text it was computed against.
+    """
+    parts = []
+    for instruction in delta:
+        if instruction[0] == COPY:
+            parts.append(basis[instruction[1] * blockSize:(instruction[1] + instruction[2]) * blockSize])
+        else:
+            parts.append(instruction[1])
+    return u''.join(parts)
@@ -0,0 +1,256 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+import struct
+
+# Offset-addressed edit operations.
+#
+# An operation is a tuple of (offset, deleteLength, insertText) where offset and
+# deleteLength are in characters.  A list of operations is always applied in order,
+# each operation addressing the text as it is after the previous one was applied.
+
+# each encoded operation starts with: offset, deleted length (both in characters)
+# and the byte length of the utf-8 encoded inserted text that follows
+OP_HEADER_FMT = '!III'
+OP_HEADER_SIZE = struct.calcsize(OP_HEADER_FMT)
+
+# number of characters compared at a time when scanning for common prefixes/suffixes
+DIFF_SCAN_BLOCK = 4096
+# changed ranges longer than this (on both sides) are split further around an anchor
+DIFF_SPLIT_SIZE = 256
+# number of characters used as a split anchor
+DIFF_ANCHOR_SIZE = 32
+
+
+def encodeOps(ops):
+    """
+    Pack a list of edit operations into a binary payload.
+
+    @param ops: C{list} of (offset, deleteLength, insertText) tuples
+
+    @return: C{str} binary payload
+    """
+    packed = []
+    for offset, deleteLength, insertText in ops:
+        encoded = insertText.encode('utf-8')
+        packed.append(struct.pack(OP_HEADER_FMT, offset, deleteLength, len(encoded)))
+        packed.append(encoded)
+    return ''.join(packed)
+
+
+def packOps(ops, maxPayloadSize):
+    """
+    Pack a list of edit operations into as many binary payloads as needed to keep
+    each payload around maxPayloadSize bytes, see splitOps().
+
+    @return: C{list} of C{str} binary payloads
+    """
+    return [encodeOps(group) for group in splitOps(ops, maxPayloadSize)]
+
+
+def splitOps(ops, maxPayloadSize):
+    """
+    Split a list of edit operations into groups that encode to around maxPayloadSize
+    bytes each.  Large inserts are split into several consecutive operations, so
+    applying the groups in order has the same effect.
+
+    @return: C{list} of C{list}s of (offset, deleteLength, insertText) tuples
+    """
+    # utf-8 needs up to 4 bytes per character
+    maxChars = max(1, (maxPayloadSize - OP_HEADER_SIZE) // 4)
+    groups = []
+    group = []
+    groupSize = 0
+    for offset, deleteLength, insertText in ops:
+        pieces = [insertText[i:i + maxChars] for i in range(0, len(insertText), maxChars)] or [insertText]
+        for piece in pieces:
+            pieceSize = OP_HEADER_SIZE + len(piece.encode('utf-8'))
+            if (groupSize > 0) and (groupSize + pieceSize > maxPayloadSize):
+                groups.append(group)
+                group = []
+                groupSize = 0
+            group.append((offset, deleteLength, piece))
+            groupSize += pieceSize
+            # the rest of the insert follows the piece just inserted
+            offset += len(piece)
+            deleteLength = 0
+    if groupSize > 0:
+        groups.append(group)
+    return groups
+
+
+def decodeOps(data):
+    """
+    Unpack a binary payload created by encodeOps().
+
+    @param data: C{str} binary payload
+
+    @return: C{list} of (offset, deleteLength, insertText) tuples
+    """
+    ops = []
+    pos = 0
+    while pos < len(data):
+        offset, deleteLength, insertSize = struct.unpack(OP_HEADER_FMT, data[pos:pos + OP_HEADER_SIZE])
+        pos += OP_HEADER_SIZE
+        ops.append((offset, deleteLength, data[pos:pos + insertSize].decode('utf-8')))
+        pos += insertSize
+    return ops
+
+
+def applyOps(text, ops):
+    """
+    Apply a list of edit operations to a string.
+
+    @return: C{unicode} the edited text
+    """
+    for offset, deleteLength, insertText in ops:
+        text = text[:offset] + insertText + text[offset + deleteLength:]
+    return text
+
+
+def commonPrefixLength(a, b):
+    """
+    Length of the common prefix of two strings.
+    Compares whole blocks first so most of the work is done by C-level string compares.
+    """
+    limit = min(len(a), len(b))
+    pos = 0
+    while (pos + DIFF_SCAN_BLOCK <= limit) and (a[pos:pos + DIFF_SCAN_BLOCK] == b[pos:pos + DIFF_SCAN_BLOCK]):
+        pos += DIFF_SCAN_BLOCK
+    # binary search the remaining block
+    low = pos
+    high = min(pos + DIFF_SCAN_BLOCK, limit)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[pos:mid] == b[pos:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def commonSuffixLength(a, b, limit=None):
+    """
+    Length of the common suffix of two strings, not exceeding limit characters.
+    """
+    if limit is None:
+        limit = min(len(a), len(b))
+    aEnd = len(a)
+    bEnd = len(b)
+    size = 0
+    while (size + DIFF_SCAN_BLOCK <= limit) and \
+            (a[aEnd - size - DIFF_SCAN_BLOCK:aEnd - size] == b[bEnd - size - DIFF_SCAN_BLOCK:bEnd - size]):
+        size += DIFF_SCAN_BLOCK
+    low = size
+    high = min(size + DIFF_SCAN_BLOCK, limit)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[aEnd - mid:aEnd - size] == b[bEnd - mid:bEnd - size]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def diffText(oldText, newText, offset=0):
+    """
+    Compute the edit operations that turn oldText into newText.
+
+    Common prefixes and suffixes are trimmed and large changed ranges are split
+    around unique anchors, so that edits in distant places of the text (multiple
+    cursors, for example) result in separate small operations.
+
+    @param offset: C{int} offset of both texts in the text the operations apply to,
+    when diffing only the changed range of a larger text
+
+    @return: C{list} of (offset, deleteLength, insertText) tuples in application order
+    """
+    ops = []
+    _diffRange(oldText, newText, offset, ops)
+    # ops were collected front to back, applying them back to front keeps offsets valid
+    ops.reverse()
+    return ops
+
+
+def addSpan(spans, begin, end, sizeDelta):
+    """
+    Add the range changed by an edit to the ranges changed by earlier edits of the
+    same text, merging those it overlaps with.  The text outside of the ranges is
+    the unchanged original, moved along by the changes of the ranges in front of it.
+
+    @param spans: C{list} of [begin, end, sizeDelta] lists in ascending order, ranges
+    of the edited text holding all earlier changes, with the change of the text
+    length within each
+    @param begin: C{int} start of the range of the edited text holding all changes of the edit
+    @param end: C{int} end of that range
+    @param sizeDelta: C{int} change of the text length made by the edit
+
+    @return: C{list} of [begin, end, sizeDelta] lists in ascending order
+    """
+    before = []
+    after = []
+    merged = [begin, end, sizeDelta]
+    for span in spans:
+        if span[1] < begin:
+            before.append(span)
+        elif span[0] > end - sizeDelta:
+            after.append([span[0] + sizeDelta, span[1] + sizeDelta, span[2]])
+        else:
+            merged = [min(merged[0], span[0]), max(merged[1], span[1] + sizeDelta), merged[2] + span[2]]
+    return before + [merged] + after
+
+
+def _diffRange(oldText, newText, offset, ops):
+    prefix = commonPrefixLength(oldText, newText)
+    suffix = commonSuffixLength(oldText, newText, min(len(oldText), len(newText)) - prefix)
+    oldMid = oldText[prefix:len(oldText) - suffix]
+    newMid = newText[prefix:len(newText) - suffix]
+    if (len(oldMid) == 0) and (len(newMid) == 0):
+        return
+    offset += prefix
+    if (len(oldMid) > DIFF_SPLIT_SIZE) and (len(newMid) > DIFF_SPLIT_SIZE):
+        anchorAt = len(newMid) // 2
+        found = _findAnchor(oldMid, newMid[anchorAt:anchorAt + DIFF_ANCHOR_SIZE], anchorAt, abs(len(oldMid) - len(newMid)))
+        if found > -1:
+            # any split point gives a correct result, a good one gives small operations
+            _diffRange(oldMid[:found], newMid[:anchorAt], offset, ops)
+            _diffRange(oldMid[found:], newMid[anchorAt:], offset + found, ops)
+            return
+    ops.append((offset, len(oldMid), newMid))
+
+
+def _findAnchor(text, anchor, expectedAt, drift):
+    """
+    Find the occurrence of anchor in text closest to where it is expected,
+    which matters for repetitive text where the anchor occurs many times.
+    """
+    window = max(drift, DIFF_SPLIT_SIZE) + len(anchor)
+    found = text.find(anchor, max(0, expectedAt - window), expectedAt + window)
+    if found == -1:
+        return text.find(anchor)
+    best = found
+    while found > -1:
+        if abs(found - expectedAt) < abs(best - expectedAt):
+            best = found
+        elif found > expectedAt:
+            break
+        found = text.find(anchor, found + 1, expectedAt + window)
+    return best
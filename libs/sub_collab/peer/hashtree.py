@@ -0,0 +1,357 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+import bisect, hashlib, struct, zlib
+
+# Hash tree (Merkle tree) over blocks of lines of a text, used to detect and
+# locate differences between the host and partner copies of a view.
+#
+# Level 0 holds the hashes of the leaves, blocks of about LINES_PER_LEAF lines,
+# every following level hashes groups of FANOUT nodes of the level below until
+# a single root hash remains.  Node ids are (level, index) tuples.
+#
+# Where a leaf ends is decided by the contents of its lines, not by counting lines
+# from the start of the text, so that adding or removing lines only changes the
+# leaves around the edit and both sides still split the same text the same way.
+
+LINES_PER_LEAF = 64
+# a leaf ends after a line whose checksum (of its utf-8 encoding, without the
+# newline) is a multiple of LINES_PER_LEAF, but
+# not before MIN_LEAF_LINES lines (repeated lines would make tiny leaves) and
+# always after MAX_LEAF_LINES lines
+MIN_LEAF_LINES = LINES_PER_LEAF / 4
+MAX_LEAF_LINES = LINES_PER_LEAF * 4
+FANOUT = 16
+HASH_SIZE = 8
+# characters of the text read at a time while splitting it into leaves
+READ_SIZE = 65536
+
+# text length, leaf count and root hash
+STATE_FMT = '!II8s'
+STATE_SIZE = struct.calcsize(STATE_FMT)
+NODE_ID_FMT = '!BI'
+NODE_ID_SIZE = struct.calcsize(NODE_ID_FMT)
+# node id and number of child hashes that follow
+NODE_CHILDREN_FMT = '!BIB'
+NODE_CHILDREN_SIZE = struct.calcsize(NODE_CHILDREN_FMT)
+LEAF_INDEX_FMT = '!I'
+LEAF_INDEX_SIZE = struct.calcsize(LEAF_INDEX_FMT)
+# leaf index and byte length of the utf-8 encoded leaf text that follows
+LEAF_TEXT_FMT = '!II'
+LEAF_TEXT_SIZE = struct.calcsize(LEAF_TEXT_FMT)
+
+
+def digest(data):
+    return hashlib.md5(data).digest()[:HASH_SIZE]
+
+
+class HashTree(object):
+    """
+    Hash tree of a text that is kept up to date incrementally.
+
+    Every change made to the tracked text must be reported with markEdit() or
+    invalidate(), update() then only splits and rehashes the leaves that changed.
+    """
+
+    def __init__(self):
+        self.invalidate()
+
+
+    def invalidate(self):
+        """
+        Forget everything, the next update() hashes the whole text.
+        """
+        # character offset of the start of each leaf
+        self.leafStarts = [0]
+        # levels[0] are the leaf hashes, levels[-1] holds the root hash
+        self.levels = [[None]]
+        # None until the text has been read
+        self.textLength = None
+        # leaves changed since the last update()
+        self.dirtyLeaves = set([0])
+
+
+    def markEdit(self, offset, deletedText, insertText):
+        """
+        Report a change of the tracked text.
+
+        @param offset: C{int} character offset of the change
+        @param deletedText: C{unicode} text that was removed at offset
+        @param insertText: C{unicode} text that was inserted at offset
+        """
+        if self.textLength is None:
+            return
+        deleteEnd = offset + len(deletedText)
+        first = max(0, bisect.bisect_right(self.leafStarts, offset) - 1)
+        # a leaf starting right at the end of the deleted text has its first line joined to the edit
+        last = max(0, bisect.bisect_right(self.leafStarts, deleteEnd) - 1)
+        self.dirtyLeaves.update(range(first, last + 1))
+        sizeDelta = len(insertText) - len(deletedText)
+        for idx in range(first + 1, last + 1):
+            # starts inside the deleted text end up behind the inserted text
+            self.leafStarts[idx] = deleteEnd + sizeDelta
+        if sizeDelta != 0:
+            for idx in range(last + 1, len(self.leafStarts)):
+                self.leafStarts[idx] += sizeDelta
+        self.textLength += sizeDelta
+
+
+    def update(self, text):
+        """
+        Bring the tree up to date with the tracked text.
+
+        @param text: C{unicode}, C{shadow.ShadowText} or anything else that can be
+            sliced, only the leaves that changed are read
+        """
+        if self.textLength != len(text):
+            # changes were missed
+            self.invalidate()
+        if len(self.dirtyLeaves) == 0:
+            return
+        if self.textLength is None:
+            self.textLength = len(text)
+        runs = []
+        for leaf in sorted(self.dirtyLeaves):
+            if (len(runs) > 0) and (runs[-1][1] == leaf - 1):
+                runs[-1][1] = leaf
+            else:
+                runs.append([leaf, leaf])
+        # front to back, a run split up to past the next one takes that one along
+        leafCountDelta = 0
+        splitUpTo = 0
+        for first, last in runs:
+            if last + leafCountDelta < splitUpTo:
+                continue
+            leafCount = len(self.leafStarts)
+            splitUpTo = self.splitLeaves(text, max(first + leafCountDelta, splitUpTo), last + leafCountDelta)
+            leafCountDelta += len(self.leafStarts) - leafCount
+        self.dirtyLeaves = set()
+        # upper levels are cheap enough to always rebuild
+        leafHashes = self.levels[0]
+        self.levels = [leafHashes]
+        while len(self.levels[-1]) > 1:
+            below = self.levels[-1]
+            self.levels.append([digest(''.join(below[idx:idx + FANOUT])) for idx in range(0, len(below), FANOUT)])
+
+
+    def splitLeaves(self, text, first, last):
+        """
+        Split the text of a run of changed leaves into new leaves, going on past the
+        run until a new leaf ends where an old one did, the leaves from there on are
+        what splitting the whole text would give.
+
+        @return: C{int} index of the first leaf behind the new ones
+        """
+        leafHashes = self.levels[0]
+        begin = self.leafStarts[first]
+        if (begin >= self.textLength) and (first > 0):
+            # the text of the leaves was deleted from the end of the text
+            del self.leafStarts[first:]
+            del leafHashes[first:]
+            return first
+        runEnd = self.leafRange(last)[1]
+        starts = [begin]
+        hashes = []
+        leafHash = hashlib.md5()
+        # lines of the current leaf read before the current block
+        lineCount = 0
+        pos = begin
+        readSize = READ_SIZE
+        stop = None
+        while stop is None:
+            block = text[pos:min(self.textLength, pos + readSize)]
+            lines = block.split(u'\n')
+            atEnd = pos + len(block) >= self.textLength
+            if atEnd and (len(lines) > 1) and (len(lines[-1]) == 0):
+                # the text ends with a newline, there is no line behind it
+                lines.pop()
+            elif not atEnd:
+                if len(lines) == 1:
+                    # a line longer than the block
+                    readSize *= 2
+                    continue
+                # the last line goes on in the next block
+                lines.pop()
+            encoded = block.encode('utf-8')
+            # '\n' is a single byte in utf-8, so the encoded lines are those of the text
+            encodedLines = encoded.split('\n')[:len(lines)]
+            lineLengths = map(len, lines)
+            byteLengths = map(len, encodedLines)
+            candidates = [idx for idx, crc in enumerate(map(zlib.crc32, encodedLines)) if crc % LINES_PER_LEAF == 0]
+            candidate = 0
+            # block index of the first line of the current leaf, and of the first line not yet hashed
+            leafLine = -lineCount
+            line = 0
+            bytePos = 0
+            while True:
+                leafEnd = leafLine + MAX_LEAF_LINES - 1
+                while (candidate < len(candidates)) and (candidates[candidate] < leafLine + MIN_LEAF_LINES - 1):
+                    candidate += 1
+                if (candidate < len(candidates)) and (candidates[candidate] < leafEnd):
+                    leafEnd = candidates[candidate]
+                if leafEnd > len(lines) - 1:
+                    if not atEnd:
+                        break
+                    leafEnd = len(lines) - 1
+                lineEnd = min(self.textLength, pos + sum(lineLengths[line:leafEnd + 1]) + leafEnd + 1 - line)
+                lineBytesEnd = min(len(encoded), bytePos + sum(byteLengths[line:leafEnd + 1]) + leafEnd + 1 - line)
+                leafHash.update(encoded[bytePos:lineBytesEnd])
+                hashes.append(leafHash.digest()[:HASH_SIZE])
+                leafHash = hashlib.md5()
+                pos = lineEnd
+                bytePos = lineBytesEnd
+                line = leafLine = leafEnd + 1
+                if lineEnd >= self.textLength:
+                    stop = len(self.leafStarts)
+                    break
+                if lineEnd >= runEnd:
+                    stop = bisect.bisect_left(self.leafStarts, lineEnd, last + 1)
+                    if (stop < len(self.leafStarts)) and (self.leafStarts[stop] == lineEnd):
+                        break
+                    stop = None
+                starts.append(lineEnd)
+            if stop is None:
+                # the rest of the lines of the block belong to a leaf that goes on in the next one
+                lineBytesEnd = bytePos + sum(byteLengths[line:]) + len(lines) - line
+                leafHash.update(encoded[bytePos:lineBytesEnd])
+                pos += sum(lineLengths[line:]) + len(lines) - line
+                lineCount = len(lines) - leafLine
+        self.leafStarts[first:stop] = starts
+        leafHashes[first:stop] = hashes
+        return first + len(starts)
+
+
+    def root(self):
+        return self.levels[-1][0]
+
+
+    def leafCount(self):
+        return len(self.levels[0])
+
+
+    def height(self):
+        return len(self.levels) - 1
+
+
+    def leafRange(self, leaf):
+        """
+        @return: C{tuple} of the begin and end character offsets of a leaf
+        """
+        if leaf + 1 < len(self.leafStarts):
+            return self.leafStarts[leaf], self.leafStarts[leaf + 1]
+        return self.leafStarts[leaf], self.textLength
+
+
+    def leafText(self, text, leaf):
+        begin, end = self.leafRange(leaf)
+        return text[begin:end]
+
+
+    def children(self, level, index):
+        """
+        @return: C{list} of the hashes of the children of a node
+        """
+        return self.levels[level - 1][index * FANOUT:(index + 1) * FANOUT]
+
+
+    def state(self):
+        return struct.pack(STATE_FMT, self.textLength, self.leafCount(), self.root())
+
+
+def decodeState(data):
+    """
+    @return: C{tuple} of text length, leaf count and root hash
+    """
+    return struct.unpack(STATE_FMT, data[:STATE_SIZE])
+
+
+def encodeNodeIds(nodeIds):
+    return ''.join([struct.pack(NODE_ID_FMT, level, index) for level, index in nodeIds])
+
+
+def decodeNodeIds(data):
+    return [struct.unpack(NODE_ID_FMT, data[pos:pos + NODE_ID_SIZE]) for pos in range(0, len(data), NODE_ID_SIZE)]
+
+
+def encodeNodes(tree, nodeIds):
+    """
+    Encode the tree state followed by the child hashes of each of the given nodes.
+    """
+    packed = [tree.state()]
+    for level, index in nodeIds:
+        if (level < 1) or (level > tree.height()):
+            continue
+        children = tree.children(level, index)
+        packed.append(struct.pack(NODE_CHILDREN_FMT, level, index, len(children)))
+        packed.extend(children)
+    return ''.join(packed)
+
+
+def decodeNodes(data):
+    """
+    @return: C{tuple} of the tree state and a C{list} of ((level, index), childHashes)
+    """
+    state = decodeState(data)
+    nodes = []
+    pos = STATE_SIZE
+    while pos < len(data):
+        level, index, childCount = struct.unpack(NODE_CHILDREN_FMT, data[pos:pos + NODE_CHILDREN_SIZE])
+        pos += NODE_CHILDREN_SIZE
+        nodes.append(((level, index), [data[pos + idx * HASH_SIZE:pos + (idx + 1) * HASH_SIZE] for idx in range(childCount)]))
+        pos += childCount * HASH_SIZE
+    return state, nodes
+
+
+def encodeLeafIndexes(leaves):
+    return ''.join([struct.pack(LEAF_INDEX_FMT, leaf) for leaf in leaves])
+
+
+def decodeLeafIndexes(data):
+    return [struct.unpack(LEAF_INDEX_FMT, data[pos:pos + LEAF_INDEX_SIZE])[0] for pos in range(0, len(data), LEAF_INDEX_SIZE)]
+
+
+def encodeLeaves(tree, text, leaves):
+    """
+    Encode the tree state followed by the text of each of the given leaves.
+    """
+    packed = [tree.state()]
+    for leaf in leaves:
+        if leaf >= tree.leafCount():
+            continue
+        encoded = tree.leafText(text, leaf).encode('utf-8')
+        packed.append(struct.pack(LEAF_TEXT_FMT, leaf, len(encoded)))
+        packed.append(encoded)
+    return ''.join(packed)
+
+
+def decodeLeaves(data):
+    """
+    @return: C{tuple} of the tree state and a C{list} of (leaf, text)
+    """
+    state = decodeState(data)
+    leaves = []
+    pos = STATE_SIZE
+    while pos < len(data):
+        leaf, size = struct.unpack(LEAF_TEXT_FMT, data[pos:pos + LEAF_TEXT_SIZE])
+        pos += LEAF_TEXT_SIZE
+        leaves.append((leaf, data[pos:pos + size].decode('utf-8')))
+        pos += size
+    return state, leaves
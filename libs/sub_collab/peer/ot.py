@@ -0,0 +1,444 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+import struct, collections
+
+# Operational transformation of concurrent edits, so that both sides of a session
+# can edit the shared view at the same time.
+#
+# An operation describes an edit of the whole text as a list of components that walk
+# it from front to back: an C{int} > 0 retains that many characters, an C{int} < 0
+# deletes that many and a C{unicode} string is inserted.  Unchanged text is covered
+# by retain counts, so the cost of composing and transforming operations depends on
+# the number of edits and not on the size of the text.  Sessions apply the resulting
+# edits to their copy of the text in place, see C{sub_collab.peer.shadow}, apply()
+# below rebuilds the whole string.
+#
+# Concurrency control follows the two-party Jupiter protocol: each side numbers the
+# operations it sends and reports how many of the peer's operations it has applied,
+# see EditState.
+
+# each encoded component is a kind ('r'etain, 'd'elete or 'i'nsert) followed by a
+# character count, or the byte length of the utf-8 encoded text that follows for inserts
+COMPONENT_FMT = '!cI'
+COMPONENT_SIZE = struct.calcsize(COMPONENT_FMT)
+
+
+def isRetain(component):
+    return isinstance(component, (int, long)) and (component > 0)
+
+
+def isDelete(component):
+    return isinstance(component, (int, long)) and (component < 0)
+
+
+def isInsert(component):
+    return isinstance(component, basestring)
+
+
+def retain(operation, count):
+    """
+    Append retaining count characters to an operation.
+    """
+    if count <= 0:
+        return
+    if (len(operation) > 0) and isRetain(operation[-1]):
+        operation[-1] += count
+    else:
+        operation.append(count)
+
+
+def insert(operation, text):
+    """
+    Append inserting text to an operation.  Inserts always go ahead of a delete at the
+    same position, so equal edits have a single representation.
+    """
+    if len(text) == 0:
+        return
+    if (len(operation) > 0) and isInsert(operation[-1]):
+        operation[-1] += text
+    elif (len(operation) > 0) and isDelete(operation[-1]):
+        if (len(operation) > 1) and isInsert(operation[-2]):
+            operation[-2] += text
+        else:
+            operation.insert(len(operation) - 1, text)
+    else:
+        operation.append(text)
+
+
+def delete(operation, count):
+    """
+    Append deleting count characters to an operation.
+    """
+    if count <= 0:
+        return
+    if (len(operation) > 0) and isDelete(operation[-1]):
+        operation[-1] -= count
+    else:
+        operation.append(-count)
+
+
+def baseLength(operation):
+    """
+    @return: C{int} length of the text the operation applies to
+    """
+    return sum([abs(component) for component in operation if not isInsert(component)])
+
+
+def targetLength(operation):
+    """
+    @return: C{int} length of the text once the operation is applied
+    """
+    length = 0
+    for component in operation:
+        if isRetain(component):
+            length += component
+        elif isInsert(component):
+            length += len(component)
+    return length
+
+
+def apply(text, operation):
+    """
+    Apply an operation to a string.
+
+    @return: C{unicode} the edited text
+    """
+    if baseLength(operation) != len(text):
+        raise ValueError('operation of a %d character text applied to %d characters' % (baseLength(operation), len(text)))
+    pieces = []
+    pos = 0
+    for component in operation:
+        if isRetain(component):
+            pieces.append(text[pos:pos + component])
+            pos += component
+        elif isDelete(component):
+            pos -= component
+        else:
+            pieces.append(component)
+    return u''.join(pieces)
+
+
+def fromOps(ops, length):
+    """
+    Build a single operation out of offset-addressed edit operations, see
+    C{sub_collab.peer.editops}.
+
+    @param ops: C{list} of (offset, deleteLength, insertText) tuples to apply in order
+    @param length: C{int} length of the text the edit operations apply to
+
+    @return: C{list} operation
+    """
+    # edit operations in descending offset order that do not overlap, like those
+    # of editops.diffText(), all address the original text
+    end = length
+    for offset, deleteLength, insertText in ops:
+        if offset + deleteLength > end:
+            break
+        end = offset
+    else:
+        operation = []
+        pos = 0
+        for offset, deleteLength, insertText in reversed(ops):
+            retain(operation, offset - pos)
+            insert(operation, insertText)
+            delete(operation, deleteLength)
+            pos = offset + deleteLength
+        retain(operation, length - pos)
+        return operation
+    operation = [length] if length > 0 else []
+    for offset, deleteLength, insertText in ops:
+        single = []
+        retain(single, offset)
+        insert(single, insertText)
+        delete(single, deleteLength)
+        retain(single, length - offset - deleteLength)
+        operation = compose(operation, single)
+        length += len(insertText) - deleteLength
+    return operation
+
+
+def toOps(operation):
+    """
+    Convert an operation into offset-addressed edit operations.
+
+    @return: C{list} of (offset, deleteLength, insertText) tuples in ascending offset order, to apply in order
+    """
+    ops = []
+    pos = 0
+    deleteLength = 0
+    insertText = u''
+    for component in operation:
+        if isRetain(component):
+            if (deleteLength > 0) or (len(insertText) > 0):
+                ops.append((pos, deleteLength, insertText))
+                pos += len(insertText)
+                deleteLength = 0
+                insertText = u''
+            pos += component
+        elif isDelete(component):
+            deleteLength -= component
+        else:
+            insertText += component
+    if (deleteLength > 0) or (len(insertText) > 0):
+        ops.append((pos, deleteLength, insertText))
+    return ops
+
+
+def _advance(component, count):
+    """
+    @return: what is left of a component once count characters of it are consumed, None if nothing
+    """
+    if isInsert(component):
+        rest = component[count:]
+    elif isRetain(component):
+        rest = component - count
+    else:
+        rest = component + count
+    return rest or None
+
+
+def _size(component):
+    if isInsert(component):
+        return len(component)
+    return abs(component)
+
+
+def compose(first, second):
+    """
+    Combine two consecutive operations into one with the same effect.
+
+    @return: C{list} operation applying first and then second
+    """
+    if targetLength(first) != baseLength(second):
+        raise ValueError('cannot compose an operation to %d characters with one of %d characters' % (targetLength(first), baseLength(second)))
+    composed = []
+    firstIter = iter(first)
+    secondIter = iter(second)
+    a = next(firstIter, None)
+    b = next(secondIter, None)
+    while (a is not None) or (b is not None):
+        if isDelete(a):
+            delete(composed, -a)
+            a = next(firstIter, None)
+            continue
+        if isInsert(b):
+            insert(composed, b)
+            b = next(secondIter, None)
+            continue
+        count = min(_size(a), _size(b))
+        if isRetain(a) and isRetain(b):
+            retain(composed, count)
+        elif isInsert(a) and isRetain(b):
+            insert(composed, a[:count])
+        elif isRetain(a) and isDelete(b):
+            delete(composed, count)
+        # an insert deleted again leaves nothing
+        a = _advance(a, count)
+        if a is None:
+            a = next(firstIter, None)
+        b = _advance(b, count)
+        if b is None:
+            b = next(secondIter, None)
+    return composed
+
+
+def transform(winning, losing):
+    """
+    Transform two concurrent operations of the same text against each other.
+    Inserts at the same position are ordered with those of winning first.
+
+    @return: (winning', losing') where winning' applies after losing and losing' after
+        winning, with the same result either way
+    """
+    if baseLength(winning) != baseLength(losing):
+        raise ValueError('cannot transform operations of %d and %d characters' % (baseLength(winning), baseLength(losing)))
+    winningPrime = []
+    losingPrime = []
+    winningIter = iter(winning)
+    losingIter = iter(losing)
+    a = next(winningIter, None)
+    b = next(losingIter, None)
+    while (a is not None) or (b is not None):
+        if isInsert(a):
+            insert(winningPrime, a)
+            retain(losingPrime, len(a))
+            a = next(winningIter, None)
+            continue
+        if isInsert(b):
+            retain(winningPrime, len(b))
+            insert(losingPrime, b)
+            b = next(losingIter, None)
+            continue
+        count = min(_size(a), _size(b))
+        if isRetain(a) and isRetain(b):
+            retain(winningPrime, count)
+            retain(losingPrime, count)
+        elif isDelete(a) and isRetain(b):
+            delete(winningPrime, count)
+        elif isRetain(a) and isDelete(b):
+            delete(losingPrime, count)
+        # deleted on both sides, nothing left to do for either
+        a = _advance(a, count)
+        if a is None:
+            a = next(winningIter, None)
+        b = _advance(b, count)
+        if b is None:
+            b = next(losingIter, None)
+    return winningPrime, losingPrime
+
+
+def encodeOperation(operation):
+    """
+    Pack an operation into a binary payload.
+
+    @return: C{str} binary payload
+    """
+    packed = []
+    for component in operation:
+        if isRetain(component):
+            packed.append(struct.pack(COMPONENT_FMT, 'r', component))
+        elif isDelete(component):
+            packed.append(struct.pack(COMPONENT_FMT, 'd', -component))
+        else:
+            encoded = component.encode('utf-8')
+            packed.append(struct.pack(COMPONENT_FMT, 'i', len(encoded)))
+            packed.append(encoded)
+    return ''.join(packed)
+
+
+def decodeOperation(data):
+    """
+    Unpack a binary payload created by encodeOperation().
+
+    @return: C{list} operation
+    """
+    operation = []
+    pos = 0
+    while pos < len(data):
+        kind, count = struct.unpack(COMPONENT_FMT, data[pos:pos + COMPONENT_SIZE])
+        pos += COMPONENT_SIZE
+        if kind == 'r':
+            retain(operation, count)
+        elif kind == 'd':
+            delete(operation, count)
+        elif kind == 'i':
+            insert(operation, data[pos:pos + count].decode('utf-8'))
+            pos += count
+        else:
+            raise ValueError('unknown operation component %r' % kind)
+    return operation
+
+
+class EditState(object):
+    """
+    One side's state of the concurrent edits of a session.
+
+    Every operation sent is numbered and carries the number of peer operations
+    applied when it was made.  Operations of ours the peer had not seen yet are kept,
+    and each operation received is transformed against them before it is applied
+    here.  The peer reports the operations it has applied with each message, which
+    drops those kept for transforming, so the log stays as short as the edits in flight.
+    """
+
+
+    def __init__(self, isServer):
+        """
+        @param isServer: C{bool} True on the server side of the connection, whose
+            inserts go first when both sides insert at the same position
+        """
+        self.isServer = isServer
+        self.reset()
+
+
+    def reset(self):
+        """
+        Start over from a text both sides agree on, as after the view was (re)shared.
+        """
+        # number of operations sent and peer operations applied
+        self.sent = 0
+        self.received = 0
+        # (number, operation) of the operations sent the peer has not acknowledged yet
+        self.outgoing = collections.deque()
+        # number of peer operations applied when we last told the peer
+        self.reportedReceived = 0
+
+
+    def local(self, operation):
+        """
+        Record an operation made on this side, about to be sent.
+
+        @return: (sent, received) C{tuple} of counts to send along with the operation
+        """
+        counts = (self.sent, self.received)
+        self.outgoing.append((self.sent, operation))
+        self.sent += 1
+        self.reportedReceived = self.received
+        return counts
+
+
+    def acknowledge(self, peerReceived):
+        """
+        Drop the operations the peer has applied.
+
+        @param peerReceived: C{int} number of our operations the peer has applied
+        """
+        while (len(self.outgoing) > 0) and (self.outgoing[0][0] < peerReceived):
+            self.outgoing.popleft()
+
+
+    def remote(self, operation, peerSent, peerReceived):
+        """
+        Transform an operation received from the peer so it applies to the text on this side.
+
+        @param peerSent: C{int} number of operations the peer sent before this one
+        @param peerReceived: C{int} number of our operations the peer had applied
+
+        @return: C{list} the transformed operation
+        """
+        if peerSent != self.received:
+            raise ValueError('received operation %d, expected %d' % (peerSent, self.received))
+        self.acknowledge(peerReceived)
+        transformed = collections.deque()
+        for number, ours in self.outgoing:
+            if self.isServer:
+                ours, operation = transform(ours, operation)
+            else:
+                operation, ours = transform(operation, ours)
+            transformed.append((number, ours))
+        self.outgoing = transformed
+        self.received += 1
+        return operation
+
+
+    def needsAck(self):
+        """
+        @return: True if peer operations were applied since we last told the peer
+        """
+        return self.received != self.reportedReceived
+
+
+    def ack(self):
+        """
+        @return: (sent, received) C{tuple} of counts to acknowledge the peer operations with
+        """
+        self.reportedReceived = self.received
+        return (self.sent, self.received)
@@ -0,0 +1,226 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+from sub_collab.peer import base
+from twisted.internet import reactor, protocol
+from twisted.protocols import basic
+import logging, struct
+
+# Happy Eyeballs style connection establishment between a partner and a host that
+# offered several addresses, without any Sublime Text dependencies.  The partner
+# races connections to all of them, starting one after the other, and keeps the
+# first connection the host answers the CONNECTED handshake on.  The host only
+# ever answers the handshake on the first of those connections it receives it on.
+
+# in seconds, given up on a single address after this long
+CONNECT_TIMEOUT = 5
+
+# connections carry length prefixed frames, see twisted.protocols.basic.Int32StringReceiver
+PREFIX_FORMAT = basic.Int32StringReceiver.structFormat
+PREFIX_LENGTH = basic.Int32StringReceiver.prefixLength
+
+
+def firstMessageType(data):
+    """
+    @param data: C{str} received on a connection so far
+    @return: C{int} message type of the first frame, or None if it is not complete yet
+    """
+    if len(data) < PREFIX_LENGTH:
+        return None
+    length = struct.unpack(PREFIX_FORMAT, data[:PREFIX_LENGTH])[0]
+    if (len(data) < PREFIX_LENGTH + length) or (length < 3):
+        return None
+    return ord(data[PREFIX_LENGTH + 2])
+
+
+class Candidate(protocol.Protocol):
+    """
+    A connection kept aside until its first frame has been received, it is then
+    either handed over to the session or dropped by its factory.
+    """
+
+    def __init__(self):
+        self.received = ''
+        self.decided = False
+
+
+    def connectionMade(self):
+        self.factory.candidateConnected(self)
+
+
+    def dataReceived(self, data):
+        self.received += data
+        messageType = firstMessageType(self.received)
+        if (messageType is not None) and not self.decided:
+            self.decided = True
+            self.factory.candidateAnswered(self, messageType)
+
+
+    def connectionLost(self, reason):
+        if not self.decided:
+            self.decided = True
+            self.factory.candidateLost(self, reason)
+
+
+class AcceptGate(protocol.ServerFactory):
+    """
+    Listening side of a session, hands the connection a partner opens the session
+    with over to the session once its first frame has been received.  Further
+    connections of a partner racing its connections are dropped, connections
+    resuming the session are handed over as well.
+    """
+    protocol = Candidate
+
+    logger = logging.getLogger('SubliminalCollaborator.AcceptGate')
+
+
+    def __init__(self, peer):
+        self.peer = peer
+
+
+    def candidateConnected(self, candidate):
+        pass
+
+
+    def candidateAnswered(self, candidate, messageType):
+        if (messageType == base.CONNECTED) and (self.peer.state != base.STATE_CONNECTING):
+            self.logger.debug('Dropping connection from %s, the session with %s is already connected' % (candidate.transport.getPeer().host, self.peer.sharingWithUser))
+            candidate.transport.abortConnection()
+            return
+        session = self.peer.buildProtocol(candidate.transport.getPeer())
+        candidate.transport.protocol = session
+        session.makeConnection(candidate.transport)
+        session.dataReceived(candidate.received)
+
+
+    def candidateLost(self, candidate, reason):
+        pass
+
+
+class ConnectionRace(protocol.ClientFactory):
+    """
+    Connects to each of the addresses of a host, attemptDelay seconds apart or right
+    after the previous attempt failed, sending the CONNECTED handshake on each
+    connection made.  The connection the host answers first is handed over to the
+    session through C{BasicPeer.raceWon()} and all others are dropped.  If all of
+    them fail the session is told so through its clientConnectionFailed().
+    """
+    protocol = Candidate
+
+    logger = logging.getLogger('SubliminalCollaborator.ConnectionRace')
+
+
+    def __init__(self, peer, addresses, port, attemptDelay, timeout=CONNECT_TIMEOUT):
+        """
+        @param peer: C{BasicPeer} connecting as the partner
+        @param addresses: C{list} of host ip addresses, in the order to try them
+        @param port: C{int} port number the host is listening on at all addresses
+        @param attemptDelay: C{float} seconds to wait for an attempt before starting the next one
+        """
+        self.peer = peer
+        self.addresses = list(addresses)
+        self.port = port
+        self.attemptDelay = attemptDelay
+        self.timeout = timeout
+        self.connectors = []
+        self.candidates = []
+        self.nextAttempt = None
+        self.lastFailure = None
+        self.winner = None
+
+
+    def start(self):
+        self.logger.info('Connecting to peer at %s:%d' % (','.join(self.addresses), self.port))
+        self.attempt()
+
+
+    def attempt(self):
+        self.nextAttempt = None
+        if len(self.addresses) == 0:
+            return
+        address = self.addresses.pop(0)
+        self.logger.debug('Trying %s:%d' % (address, self.port))
+        self.connectors.append(reactor.connectTCP(address, self.port, self, timeout=self.timeout))
+        if len(self.addresses) > 0:
+            self.nextAttempt = reactor.callLater(self.attemptDelay, self.attempt)
+
+
+    def disconnect(self):
+        """
+        Give up on all addresses, stands in for the connector of the session until it is connected.
+        """
+        if self.nextAttempt is not None:
+            self.nextAttempt.cancel()
+            self.nextAttempt = None
+        self.addresses = []
+        # stopping a connector reports the failure right away, which drops it from the list
+        for connector in list(self.connectors):
+            connector.stopConnecting()
+        for candidate in list(self.candidates):
+            candidate.transport.abortConnection()
+
+
+    def candidateConnected(self, candidate):
+        if self.winner is not None:
+            candidate.transport.abortConnection()
+            return
+        self.candidates.append(candidate)
+        self.connectors.remove(candidate.transport.connector)
+        frame = self.peer.connectedFrame()
+        candidate.transport.write(struct.pack(PREFIX_FORMAT, len(frame)) + frame)
+
+
+    def candidateAnswered(self, candidate, messageType):
+        self.winner = candidate
+        self.candidates.remove(candidate)
+        self.disconnect()
+        self.logger.debug('Connected to %s first' % candidate.transport.getPeer().host)
+        self.peer.raceWon(candidate.transport.connector, candidate.transport, candidate.received)
+
+
+    def candidateLost(self, candidate, reason):
+        if candidate in self.candidates:
+            self.candidates.remove(candidate)
+        self.attemptFailed(candidate.transport.connector, reason)
+
+
+    def clientConnectionFailed(self, connector, reason):
+        if connector in self.connectors:
+            self.connectors.remove(connector)
+        self.attemptFailed(connector, reason)
+
+
+    def clientConnectionLost(self, connector, reason):
+        # reported by candidateLost()
+        pass
+
+
+    def attemptFailed(self, connector, reason):
+        if self.winner is not None:
+            return
+        self.logger.debug('Connecting to %s failed: %s' % (connector.getDestination().host, reason.value))
+        self.lastFailure = (connector, reason)
+        if self.nextAttempt is not None:
+            # no point in waiting for the next one
+            self.nextAttempt.cancel()
+            self.attempt()
+        elif (len(self.addresses) == 0) and (len(self.connectors) == 0) and (len(self.candidates) == 0):
+            self.peer.clientConnectionFailed(*self.lastFailure)
@@ -0,0 +1,175 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+import struct, json, os, time
+
+# Recording of the messages of a connection as they went over the wire, without
+# any Sublime Text dependencies so that recordings can be replayed outside of
+# the editor, see benchmarks/replay.py.
+#
+# A recording starts with a file header: magic, format version and a JSON
+# description of the session at the time the file was started.  Every message
+# follows as a record header (time, direction and length) and the message with
+# its header, sequenced if FEATURE_RESUME was agreed.  Recordings are rotated
+# like logging.handlers.RotatingFileHandler rotates its files, the oldest one
+# being the one with the highest number.
+
+FILE_MAGIC = 'SCREC'
+FILE_VERSION = 1
+# magic, version and length of the session description
+FILE_HEADER_FMT = '!5sBH'
+FILE_HEADER_SIZE = struct.calcsize(FILE_HEADER_FMT)
+# time the message was sent or received, direction and message length
+RECORD_HEADER_FMT = '!dBI'
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER_FMT)
+
+INCOMING = 0
+OUTGOING = 1
+
+# in bytes, recorded messages are written out at least this often
+FLUSH_SIZE = 65536
+# in seconds
+FLUSH_INTERVAL = 1.0
+
+
+class SessionRecorder(object):
+    """
+    Writes the messages of a connection to a recording of bounded size.
+    """
+
+
+    def __init__(self, path, describe, maxBytes, maxFiles):
+        """
+        @param path: C{str} file of the latest recording, older ones get a .1, .2, ... suffix
+        @param describe: callable returning a C{dict} describing the session, written at the
+        start of every file so that each can be replayed on its own
+        @param maxBytes: C{int} size at which a file is rotated
+        @param maxFiles: C{int} most files kept, including the latest one
+        """
+        self.path = path
+        self.describe = describe
+        self.maxBytes = maxBytes
+        self.maxFiles = max(1, maxFiles)
+        self.recordFile = None
+        self.size = 0
+        self.headerSize = 0
+        self.unflushed = 0
+        self.lastFlush = time.time()
+        self.open()
+
+
+    def open(self):
+        description = json.dumps(self.describe())
+        self.recordFile = open(self.path, 'wb')
+        self.recordFile.write(struct.pack(FILE_HEADER_FMT, FILE_MAGIC, FILE_VERSION, len(description)) + description)
+        self.size = FILE_HEADER_SIZE + len(description)
+        self.headerSize = self.size
+
+
+    def rotate(self):
+        self.recordFile.close()
+        self.unflushed = 0
+        for index in range(self.maxFiles - 1, 0, -1):
+            older = '%s.%d' % (self.path, index)
+            if index == 1:
+                newer = self.path
+            else:
+                newer = '%s.%d' % (self.path, index - 1)
+            if not os.path.exists(newer):
+                continue
+            if os.path.exists(older):
+                os.remove(older)
+            os.rename(newer, older)
+        self.open()
+
+
+    def record(self, direction, frame):
+        """
+        @param direction: C{int} INCOMING or OUTGOING
+        @param frame: C{str} message as sent or received
+        """
+        if self.recordFile is None:
+            return
+        if (self.size + RECORD_HEADER_SIZE + len(frame) > self.maxBytes) and (self.size > self.headerSize):
+            self.rotate()
+        now = time.time()
+        self.recordFile.write(struct.pack(RECORD_HEADER_FMT, now, direction, len(frame)))
+        self.recordFile.write(frame)
+        self.size += RECORD_HEADER_SIZE + len(frame)
+        self.unflushed += RECORD_HEADER_SIZE + len(frame)
+        if (self.unflushed >= FLUSH_SIZE) or (now - self.lastFlush >= FLUSH_INTERVAL):
+            self.recordFile.flush()
+            self.unflushed = 0
+            self.lastFlush = now
+
+
+    def close(self):
+        if self.recordFile is not None:
+            self.recordFile.close()
+            self.recordFile = None
+
+
+def recordingFiles(path):
+    """
+    @return: C{list} of the files of a rotated recording, oldest first
+    """
+    files = []
+    index = 1
+    while os.path.exists('%s.%d' % (path, index)):
+        files.insert(0, '%s.%d' % (path, index))
+        index += 1
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def readRecording(path):
+    """
+    @param path: C{str} a single recording file
+
+    @return: (description, records) C{tuple}, description being the C{dict} the file
+    started with and records a generator of (time, direction, frame) C{tuple}s
+    """
+    recordFile = open(path, 'rb')
+    header = recordFile.read(FILE_HEADER_SIZE)
+    if len(header) < FILE_HEADER_SIZE:
+        recordFile.close()
+        raise ValueError('%s is not a session recording' % path)
+    magic, version, descriptionSize = struct.unpack(FILE_HEADER_FMT, header)
+    if (magic != FILE_MAGIC) or (version != FILE_VERSION):
+        recordFile.close()
+        raise ValueError('%s is not a version %d session recording' % (path, FILE_VERSION))
+    description = json.loads(recordFile.read(descriptionSize))
+    def records():
+        try:
+            while True:
+                recordHeader = recordFile.read(RECORD_HEADER_SIZE)
+                if len(recordHeader) < RECORD_HEADER_SIZE:
+                    # the end, or the last record was cut short
+                    return
+                when, direction, frameSize = struct.unpack(RECORD_HEADER_FMT, recordHeader)
+                frame = recordFile.read(frameSize)
+                if len(frame) < frameSize:
+                    return
+                yield when, direction, frame
+        finally:
+            recordFile.close()
+    return description, records()
@@ -0,0 +1,154 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+
+# Compact encoding of region sets (selections and view positions).
+#
+# A region set is encoded as a varint count followed by each region as two
+# zigzag varints: the delta of its start (a) to the end (b) of the previous
+# region and the delta of its end to its start.  Sorted selections of many
+# cursors thus encode to 2 or 3 bytes per region.
+#
+# Selections can also be encoded as a difference to the previously sent set,
+# replacing all but a common prefix and suffix of regions.
+
+SELECTION_FULL = 'F'
+SELECTION_DIFF = 'D'
+
+
+def zigzag(value):
+    if value < 0:
+        return ((-value) << 1) - 1
+    return value << 1
+
+
+def unzigzag(value):
+    if value & 1:
+        return -((value + 1) >> 1)
+    return value >> 1
+
+
+def encodeVarint(value, out):
+    """
+    Append the varint encoding of a non-negative C{int} to a C{bytearray}.
+    """
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decodeVarint(data, pos):
+    """
+    @param data: C{bytearray} to decode from
+    @return: C{tuple} of the decoded value and the position after it
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def packRegions(regions, out):
+    encodeVarint(len(regions), out)
+    previous = 0
+    for a, b in regions:
+        encodeVarint(zigzag(a - previous), out)
+        encodeVarint(zigzag(b - a), out)
+        previous = b
+
+
+def unpackRegions(data, pos):
+    count, pos = decodeVarint(data, pos)
+    regions = []
+    previous = 0
+    for idx in xrange(count):
+        delta, pos = decodeVarint(data, pos)
+        a = previous + unzigzag(delta)
+        delta, pos = decodeVarint(data, pos)
+        previous = a + unzigzag(delta)
+        regions.append((a, previous))
+    return regions, pos
+
+
+def encodeRegions(regions):
+    """
+    @param regions: C{list} of (a, b) tuples
+    @return: C{str} encoded region set
+    """
+    out = bytearray()
+    packRegions(regions, out)
+    return str(out)
+
+
+def decodeRegions(data):
+    """
+    @return: C{list} of (a, b) tuples
+    """
+    return unpackRegions(bytearray(data), 0)[0]
+
+
+def encodeSelection(selection, previous):
+    """
+    Encode a selection, as a difference to the previous one if that is shorter.
+
+    @param selection: C{list} of (a, b) tuples
+    @param previous: C{list} of (a, b) tuples last sent, or None
+    @return: C{str} encoded selection
+    """
+    out = bytearray(SELECTION_FULL)
+    packRegions(selection, out)
+    if previous is None:
+        return str(out)
+    limit = min(len(selection), len(previous))
+    prefix = 0
+    while (prefix < limit) and (selection[prefix] == previous[prefix]):
+        prefix += 1
+    suffix = 0
+    while (suffix < limit - prefix) and (selection[-1 - suffix] == previous[-1 - suffix]):
+        suffix += 1
+    diff = bytearray(SELECTION_DIFF)
+    encodeVarint(prefix, diff)
+    encodeVarint(suffix, diff)
+    packRegions(selection[prefix:len(selection) - suffix], diff)
+    if len(diff) < len(out):
+        return str(diff)
+    return str(out)
+
+
+def decodeSelection(data, previous):
+    """
+    @param data: C{str} encoded selection
+    @param previous: C{list} of (a, b) tuples last received, or None
+    @return: C{list} of (a, b) tuples
+    """
+    data = bytearray(data)
+    if data[0] == ord(SELECTION_FULL):
+        return unpackRegions(data, 1)[0]
+    prefix, pos = decodeVarint(data, 1)
+    suffix, pos = decodeVarint(data, pos)
+    middle = unpackRegions(data, pos)[0]
+    return previous[:prefix] + middle + previous[len(previous) - suffix:]
@@ -0,0 +1,125 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+import struct, collections, itertools
+
+# Sequence numbers and replay of the messages of a connection, so that a session
+# can be resumed over a new connection when the last one was lost.
+#
+# With FEATURE_RESUME agreed every message but the handshakes is sent with a
+# sequenced header, carrying the number of messages sent before it on the
+# connection.  Both sides keep the latest messages they sent and the number of
+# messages they received, see ReplayBuffer.
+
+# - magicNumber: 10, one up from sub_collab.peer.base.MAGIC_NUMBER
+SEQUENCED_MAGIC_NUMBER = 10
+# magic number, message type, message sub-type and sequence number
+SEQUENCED_HEADER_FMT = '!HBBI'
+SEQUENCED_HEADER_SIZE = struct.calcsize(SEQUENCED_HEADER_FMT)
+# header of the messages the sequenced header replaces, see sub_collab.peer.basic.BasicPeer
+HEADER_FMT = '!HBB'
+HEADER_SIZE = struct.calcsize(HEADER_FMT)
+# RESUME and RESUME_ACK payload: number of messages received and sequence number
+# of the oldest message that can still be replayed
+RESUME_FMT = '!II'
+
+
+def encodeResume(received, oldest):
+    return struct.pack(RESUME_FMT, received, oldest)
+
+
+def decodeResume(payload):
+    """
+    @return: (received, oldest) C{tuple}
+    """
+    return struct.unpack(RESUME_FMT, payload)
+
+
+class ReplayBuffer(object):
+    """
+    The latest messages sent on a connection, in their sequenced form, and the
+    number of messages received.  Oldest messages are dropped once the buffer
+    holds more than maxSize bytes.
+    """
+
+
+    def __init__(self, maxSize):
+        """
+        @param maxSize: C{int} most bytes of messages to keep for replay
+        """
+        self.maxSize = maxSize
+        # number of messages sent and received
+        self.sent = 0
+        self.received = 0
+        self.frames = collections.deque()
+        self.size = 0
+
+
+    def oldest(self):
+        """
+        @return: C{int} sequence number of the oldest message that can be replayed
+        """
+        return self.sent - len(self.frames)
+
+
+    def record(self, frame):
+        """
+        Number a message about to be sent and keep it for replay.
+
+        @param frame: C{str} message with the plain header
+
+        @return: C{str} the message with a sequenced header
+        """
+        magicNumber, messageType, messageSubType = struct.unpack(HEADER_FMT, frame[:HEADER_SIZE])
+        frame = struct.pack(SEQUENCED_HEADER_FMT, SEQUENCED_MAGIC_NUMBER, messageType, messageSubType, self.sent) + frame[HEADER_SIZE:]
+        self.sent += 1
+        self.frames.append(frame)
+        self.size += len(frame)
+        while (self.size > self.maxSize) and (len(self.frames) > 0):
+            self.size -= len(self.frames.popleft())
+        return frame
+
+
+    def since(self, count):
+        """
+        @param count: C{int} number of messages the peer received
+
+        @return: C{list} of the messages the peer did not receive, None if some are no longer kept
+        """
+        oldest = self.oldest()
+        if (count < oldest) or (count > self.sent):
+            return None
+        return list(itertools.islice(self.frames, count - oldest, None))
+
+
+    def accept(self, sequence):
+        """
+        Account for a received message.
+
+        @param sequence: C{int} sequence number of the message
+
+        @return: False if the message was received before
+        """
+        if sequence < self.received:
+            return False
+        # messages the peer could not replay are skipped
+        self.received = sequence + 1
+        return True
@@ -0,0 +1,143 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+import bisect
+
+# Copy of the contents of a shared view as last sent to or received from the peer.
+#
+# The text is kept in chunks of around CHUNK_SIZE characters, so an edit only
+# rebuilds the chunk it falls in and costs about the same whatever the size of
+# the view.  Chunks are never changed in place, which lets snapshots share them.
+
+CHUNK_SIZE = 16384
+
+
+class ShadowText(object):
+    """
+    Text that supports len() and slicing like a C{unicode} string, edited in place
+    with offset-addressed edit operations, see C{sub_collab.peer.editops}.
+    """
+
+    def __init__(self, text=u''):
+        self.chunks = [text[pos:pos + CHUNK_SIZE] for pos in range(0, len(text), CHUNK_SIZE)] or [u'']
+        # character offset of the start of each chunk
+        self.starts = []
+        self.length = len(text)
+        self.restart(0)
+
+
+    def restart(self, first):
+        """
+        Recompute the chunk offsets from the given chunk on.
+        """
+        del self.starts[first:]
+        pos = 0
+        if first > 0:
+            pos = self.starts[first - 1] + len(self.chunks[first - 1])
+        for chunk in self.chunks[first:]:
+            self.starts.append(pos)
+            pos += len(chunk)
+
+
+    def __len__(self):
+        return self.length
+
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            begin, end, step = key.indices(self.length)
+            return self.substr(begin, end)
+        if key < 0:
+            key += self.length
+        return self.substr(key, key + 1)
+
+
+    def chunkAt(self, offset):
+        return max(0, bisect.bisect_right(self.starts, offset) - 1)
+
+
+    def substr(self, begin, end):
+        """
+        @return: C{unicode} text between the given character offsets
+        """
+        begin = max(0, begin)
+        end = min(self.length, end)
+        if begin >= end:
+            return u''
+        first = self.chunkAt(begin)
+        last = self.chunkAt(end - 1)
+        if first == last:
+            return self.chunks[first][begin - self.starts[first]:end - self.starts[first]]
+        pieces = [self.chunks[first][begin - self.starts[first]:]]
+        pieces.extend(self.chunks[first + 1:last])
+        pieces.append(self.chunks[last][:end - self.starts[last]])
+        return u''.join(pieces)
+
+
+    def text(self):
+        """
+        @return: C{unicode} the whole text
+        """
+        return u''.join(self.chunks)
+
+
+    def snapshot(self):
+        """
+        @return: C{ShadowText} copy of the text as it is now, unaffected by later edits
+        """
+        copy = ShadowText()
+        copy.chunks = list(self.chunks)
+        copy.starts = list(self.starts)
+        copy.length = self.length
+        return copy
+
+
+    def edit(self, offset, deleteLength, insertText):
+        """
+        Replace deleteLength characters at offset with insertText.
+        """
+        if (offset < 0) or (offset + deleteLength > self.length):
+            raise ValueError('edit of %d characters at %d out of %d characters' % (deleteLength, offset, self.length))
+        first = self.chunkAt(offset)
+        last = self.chunkAt(offset + deleteLength)
+        merged = self.chunks[first][:offset - self.starts[first]] + insertText + \
+            self.chunks[last][offset + deleteLength - self.starts[last]:]
+        if (len(merged) < CHUNK_SIZE // 4) and (last + 1 < len(self.chunks)):
+            # keep chunks from getting ever smaller
+            last += 1
+            merged += self.chunks[last]
+        if len(merged) > 2 * CHUNK_SIZE:
+            pieces = [merged[pos:pos + CHUNK_SIZE] for pos in range(0, len(merged), CHUNK_SIZE)]
+        elif (len(merged) == 0) and (len(self.chunks) > last - first + 1):
+            pieces = []
+        else:
+            pieces = [merged]
+        self.chunks[first:last + 1] = pieces
+        self.length += len(insertText) - deleteLength
+        self.restart(first)
+
+
+    def applyOps(self, ops):
+        """
+        Apply a list of (offset, deleteLength, insertText) edit operations in order.
+        """
+        for offset, deleteLength, insertText in ops:
+            self.edit(offset, deleteLength, insertText)
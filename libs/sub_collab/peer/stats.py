@@ -0,0 +1,203 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+from sub_collab.peer import base
+import json, os, time
+
+# Counters describing how a session is performing, without any Sublime Text
+# dependencies so that they can be used outside of the editor as well.
+#
+# The round trip time of PING messages measures the connection and the reactor
+# of the peer, while the apply timings measure how long view changes received
+# wait for, and then take on, the main UI event loop.  A slow round trip with
+# quick apply timings points at the network, the other way around at the editor.
+
+# weight of the latest sample in the smoothed averages, as used for the TCP round trip time
+SMOOTHING = 0.125
+
+
+class Timing(object):
+    """
+    Latest, smallest, largest and smoothed average of a series of durations.
+    """
+
+
+    def __init__(self):
+        self.count = 0
+        self.last = None
+        self.min = None
+        self.max = None
+        self.average = None
+
+
+    def record(self, seconds):
+        self.count += 1
+        self.last = seconds
+        if self.count == 1:
+            self.min = self.max = self.average = seconds
+        else:
+            self.min = min(self.min, seconds)
+            self.max = max(self.max, seconds)
+            self.average += SMOOTHING * (seconds - self.average)
+
+
+    def snapshot(self):
+        """
+        @return: C{dict} of the timings in milliseconds, None where nothing was recorded yet
+        """
+        def millis(seconds):
+            if seconds is None:
+                return None
+            return round(seconds * 1000.0, 2)
+        return {
+            'count': self.count,
+            'last': millis(self.last),
+            'min': millis(self.min),
+            'max': millis(self.max),
+            'average': millis(self.average)
+        }
+
+
+class SessionStats(object):
+    """
+    Traffic and timings of a single session.
+    """
+
+
+    def __init__(self):
+        self.started = time.time()
+        # message type -> [frames, bytes], headers included
+        self.sent = {}
+        self.received = {}
+        # round trip of PING messages
+        self.roundTrip = Timing()
+        # from queueing the first change of a batch to handling the batch
+        self.applyWait = Timing()
+        # handling a batch of view changes
+        self.applyTime = Timing()
+        self.queueDepth = 0
+        self.maxQueueDepth = 0
+        # host-side views (re)sent in full or as a delta, partner-side resyncs asked for
+        self.resyncs = 0
+        # partner-side hash tree blocks replaced with the host contents
+        self.repairs = 0
+
+
+    def countSent(self, messageType, size):
+        counts = self.sent.setdefault(messageType, [0, 0])
+        counts[0] += 1
+        counts[1] += size
+
+
+    def countReceived(self, messageType, size):
+        counts = self.received.setdefault(messageType, [0, 0])
+        counts[0] += 1
+        counts[1] += size
+
+
+    def recordBatch(self, waited, took, depth):
+        """
+        @param waited: C{float} seconds the batch waited for the main UI event loop
+        @param took: C{float} seconds taken to apply the batch
+        @param depth: C{int} number of queued changes in the batch
+        """
+        self.applyWait.record(waited)
+        self.applyTime.record(took)
+        self.queueDepth = depth
+        self.maxQueueDepth = max(self.maxQueueDepth, depth)
+
+
+    def snapshot(self):
+        """
+        @return: C{dict} of all counters, ready to be serialized as JSON
+        """
+        def byType(counts):
+            return dict([(base.numeric_to_symbolic.get(messageType, str(messageType)), {'frames': frames, 'bytes': size}) \
+                for messageType, (frames, size) in counts.items()])
+        def total(counts):
+            return {
+                'frames': sum([frames for frames, size in counts.values()]),
+                'bytes': sum([size for frames, size in counts.values()])
+            }
+        return {
+            'uptime': round(time.time() - self.started, 1),
+            'sent': byType(self.sent),
+            'received': byType(self.received),
+            'sentTotal': total(self.sent),
+            'receivedTotal': total(self.received),
+            'roundTrip': self.roundTrip.snapshot(),
+            'applyWait': self.applyWait.snapshot(),
+            'applyTime': self.applyTime.snapshot(),
+            'queueDepth': self.queueDepth,
+            'maxQueueDepth': self.maxQueueDepth,
+            'resyncs': self.resyncs,
+            'repairs': self.repairs
+        }
+
+
+def formatSnapshot(name, snapshot):
+    """
+    @param name: C{str} session label
+    @param snapshot: C{dict} from SessionStats.snapshot(), with the session details BasicPeer.getStats() adds
+
+    @return: C{list} of C{str} lines describing the session
+    """
+    def timing(label, values):
+        if values['count'] == 0:
+            return '  %-12s -' % label
+        return '  %-12s last %.1f ms, avg %.1f ms, min %.1f ms, max %.1f ms (%d)' % \
+            (label, values['last'], values['average'], values['min'], values['max'], values['count'])
+    lines = [
+        '%s [%s, %s, up %ds]' % (name, snapshot.get('role'), snapshot.get('state'), snapshot['uptime']),
+        timing('round trip', snapshot['roundTrip']),
+        timing('apply wait', snapshot['applyWait']),
+        timing('apply time', snapshot['applyTime']),
+        '  %-12s %d, max %d' % ('queue depth', snapshot['queueDepth'], snapshot['maxQueueDepth']),
+        '  %-12s %d resyncs, %d block repairs' % ('resyncs', snapshot['resyncs'], snapshot['repairs']),
+        '  %-12s %d frames, %d bytes sent / %d frames, %d bytes received' % ('traffic', \
+            snapshot['sentTotal']['frames'], snapshot['sentTotal']['bytes'], \
+            snapshot['receivedTotal']['frames'], snapshot['receivedTotal']['bytes'])
+    ]
+    for messageType in sorted(set(snapshot['sent'].keys()) | set(snapshot['received'].keys())):
+        sent = snapshot['sent'].get(messageType, {'frames': 0, 'bytes': 0})
+        received = snapshot['received'].get(messageType, {'frames': 0, 'bytes': 0})
+        lines.append('    %-18s %7d frames %10d bytes out  %7d frames %10d bytes in' % \
+            (messageType, sent['frames'], sent['bytes'], received['frames'], received['bytes']))
+    return lines
+
+
+def dump(path, snapshots):
+    """
+    Write session snapshots to a JSON file, replacing the previous dump in one go.
+
+    @param path: C{str} file to write
+    @param snapshots: C{dict} of session label to snapshot
+    """
+    tmpPath = path + '.tmp'
+    dumpFile = open(tmpPath, 'w')
+    try:
+        json.dump({'time': time.time(), 'sessions': snapshots}, dumpFile, indent=2, sort_keys=True)
+    finally:
+        dumpFile.close()
+    if os.name == 'nt' and os.path.exists(path):
+        # rename does not replace on windows
+        os.remove(path)
+    os.rename(tmpPath, path)
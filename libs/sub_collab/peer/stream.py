@@ -0,0 +1,374 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+from zope.interface import implements
+from sub_collab.peer import base, delta, hashtree
+from twisted.internet import interfaces
+import logging, zlib, collections
+
+# Producers streaming shared views over a connection, without any Sublime Text
+# dependencies so that they can be used outside of the editor as well.
+
+# in bytes
+MAX_CHUNK_SIZE = 1024
+# in characters, chunk size used when the view stream is compressed
+MAX_COMPRESSED_CHUNK_SIZE = 16384
+# in bytes, most VIEW_CHUNK payload sent but not yet acknowledged by the partner
+VIEW_STREAM_WINDOW = 262144
+
+
+class ViewStreamProducer(object):
+    """
+    Streams a snapshot of the view contents to the partner as VIEW_CHUNK messages,
+    followed by END_OF_VIEW.
+
+    At most VIEW_STREAM_WINDOW bytes of chunks are left unacknowledged, every
+    VIEW_CHUNK_ACK from the partner opens the window again.  As a streaming
+    producer of the transport it is also paused while the transport write
+    buffer is full.  Runs on the reactor thread.
+    """
+    implements(interfaces.IPushProducer)
+
+    logger = logging.getLogger('SubliminalCollaborator.ViewStreamProducer')
+
+
+    def __init__(self, peer, text, chunkSize, syntax, onFinished):
+        """
+        @param peer: C{BasicPeer} or other protocol instance the view is streamed by
+        @param text: C{unicode} or C{shadow.ShadowText} view contents to send
+        @param chunkSize: C{int} number of characters per VIEW_CHUNK
+        @param syntax: C{str} END_OF_VIEW payload
+        @param onFinished: callable invoked once END_OF_VIEW has been sent
+        """
+        self.peer = peer
+        self.text = text
+        self.totalToSend = len(text)
+        self.chunkSize = chunkSize
+        self.syntax = syntax
+        self.onFinished = onFinished
+        self.begin = 0
+        self.unacked = 0
+        self.paused = False
+        self.done = False
+
+
+    def start(self):
+        self.peer.streamProducers.add(self)
+        self.produce()
+
+
+    def produce(self):
+        """
+        Send chunks until the window is full, the transport is paused or the view is sent.
+        """
+        while (not self.paused) and (not self.done) \
+                and (self.begin < self.totalToSend) \
+                and (self.unacked < VIEW_STREAM_WINDOW):
+            self.unacked += self.peer.sendViewChunk(self.text[self.begin:self.begin + self.chunkSize])
+            self.begin = self.begin + self.chunkSize
+            self.peer.viewStreamProgress(min(self.begin, self.totalToSend), self.totalToSend)
+        if (not self.done) and (self.begin >= self.totalToSend):
+            self.done = True
+            self.text = None
+            self.peer.streamProducers.remove(self)
+            self.peer.writeMessage(base.END_OF_VIEW, payload=self.syntax)
+            self.onFinished()
+
+
+    def chunkAcked(self, size):
+        self.unacked -= size
+        self.produce()
+
+
+    #*** interfaces.IPushProducer method implementations ***#
+
+    def pauseProducing(self):
+        self.paused = True
+
+
+    def resumeProducing(self):
+        self.paused = False
+        self.produce()
+
+
+    def stopProducing(self):
+        self.logger.debug('View stream stopped after %d of %d characters' % (self.begin, self.totalToSend))
+        self.done = True
+
+
+class StreamProducerGroup(object):
+    """
+    The streaming producer registered with the transport of a connection, passing
+    its pause and resume calls on to all view streams sharing that connection.
+    """
+    implements(interfaces.IPushProducer)
+
+
+    def __init__(self):
+        self.producers = set()
+        self.paused = False
+
+
+    def add(self, producer):
+        self.producers.add(producer)
+        if self.paused:
+            producer.pauseProducing()
+
+
+    def remove(self, producer):
+        self.producers.discard(producer)
+
+
+    def pauseProducing(self):
+        self.paused = True
+        for producer in list(self.producers):
+            producer.pauseProducing()
+
+
+    def resumeProducing(self):
+        self.paused = False
+        for producer in list(self.producers):
+            producer.resumeProducing()
+
+
+    def stopProducing(self):
+        for producer in list(self.producers):
+            producer.stopProducing()
+        self.producers.clear()
+        # view streams of a resumed connection start unpaused
+        self.paused = False
+
+
+class BacklogProducer(object):
+    """
+    Registered with the transport of a connection to write its backlog of
+    frames, once the transport has room for it again.
+    """
+    implements(interfaces.IPushProducer)
+
+
+    def __init__(self, connection):
+        """
+        @param connection: C{FollowerStream} or other object with a drainBacklog() method
+        """
+        self.connection = connection
+
+
+    def pauseProducing(self):
+        pass
+
+
+    def resumeProducing(self):
+        self.connection.drainBacklog()
+
+
+    def stopProducing(self):
+        pass
+
+
+class FollowerStream(object):
+    """
+    Frames of a view shared with many followers, the watchers of a broadcast or
+    the partners of a relay room, as written to one of them.
+
+    Frames encoded once for all followers are handed to each as the same
+    length-prefixed C{str}.  Frames the transport has no room for are kept in a
+    backlog, and frames sent while the follower is sent a snapshot of the view are
+    held back until it acknowledges the snapshot.  A follower whose backlog or held
+    frames grow beyond maxBacklog bytes is dropped, frames are ignored until it is
+    sent a new snapshot once its transport has caught up.  Runs on the reactor thread.
+    """
+    logger = logging.getLogger('SubliminalCollaborator.FollowerStream')
+
+
+    def __init__(self, connection, maxBacklog):
+        """
+        @param connection: protocol instance of the follower, with a transport, a
+        C{StreamProducerGroup} as streamProducers, a str() method, a writeData()
+        method writing length-prefixed data through write() and a requestSnapshot()
+        method asking for a new snapshot of the view, see beginSnapshot()
+        @param maxBacklog: C{int} most bytes the follower may fall behind by
+        """
+        self.connection = connection
+        self.maxBacklog = maxBacklog
+        # length-prefixed frames waiting for room in the transport
+        self.backlog = collections.deque()
+        self.backlogSize = 0
+        # frames held back while a snapshot is sent, None if not sending one
+        self.heldFrames = None
+        self.heldSize = 0
+        # sent frames since the last snapshot
+        self.watching = False
+        # fell behind, frames are ignored until the next snapshot
+        self.dropped = False
+        # a snapshot is about to be sent
+        self.snapshotPending = False
+
+
+    def write(self, data):
+        """
+        Write length-prefixed data to the transport, or to the backlog if the
+        transport is full or there is a backlog already.
+        """
+        if (len(self.backlog) > 0) or self.connection.streamProducers.paused:
+            self.backlog.append(data)
+            self.backlogSize += len(data)
+        else:
+            self.connection.transport.write(data)
+
+
+    def drainBacklog(self):
+        """
+        Write the backlog for as long as the transport has room for it.
+        """
+        while (len(self.backlog) > 0) and (not self.connection.streamProducers.paused):
+            data = self.backlog.popleft()
+            self.backlogSize -= len(data)
+            self.connection.transport.write(data)
+        if self.dropped and (self.heldFrames is None) and (not self.snapshotPending) \
+                and (not self.connection.streamProducers.paused):
+            self.connection.requestSnapshot()
+
+
+    def sendFrame(self, data):
+        """
+        Send a frame encoded once for all followers.
+
+        @param data: C{str} length-prefixed frame
+        """
+        if (not self.watching) or self.dropped:
+            return
+        if self.heldFrames is not None:
+            self.heldFrames.append(data)
+            self.heldSize += len(data)
+            if self.heldSize > self.maxBacklog:
+                self.dropBehind()
+        else:
+            self.connection.writeData(data)
+            if self.backlogSize > self.maxBacklog:
+                self.dropBehind()
+
+
+    def dropBehind(self):
+        """
+        Stop sending frames to the follower, it is sent a new snapshot of the view
+        once its transport has caught up.
+        """
+        self.logger.info('%s fell behind by %d bytes, resending the view' % (self.connection.str(), max(self.heldSize, self.backlogSize)))
+        self.dropped = True
+        # superseded by the snapshot
+        self.backlog.clear()
+        self.backlogSize = 0
+        if self.heldFrames is not None:
+            # a snapshot is being sent, the new one follows once it is acknowledged
+            self.heldFrames = []
+            self.heldSize = 0
+        elif not self.connection.streamProducers.paused:
+            self.connection.requestSnapshot()
+
+
+    def beginSnapshot(self, frames):
+        """
+        Hold back frames from here on until the follower acknowledges the snapshot
+        about to be sent, see endSnapshot().
+
+        @param frames: C{list} of length-prefixed frames to send right after the snapshot
+
+        @return: True if the snapshot is to be sent now, False if one is being sent
+        already, the new one is then requested once that one is acknowledged
+        """
+        self.snapshotPending = False
+        if self.heldFrames is not None:
+            # the one being sent is out of date
+            self.dropped = True
+            self.heldFrames = []
+            self.heldSize = 0
+            return False
+        self.watching = True
+        self.dropped = False
+        self.heldFrames = list(frames)
+        self.heldSize = 0
+        return True
+
+
+    def endSnapshot(self):
+        """
+        The follower acknowledged the snapshot, send it the frames held back since.
+        """
+        heldFrames = self.heldFrames
+        self.heldFrames = None
+        self.heldSize = 0
+        if self.dropped:
+            self.connection.requestSnapshot()
+            return
+        for data in heldFrames:
+            self.connection.writeData(data)
+
+
+    def answersQueries(self):
+        """
+        @return: True if the follower is in step with the shared view, queries sent
+        before a snapshot are replaced by it
+        """
+        return (self.heldFrames is None) and (not self.dropped) and (not self.snapshotPending)
+
+
+    def answerQuery(self, messageType, payload, view, compressionLevel, maxPayloadSize):
+        """
+        Answer a VIEW_RESYNC, VIEW_TREE_QUERY or VIEW_RANGE_QUERY of the follower
+        from the shared view, or send it a snapshot instead if that is smaller.
+
+        @param view: object with currentText() and currentTree() methods, returning the
+        C{shadow.ShadowText} and C{hashtree.HashTree} of the view as the follower will have it
+        @param compressionLevel: C{int} zlib level of compressed replies, None to not compress them
+        @param maxPayloadSize: C{int} largest payload the follower accepts
+
+        @return: C{tuple} of the message type and payload of the reply, or None if there is none
+        """
+        if not self.answersQueries():
+            return None
+        if messageType == base.VIEW_TREE_QUERY:
+            return (base.VIEW_TREE_NODES, hashtree.encodeNodes(view.currentTree(), hashtree.decodeNodeIds(payload)))
+        if messageType == base.VIEW_RANGE_QUERY:
+            tree = view.currentTree()
+            reply = (base.VIEW_RANGE, hashtree.encodeLeaves(tree, view.currentText(), hashtree.decodeLeafIndexes(payload)))
+        elif len(payload) == 0:
+            self.connection.requestSnapshot()
+            return None
+        else:
+            textLength, blockSize, sigs = delta.decodeSignature(payload)
+            reply = (base.VIEW_DELTA, delta.encodeDelta(delta.computeDelta(view.currentText().text(), textLength, blockSize, sigs)))
+        if compressionLevel is not None:
+            reply = (reply[0], zlib.compress(reply[1], compressionLevel))
+        if len(reply[1]) > maxPayloadSize:
+            self.connection.requestSnapshot()
+            return None
+        return reply
+
+
+    def reset(self):
+        """
+        Forget everything waiting to be written, once the connection is lost.
+        """
+        self.backlog.clear()
+        self.backlogSize = 0
+        self.heldFrames = None
+        self.heldSize = 0
@@ -0,0 +1,95 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+"""
+Randomized tests of the rsync-style delta transfer of view contents.
+
+Run as described in testutil.
+"""
+import random, unittest
+
+import testutil
+from sub_collab.peer import delta
+
+ROUNDS = 300
+
+
+def editText(rand, text):
+    """
+    Apply a few random edits to text.
+    """
+    for i in range(rand.randint(1, 4)):
+        offset, deleteLength, insertText = testutil.randomEdit(rand, text, 30)
+        text = text[:offset] + insertText + text[offset + deleteLength:]
+    return text
+
+
+class DeltaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rand = random.Random(1)
+
+
+    def roundTrip(self, basis, text, blockSize):
+        """
+        Sign basis, describe text against the decoded signature and rebuild text
+        from basis with the decoded delta.
+        """
+        textLength, blockSize, sigs = delta.decodeSignature(
+            delta.encodeSignature(len(basis), blockSize, delta.signature(basis, blockSize)))
+        self.assertEqual(textLength, len(basis))
+        instructions = delta.decodeDelta(delta.encodeDelta(delta.computeDelta(text, textLength, blockSize, sigs)))
+        self.assertEqual(delta.applyDelta(basis, blockSize, instructions), text)
+        return instructions
+
+
+    def test_editedText(self):
+        for i in range(ROUNDS):
+            basis = testutil.randomText(self.rand, 1000)
+            self.roundTrip(basis, editText(self.rand, basis), self.rand.randint(1, 40))
+
+
+    def test_unrelatedText(self):
+        for i in range(ROUNDS):
+            self.roundTrip(testutil.randomText(self.rand, 300), testutil.randomText(self.rand, 300), self.rand.randint(1, 40))
+
+
+    def test_movedBlocks(self):
+        for i in range(ROUNDS):
+            basis = testutil.randomText(self.rand, 600)
+            cut = self.rand.randint(0, len(basis))
+            self.roundTrip(basis, basis[cut:] + basis[:cut], self.rand.randint(1, 40))
+
+
+    def test_sameTextIsCopied(self):
+        for i in range(ROUNDS):
+            basis = testutil.randomText(self.rand, 1000)
+            instructions = self.roundTrip(basis, basis, self.rand.randint(1, 40))
+            self.assertEqual([instruction for instruction in instructions if instruction[0] == delta.LITERAL], [])
+
+
+    def test_blockSizeFor(self):
+        self.assertEqual(delta.blockSizeFor(0), delta.MIN_BLOCK_SIZE)
+        self.assertEqual(delta.blockSizeFor(10 ** 12), delta.MAX_BLOCK_SIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()
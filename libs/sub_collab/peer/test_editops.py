@@ -0,0 +1,147 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+"""
+Randomized tests of the offset-addressed edit operations.
+
+Run as described in testutil.
+"""
+import random, unittest
+
+import testutil
+from sub_collab.peer import editops
+
+ROUNDS = 300
+
+
+class DiffTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rand = random.Random(1)
+
+
+    def test_diffRoundTrip(self):
+        for i in range(ROUNDS):
+            oldText = testutil.randomText(self.rand, 600)
+            newText = testutil.randomText(self.rand, 600)
+            self.assertEqual(editops.applyOps(oldText, editops.diffText(oldText, newText)), newText)
+
+
+    def test_diffOfEditedText(self):
+        # long texts with a few scattered edits, which diffText splits around anchors
+        for i in range(ROUNDS):
+            oldText = u''.join([self.rand.choice([u'line %d\n' % n, u'\t\xe9\n']) for n in range(300)])
+            newText = oldText
+            for j in range(self.rand.randint(1, 5)):
+                offset, deleteLength, insertText = testutil.randomEdit(self.rand, newText)
+                newText = newText[:offset] + insertText + newText[offset + deleteLength:]
+            ops = editops.diffText(oldText, newText)
+            self.assertEqual(editops.applyOps(oldText, ops), newText)
+            self.assertTrue(sum([deleteLength for offset, deleteLength, insertText in ops]) <= len(oldText))
+
+
+    def test_diffWithOffset(self):
+        for i in range(ROUNDS):
+            text = testutil.randomText(self.rand, 200)
+            begin = self.rand.randint(0, len(text))
+            end = self.rand.randint(begin, len(text))
+            newMid = testutil.randomText(self.rand, 50)
+            ops = editops.diffText(text[begin:end], newMid, begin)
+            self.assertEqual(editops.applyOps(text, ops), text[:begin] + newMid + text[end:])
+
+
+    def test_diffEqualText(self):
+        self.assertEqual(editops.diffText(u'abc', u'abc'), [])
+        self.assertEqual(editops.diffText(u'', u''), [])
+
+
+class EncodeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rand = random.Random(2)
+
+
+    def test_encodeRoundTrip(self):
+        for i in range(ROUNDS):
+            ops = [testutil.randomEdit(self.rand, u'x' * 100) for j in range(self.rand.randint(0, 5))]
+            self.assertEqual(editops.decodeOps(editops.encodeOps(ops)), ops)
+
+
+    def test_packOps(self):
+        for i in range(ROUNDS):
+            oldText = testutil.randomText(self.rand, 300)
+            newText = testutil.randomText(self.rand, 300)
+            maxPayloadSize = self.rand.randint(editops.OP_HEADER_SIZE + 4, 200)
+            text = oldText
+            for payload in editops.packOps(editops.diffText(oldText, newText), maxPayloadSize):
+                # a payload may only exceed the limit when it holds a single operation
+                ops = editops.decodeOps(payload)
+                self.assertTrue((len(payload) <= maxPayloadSize) or (len(ops) == 1))
+                text = editops.applyOps(text, ops)
+            self.assertEqual(text, newText)
+
+
+class SpanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rand = random.Random(3)
+
+
+    def test_spansHoldAllEdits(self):
+        # diffing each span of the edited text against the matching range of the
+        # original, back to front, has to give the edited text
+        for i in range(ROUNDS):
+            original = testutil.randomText(self.rand, 400)
+            text = original
+            spans = []
+            for j in range(self.rand.randint(1, 30)):
+                offset, deleteLength, insertText = testutil.randomEdit(self.rand, text)
+                text = text[:offset] + insertText + text[offset + deleteLength:]
+                # spans may reach further than the edit itself
+                begin = max(0, offset - self.rand.randint(0, 3))
+                end = min(len(text), offset + len(insertText) + self.rand.randint(0, 3))
+                spans = editops.addSpan(spans, begin, end, len(insertText) - deleteLength)
+            self.assertEqual(sum([span[2] for span in spans]), len(text) - len(original))
+            ops = []
+            shift = len(text) - len(original)
+            for begin, end, sizeDelta in reversed(spans):
+                shift -= sizeDelta
+                self.assertTrue(0 <= begin <= end <= len(text))
+                ops.extend(editops.diffText(original[begin - shift:end - shift - sizeDelta], text[begin:end], begin - shift))
+            self.assertEqual(editops.applyOps(original, ops), text)
+
+
+    def test_spansStaySortedAndApart(self):
+        for i in range(ROUNDS):
+            spans = []
+            length = 1000
+            for j in range(self.rand.randint(1, 30)):
+                begin = self.rand.randint(0, length)
+                sizeDelta = self.rand.randint(-min(10, length - begin), 10)
+                end = min(length + sizeDelta, begin + max(0, sizeDelta) + self.rand.randint(0, 5))
+                spans = editops.addSpan(spans, begin, end, sizeDelta)
+                length += sizeDelta
+            for previous, span in zip(spans, spans[1:]):
+                self.assertTrue(previous[1] < span[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
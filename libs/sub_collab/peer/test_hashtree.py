@@ -0,0 +1,141 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+"""
+Randomized tests of the incremental update of the content-defined hash tree.
+
+Run as described in testutil.
+"""
+import random, unittest
+
+import testutil
+from sub_collab.peer import hashtree
+
+STEPS = 600
+
+# a few lines repeat a lot, like braces and blank lines in code
+WORDS = [u'a', u'bb', u'}', u'    x = 1', u'', u'def f():', u'\xe9t\xe9']
+
+
+def scratch(text):
+    """
+    @return: L{HashTree} built from scratch
+    """
+    tree = hashtree.HashTree()
+    tree.update(text)
+    return tree
+
+
+class HashTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rand = random.Random(1)
+        self.readSize = hashtree.READ_SIZE
+
+
+    def tearDown(self):
+        hashtree.READ_SIZE = self.readSize
+
+
+    def randomLine(self, numbered):
+        if numbered:
+            return u'%s%d\n' % (self.rand.choice(WORDS), self.rand.randint(0, 999))
+        return self.rand.choice(WORDS) + u'\n'
+
+
+    def randomLines(self, count, numbered):
+        return u''.join([self.randomLine(numbered) for i in range(count)])
+
+
+    def checkIncremental(self, numbered):
+        """
+        Edit a random text and check the incrementally updated tree against one
+        built from scratch.
+        """
+        text = self.randomLines(self.rand.randint(0, 4000), numbered)
+        tree = scratch(text)
+        for step in range(STEPS):
+            offset = self.rand.randint(0, len(text))
+            insertText = self.rand.choice([u'', u'q', u'\n', u'zz\nyy', self.randomLines(self.rand.randint(0, 80), numbered)])
+            if self.rand.random() < 0.6:
+                # replace about as much as is inserted, like typing over a selection
+                deleteLength = max(0, len(insertText) + self.rand.randint(-3, 3))
+            else:
+                deleteLength = self.rand.choice([0, 0, 0, 1, 3, 40, 200])
+            deleteLength = min(deleteLength, len(text) - offset)
+            tree.markEdit(offset, text[offset:offset + deleteLength], insertText)
+            text = text[:offset] + insertText + text[offset + deleteLength:]
+            if self.rand.random() < 0.3:
+                tree.update(text)
+                expected = scratch(text)
+                self.assertEqual(tree.leafStarts, expected.leafStarts)
+                self.assertEqual(tree.levels, expected.levels)
+                self.assertEqual(tree.state(), expected.state())
+
+
+    def test_incrementalRepetitiveLines(self):
+        self.checkIncremental(False)
+
+
+    def test_incrementalNumberedLines(self):
+        self.checkIncremental(True)
+
+
+    def test_incrementalSmallReads(self):
+        # leaves are read in pieces, check boundaries falling on and around the piece ends
+        for readSize in (5, 97):
+            hashtree.READ_SIZE = readSize
+            self.checkIncremental(False)
+            self.checkIncremental(True)
+
+
+    def test_editKeepsOtherLeaves(self):
+        text = self.randomLines(20000, True)
+        tree = scratch(text)
+        for step in range(50):
+            leaves = set(tree.levels[0])
+            offset = text.find(u'\n', self.rand.randint(0, len(text) - 1)) + 1
+            insertText = self.randomLines(self.rand.randint(1, 3), True)
+            tree.markEdit(offset, u'', insertText)
+            text = text[:offset] + insertText + text[offset:]
+            tree.update(text)
+            self.assertTrue(len(set(tree.levels[0]) - leaves) <= 4)
+
+
+    def test_emptyText(self):
+        tree = scratch(u'')
+        self.assertEqual(tree.leafCount(), 1)
+        tree.markEdit(0, u'', u'a\nb')
+        tree.update(u'a\nb')
+        self.assertEqual(tree.state(), scratch(u'a\nb').state())
+
+
+    def test_encodeLeaves(self):
+        text = self.randomLines(3000, True)
+        tree = scratch(text)
+        leaves = self.rand.sample(range(tree.leafCount()), min(5, tree.leafCount()))
+        state, decoded = hashtree.decodeLeaves(hashtree.encodeLeaves(tree, text, leaves))
+        self.assertEqual(state, hashtree.decodeState(tree.state()))
+        self.assertEqual(decoded, [(leaf, tree.leafText(text, leaf)) for leaf in leaves])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+"""
+Randomized tests of the operational transformation of concurrent edits.
+
+Run as described in testutil.
+"""
+import random, unittest
+
+import testutil
+from sub_collab.peer import editops, ot
+
+ROUNDS = 500
+# longest texts the operations are tried on
+TEXT_LENGTH = 40
+
+
+def randomOperation(rand, length):
+    """
+    @return: C{list} operation of a text of the given length, with a few edits
+    """
+    operation = []
+    pos = 0
+    while pos < length:
+        count = rand.randint(1, length - pos)
+        kind = rand.random()
+        if kind < 0.5:
+            ot.retain(operation, count)
+        elif kind < 0.75:
+            ot.delete(operation, count)
+        else:
+            ot.insert(operation, testutil.randomText(rand, 5))
+            continue
+        pos += count
+    if rand.random() < 0.3:
+        ot.insert(operation, testutil.randomText(rand, 5))
+    return operation
+
+
+class TransformTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rand = random.Random(1)
+
+
+    def test_transformConverges(self):
+        for i in range(ROUNDS):
+            text = testutil.randomText(self.rand, TEXT_LENGTH)
+            a = randomOperation(self.rand, len(text))
+            b = randomOperation(self.rand, len(text))
+            aPrime, bPrime = ot.transform(a, b)
+            self.assertEqual(ot.apply(ot.apply(text, a), bPrime), ot.apply(ot.apply(text, b), aPrime))
+            # the same with the other operation winning ties
+            bPrime, aPrime = ot.transform(b, a)
+            self.assertEqual(ot.apply(ot.apply(text, a), bPrime), ot.apply(ot.apply(text, b), aPrime))
+
+
+    def test_composeAppliesBoth(self):
+        for i in range(ROUNDS):
+            text = testutil.randomText(self.rand, TEXT_LENGTH)
+            a = randomOperation(self.rand, len(text))
+            b = randomOperation(self.rand, ot.targetLength(a))
+            self.assertEqual(ot.apply(text, ot.compose(a, b)), ot.apply(ot.apply(text, a), b))
+
+
+    def test_editOpsRoundTrip(self):
+        for i in range(ROUNDS):
+            oldText = testutil.randomText(self.rand, TEXT_LENGTH)
+            newText = testutil.randomText(self.rand, TEXT_LENGTH)
+            operation = ot.fromOps(editops.diffText(oldText, newText), len(oldText))
+            self.assertEqual(ot.apply(oldText, operation), newText)
+            self.assertEqual(editops.applyOps(oldText, ot.toOps(operation)), newText)
+
+
+    def test_encodeRoundTrip(self):
+        for i in range(ROUNDS):
+            operation = randomOperation(self.rand, self.rand.randint(0, 100))
+            self.assertEqual(ot.decodeOperation(ot.encodeOperation(operation)), operation)
+
+
+    def test_lengthMismatch(self):
+        self.assertRaises(ValueError, ot.apply, u'abc', [2])
+        self.assertRaises(ValueError, ot.transform, [2], [3])
+        self.assertRaises(ValueError, ot.compose, [2], [3])
+
+
+class EditStateTest(unittest.TestCase):
+    """
+    Two sides editing the same text at the same time, with the operations of each
+    side delivered to the other after random delays.
+    """
+
+    def test_concurrentEditsConverge(self):
+        rand = random.Random(2)
+        for i in range(ROUNDS / 5):
+            text = testutil.randomText(rand, TEXT_LENGTH)
+            texts = [text, text]
+            states = [ot.EditState(True), ot.EditState(False)]
+            # messages in flight to each side: (sent, received, operation)
+            inFlight = [[], []]
+            for step in range(rand.randint(1, 30)):
+                side = rand.randint(0, 1)
+                if (rand.random() < 0.5) or (len(inFlight[side]) == 0):
+                    operation = randomOperation(rand, len(texts[side]))
+                    texts[side] = ot.apply(texts[side], operation)
+                    sent, received = states[side].local(operation)
+                    inFlight[1 - side].append((sent, received, operation))
+                else:
+                    sent, received, operation = inFlight[side].pop(0)
+                    texts[side] = ot.apply(texts[side], states[side].remote(operation, sent, received))
+            for side in (0, 1):
+                while len(inFlight[side]) > 0:
+                    sent, received, operation = inFlight[side].pop(0)
+                    texts[side] = ot.apply(texts[side], states[side].remote(operation, sent, received))
+            self.assertEqual(texts[0], texts[1])
+
+
+    def test_outOfOrderOperation(self):
+        state = ot.EditState(True)
+        self.assertRaises(ValueError, state.remote, [u'x'], 1, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
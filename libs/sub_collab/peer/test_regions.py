@@ -0,0 +1,106 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+"""
+Randomized tests of the compact encoding of region sets and selections.
+
+Run as described in testutil.
+"""
+import random, unittest
+
+import testutil
+from sub_collab.peer import regions
+
+ROUNDS = 1000
+
+
+def randomRegions(rand, count):
+    """
+    @return: C{list} of (a, b) tuples, mostly sorted carets and selections
+    with an occasional reversed or out of order one
+    """
+    result = []
+    pos = 0
+    for i in range(count):
+        pos += rand.randint(0, 200)
+        a = pos
+        b = pos + rand.choice([0, 0, rand.randint(1, 50), -rand.randint(0, a)])
+        if rand.random() < 0.05:
+            a = rand.randint(0, 2 ** 31)
+        result.append((a, b))
+        pos = max(a, b)
+    return result
+
+
+class RegionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rand = random.Random(1)
+
+
+    def test_zigzag(self):
+        for value in range(-1000, 1000) + [2 ** 31, -2 ** 31, 2 ** 40]:
+            self.assertTrue(regions.zigzag(value) >= 0)
+            self.assertEqual(regions.unzigzag(regions.zigzag(value)), value)
+
+
+    def test_varint(self):
+        values = [0, 1, 0x7f, 0x80, 0x3fff, 0x4000, 2 ** 32 - 1, 2 ** 40] + [self.rand.randint(0, 2 ** 32) for i in range(ROUNDS)]
+        out = bytearray()
+        for value in values:
+            regions.encodeVarint(value, out)
+        pos = 0
+        for value in values:
+            decoded, pos = regions.decodeVarint(out, pos)
+            self.assertEqual(decoded, value)
+        self.assertEqual(pos, len(out))
+
+
+    def test_regionsRoundTrip(self):
+        for i in range(ROUNDS):
+            regionSet = randomRegions(self.rand, self.rand.randint(0, 30))
+            self.assertEqual(regions.decodeRegions(regions.encodeRegions(regionSet)), regionSet)
+
+
+    def test_selectionRoundTrip(self):
+        previous = None
+        for i in range(ROUNDS):
+            if (previous is None) or (self.rand.random() < 0.2):
+                selection = randomRegions(self.rand, self.rand.randint(0, 30))
+            else:
+                # change a few regions of the previous selection, like moving some of many cursors
+                selection = list(previous)
+                for j in range(self.rand.randint(0, 3)):
+                    idx = self.rand.randint(0, len(selection))
+                    selection[idx:idx + self.rand.randint(0, 2)] = randomRegions(self.rand, self.rand.randint(0, 2))
+            data = regions.encodeSelection(selection, previous)
+            self.assertEqual(regions.decodeSelection(data, previous), selection)
+            self.assertTrue(len(data) <= len(regions.encodeSelection(selection, None)))
+            previous = selection
+
+
+    def test_sortedCaretsAreSmall(self):
+        carets = [(pos * 40, pos * 40) for pos in range(1000)]
+        self.assertTrue(len(regions.encodeRegions(carets)) <= 3 * len(carets))
+
+
+if __name__ == '__main__':
+    unittest.main()
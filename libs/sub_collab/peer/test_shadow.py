@@ -0,0 +1,106 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+"""
+Randomized tests of the chunked shadow copy of a shared view, against a plain string.
+
+Run as described in testutil.
+"""
+import random, unittest
+
+import testutil
+from sub_collab.peer import editops, shadow
+
+
+class ShadowTextTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rand = random.Random(1)
+        # small chunks, so that edits keep splitting and merging them
+        self.chunkSize = shadow.CHUNK_SIZE
+        shadow.CHUNK_SIZE = 16
+
+
+    def tearDown(self):
+        shadow.CHUNK_SIZE = self.chunkSize
+
+
+    def assertSameText(self, shadowText, text):
+        self.assertEqual(len(shadowText), len(text))
+        self.assertEqual(shadowText.text(), text)
+        for i in range(10):
+            begin = self.rand.randint(0, len(text))
+            end = self.rand.randint(begin, len(text))
+            self.assertEqual(shadowText[begin:end], text[begin:end])
+        self.assertEqual(shadowText[:], text)
+        if len(text) > 0:
+            self.assertEqual(shadowText[-1], text[-1])
+
+
+    def test_editsMatchString(self):
+        text = testutil.randomText(self.rand, 500)
+        shadowText = shadow.ShadowText(text)
+        self.assertSameText(shadowText, text)
+        for i in range(2000):
+            offset = self.rand.randint(0, len(text))
+            deleteLength = self.rand.randint(0, min(40, len(text) - offset))
+            insertText = testutil.randomText(self.rand, 40)
+            shadowText.edit(offset, deleteLength, insertText)
+            text = text[:offset] + insertText + text[offset + deleteLength:]
+            self.assertSameText(shadowText, text)
+
+
+    def test_applyOps(self):
+        for i in range(200):
+            oldText = testutil.randomText(self.rand, 300)
+            newText = testutil.randomText(self.rand, 300)
+            shadowText = shadow.ShadowText(oldText)
+            shadowText.applyOps(editops.diffText(oldText, newText))
+            self.assertSameText(shadowText, newText)
+
+
+    def test_snapshotUnaffectedByEdits(self):
+        text = testutil.randomText(self.rand, 300)
+        shadowText = shadow.ShadowText(text)
+        snapshot = shadowText.snapshot()
+        for i in range(100):
+            offset = self.rand.randint(0, len(shadowText))
+            shadowText.edit(offset, min(5, len(shadowText) - offset), testutil.randomText(self.rand, 5))
+        self.assertSameText(snapshot, text)
+
+
+    def test_emptyText(self):
+        shadowText = shadow.ShadowText()
+        self.assertSameText(shadowText, u'')
+        shadowText.edit(0, 0, u'abc')
+        shadowText.edit(0, 3, u'')
+        self.assertSameText(shadowText, u'')
+
+
+    def test_editOutOfBounds(self):
+        shadowText = shadow.ShadowText(u'abc')
+        self.assertRaises(ValueError, shadowText.edit, 2, 2, u'')
+        self.assertRaises(ValueError, shadowText.edit, -1, 0, u'x')
+        self.assertSameText(shadowText, u'abc')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+"""
+Setup and random generators shared by the randomized tests next to this module.
+
+The tests run as scripts, with the python 2 the plugin runs on, from the root of
+the package:
+
+    python libs/sub_collab/peer/test_delta.py
+
+Importing this module first puts the plugin libs on the path, so that the tests
+import sub_collab as the plugin does.
+"""
+import os, sys
+
+LIBS_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+if LIBS_DIR not in sys.path:
+    sys.path.insert(0, LIBS_DIR)
+
+# newlines, spaces and multi-byte characters, from few letters so that texts repeat
+ALPHABET = u'ab\n \xe9\u4e2d'
+
+
+def randomText(rand, maxLength):
+    """
+    @param rand: C{random.Random} of the test
+
+    @return: C{unicode} text of up to maxLength characters of ALPHABET
+    """
+    return u''.join([rand.choice(ALPHABET) for i in range(rand.randint(0, maxLength))])
+
+
+def randomEdit(rand, text, maxLength=20):
+    """
+    Edit text in a random place, deleting and inserting up to maxLength characters.
+
+    @return: (offset, deleteLength, insertText) tuple
+    """
+    offset = rand.randint(0, len(text))
+    deleteLength = rand.randint(0, min(maxLength, len(text) - offset))
+    return (offset, deleteLength, randomText(rand, maxLength))
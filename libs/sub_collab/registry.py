@@ -35,8 +35,17 @@ class Registry(object):
         self.negotiators = {}
         # nested session map: negotiator key -> peer username -> set(session)
         self.sessionsByUserByNegotiator = {}
-        # sessions by view id
+        # sessions by view id, replaced rather than modified so it can be read without the lock
         self.sessionsByViewId = {}
+        # all registered sessions, replaced rather than modified like sessionsByViewId
+        self.sessions = ()
+        # reverse indexes: session -> (negotiator key, peer username) and session -> set(view id)
+        self.keysBySession = {}
+        self.viewIdsBySession = {}
+        # state callback name -> callable, see addStateCallback()
+        self.stateCallbacks = {}
+        # taken by everything that modifies the sessions
+        self.lock = threading.RLock()
 
 
     def buildNegotiatorKey(self, protocol, config):
@@ -149,66 +158,128 @@ class Registry(object):
     def registerSession(self, session):
         negotiatorKey = session.getParentNegotiatorKey()
         peerUser = session.sharingWithUser
-        if negotiatorKey in self.sessionsByUserByNegotiator:
-            if peerUser in self.sessionsByUserByNegotiator[negotiatorKey]:
-                existingSessions = self.sessionsByUserByNegotiator[negotiatorKey][peerUser]
-                if session in existingSessions:
-                    if hasattr(session, 'view') and session.view:
-                        self.logger.warn('already collaborating on %s with %s' % (session.view.file_name(), peerUser))
-                    else:
-                        self.logger.debug('attempt to register already existing session with %s but without a set view' % peerUser)
+        self.lock.acquire()
+        try:
+            if session in self.keysBySession:
+                if hasattr(session, 'view') and session.view:
+                    self.logger.warn('already collaborating on %s with %s' % (session.view.file_name(), peerUser))
                 else:
-                    existingSessions.add(session)
-            else:
-                self.sessionsByUserByNegotiator[negotiatorKey] = {peerUser: set([session])}
-        else:
-            self.sessionsByUserByNegotiator[negotiatorKey] = {peerUser: set([session])}
+                    self.logger.debug('attempt to register already existing session with %s but without a set view' % peerUser)
+                return
+            self.keysBySession[session] = (negotiatorKey, peerUser)
+            self.sessionsByUserByNegotiator.setdefault(negotiatorKey, {}).setdefault(peerUser, set()).add(session)
+            self.sessions = self.sessions + (session,)
+        finally:
+            self.lock.release()
 
 
     def registerSessionByView(self, view, session):
-        if view.id() in self.sessionsByViewId:
-            self.logger.warn('already sharing view %s with %s' % (view.file_name(), session.str()))
-        else:
-            self.sessionsByViewId[view.id()] = session
+        self.lock.acquire()
+        try:
+            if view.id() in self.sessionsByViewId:
+                self.logger.warn('already sharing view %s with %s' % (view.file_name(), session.str()))
+                return
+            # copy-on-write, readers only ever see a complete map
+            sessionsByViewId = self.sessionsByViewId.copy()
+            sessionsByViewId[view.id()] = session
+            self.sessionsByViewId = sessionsByViewId
+            self.viewIdsBySession.setdefault(session, set()).add(view.id())
+        finally:
+            self.lock.release()
 
 
     def hasSession(self, negotiatorKey, peerUser):
-        return negotiatorKey in self.sessionsByUserByNegotiator and peerUser in self.sessionsByUserByNegotiator[negotiatorKey]
+        return len(self.getSessionsByNegotiatorAndPeer(negotiatorKey, peerUser) or ()) > 0
 
 
     def getSessionsByNegotiatorAndPeer(self, negotiatorKey, peerUser):
         sessions = None
-        if negotiatorKey in self.sessionsByUserByNegotiator:
-            sessions = self.sessionsByUserByNegotiator[negotiatorKey].get(peerUser)
+        self.lock.acquire()
+        try:
+            if negotiatorKey in self.sessionsByUserByNegotiator:
+                sessions = self.sessionsByUserByNegotiator[negotiatorKey].get(peerUser)
+                if sessions is not None:
+                    sessions = set(sessions)
+        finally:
+            self.lock.release()
         return sessions
 
 
     def getSessionByView(self, view):
+        # called on every modification and selection change, so no locking here
         return self.sessionsByViewId.get(view.id())
 
 
+    def isRegistered(self, session):
+        return (session in self.keysBySession) or (session in self.viewIdsBySession)
+
+
     def listSessions(self):
-        sessions = []
-        for sessionsByUser in self.sessionsByUserByNegotiator.itervalues():
-            for userSessions in sessionsByUser.itervalues():
-                sessions += userSessions
-        return sessions
+        return list(self.sessions)
 
 
     def removeSession(self, session):
         """
         Remove a session from both session registries.
         """
-        negotiatorKey = session.getParentNegotiatorKey()
-        peerUser = session.sharingWithUser
-        if negotiatorKey in self.sessionsByUserByNegotiator:
-            sessionsByUser = self.sessionsByUserByNegotiator[negotiatorKey]
-            if peerUser in sessionsByUser:
-                sessionsByUser[peerUser].discard(session)
-        if session in self.sessionsByViewId.values():
-            for viewId, registeredSession in self.sessionsByViewId.items():
-                if session == registeredSession:
-                    self.sessionsByViewId.pop(viewId, None)
+        self.lock.acquire()
+        try:
+            keys = self.keysBySession.pop(session, None)
+            if keys is not None:
+                negotiatorKey, peerUser = keys
+                sessionsByUser = self.sessionsByUserByNegotiator.get(negotiatorKey, {})
+                userSessions = sessionsByUser.get(peerUser, set())
+                userSessions.discard(session)
+                if len(userSessions) == 0:
+                    sessionsByUser.pop(peerUser, None)
+                if len(sessionsByUser) == 0:
+                    self.sessionsByUserByNegotiator.pop(negotiatorKey, None)
+                self.sessions = tuple([registered for registered in self.sessions if registered is not session])
+            viewIds = self.viewIdsBySession.pop(session, None)
+            if viewIds:
+                sessionsByViewId = self.sessionsByViewId.copy()
+                for viewId in viewIds:
+                    if sessionsByViewId.get(viewId) is session:
+                        del sessionsByViewId[viewId]
+                self.sessionsByViewId = sessionsByViewId
+        finally:
+            self.lock.release()
+
+
+    def addStateCallback(self, name, callback):
+        """
+        Registers a callable to be called as callback(session, previousState, state)
+        each time a session changes state.  Registering again under the same name
+        replaces the earlier callback, so reloading a plugin module does not stack them up.
+        """
+        self.lock.acquire()
+        try:
+            stateCallbacks = self.stateCallbacks.copy()
+            stateCallbacks[name] = callback
+            self.stateCallbacks = stateCallbacks
+        finally:
+            self.lock.release()
+
+
+    def removeStateCallback(self, name):
+        self.lock.acquire()
+        try:
+            stateCallbacks = self.stateCallbacks.copy()
+            stateCallbacks.pop(name, None)
+            self.stateCallbacks = stateCallbacks
+        finally:
+            self.lock.release()
+
+
+    def sessionStateChanged(self, session, previousState, state):
+        """
+        Called by the sessions themselves on every change of their state.
+        """
+        for name, callback in self.stateCallbacks.items():
+            try:
+                callback(session, previousState, state)
+            except Exception:
+                self.logger.exception('state callback %s failed for %s' % (name, session.str()))
 
 
 ##################################################
@@ -0,0 +1,578 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+
+#   Copyright (c) 2012 Nick Lloyd
+
+#   Permission is hereby granted, free of charge, to any person obtaining a copy
+#   of this software and associated documentation files (the "Software"), to deal
+#   in the Software without restriction, including without limitation the rights
+#   to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#   copies of the Software, and to permit persons to whom the Software is
+#   furnished to do so, subject to the following conditions:
+
+#   The above copyright notice and this permission notice shall be included in
+#   all copies or substantial portions of the Software.
+
+#   THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#   IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#   FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#   AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHE`R
+#   LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#   OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+#   THE SOFTWARE.
+from sub_collab.peer import base, editops, hashtree, regions, shadow, stream
+from twisted.internet import protocol
+from twisted.protocols import basic
+from twisted.application import internet
+from twisted.python import usage
+import logging, struct, zlib
+
+# Relay hub for sessions between peers that cannot connect to each other directly.
+#
+# Hosts and partners both connect to the relay and name the room they join in a
+# RELAY_JOIN message, sent ahead of the usual CONNECTED handshake.  Towards the
+# host of a room the relay acts as its partner, keeping a copy of the shared view
+# up to date.  Towards the partners of a room it acts as the host: late joiners
+# are sent that copy by the relay, and every frame from the host is written to all
+# partners as received.  Partners are view-only, roles cannot be swapped.
+#
+# Nothing in here depends on Sublime Text, the relay runs as a twistd plugin:
+#
+#     PYTHONPATH=libs twistd -n sub-collab-relay --port 6789
+
+
+DEFAULT_PORT = 6789
+
+# in bytes, most data a partner may fall behind by before it is sent a new snapshot instead
+MAX_PARTNER_BACKLOG = 1048576
+
+# frames from the host are relayed to all partners as they are, so every connection
+# needs to agree on how they are encoded
+REQUIRED_FEATURES = frozenset([base.FEATURE_MERKLE, base.FEATURE_PACKED_REGIONS])
+OFFERED_FEATURES = REQUIRED_FEATURES | frozenset([base.FEATURE_ZLIB])
+
+COMPRESSION_LEVEL = 6
+
+
+class Room(object):
+    """
+    A view shared by one host with any number of partners through the relay.
+    """
+    logger = logging.getLogger('SubliminalCollaborator.relay.Room')
+
+
+    def __init__(self, name):
+        self.name = name
+        self.host = None
+        self.partners = set()
+        # shared view contents, C{shadow.ShadowText} edited in place, None until the host has sent the view
+        self.text = None
+        self.viewName = 'NONAME'
+        self.syntax = ''
+        self.tree = hashtree.HashTree()
+        # view chunks of a (re)share being received from the host
+        self.chunks = None
+        # last selection of the host, the basis of the next packed selection difference
+        self.selection = None
+        # last POSITION frame of the host, sent to late joiners
+        self.positionData = None
+
+
+    def isEmpty(self):
+        return (self.host is None) and (len(self.partners) == 0)
+
+
+    def isReady(self):
+        return (self.text is not None) and (self.chunks is None)
+
+
+    #*** host side ***#
+
+    def beginView(self, viewName=None):
+        self.chunks = []
+        if viewName is not None:
+            self.viewName = viewName
+
+
+    def addViewChunk(self, chunk):
+        self.chunks.append(chunk)
+
+
+    def endView(self, syntax):
+        self.text = shadow.ShadowText(u''.join(self.chunks))
+        self.chunks = None
+        self.syntax = syntax
+        self.tree.invalidate()
+        self.logger.info('Room %s has a %d character view' % (self.name, len(self.text)))
+        for partner in self.partners:
+            self.sendSnapshot(partner)
+
+
+    def applyEdit(self, payload):
+        """
+        Apply an EDIT_TYPE_OPS payload to the view copy.
+
+        @return: True if the edit applies to the view copy
+        """
+        ops = editops.decodeOps(payload)
+        for offset, deleteLength, insertText in ops:
+            if offset + deleteLength > len(self.text):
+                return False
+            self.tree.markEdit(offset, self.text[offset:offset + deleteLength], insertText)
+            self.text.edit(offset, deleteLength, insertText)
+        return True
+
+
+    def checkViewSync(self, state):
+        """
+        @return: True if the view copy matches the host tree state
+        """
+        self.tree.update(self.text)
+        return self.tree.state() == state
+
+
+    def relay(self, data):
+        """
+        Write a length-prefixed frame from the host to all partners.
+        """
+        for partner in list(self.partners):
+            partner.relayFrame(data)
+
+
+    #*** partner side ***#
+
+    def sendSnapshot(self, partner):
+        if not self.isReady():
+            # sent once the view from the host is complete
+            return
+        partner.beginSnapshot(self.text.snapshot(), self.selection, self.positionData)
+
+
+    def currentText(self):
+        return self.text
+
+
+    def currentTree(self):
+        self.tree.update(self.text)
+        return self.tree
+
+
+class RelayConnection(basic.Int32StringReceiver):
+    """
+    Connection of a single host or partner to the relay, speaking the
+    C{sub_collab.peer.basic.BasicPeer} wire protocol.
+    """
+    logger = logging.getLogger('SubliminalCollaborator.relay.RelayConnection')
+
+    messageHeaderFmt = '!HBB'
+    messageHeaderSize = struct.calcsize(messageHeaderFmt)
+
+    MAX_LENGTH = 16 * 1024 * 1024
+
+
+    def __init__(self, hub):
+        self.hub = hub
+        self.room = None
+        self.role = None
+        self.sharingWithUser = 'unknown'
+        self.features = set()
+        self.connected = False
+        self.streamProducers = stream.StreamProducerGroup()
+        # host side, incoming view stream
+        self.viewDecompressor = None
+        # partner side, outgoing view stream and the frames relayed to it
+        self.viewStreamProducer = None
+        self.viewCompressor = None
+        self.toAck = None
+        self.ackdChunks = None
+        self.follower = stream.FollowerStream(self, MAX_PARTNER_BACKLOG)
+
+
+    def str(self):
+        return '%s %s of room %s' % (self.role, self.sharingWithUser, self.room and self.room.name)
+
+
+    def isHost(self):
+        return (self.room is not None) and (self.room.host is self)
+
+
+    #*** writing ***#
+
+    def writeMessage(self, messageType, messageSubType=base.EDIT_TYPE_NA, payload=''):
+        if isinstance(payload, unicode):
+            payload = payload.encode('utf-8')
+        frame = struct.pack(self.messageHeaderFmt, base.MAGIC_NUMBER, messageType, messageSubType) + payload
+        self.writeData(struct.pack(self.structFormat, len(frame)) + frame)
+
+
+    def writeData(self, data):
+        if not self.connected:
+            return
+        self.follower.write(data)
+
+
+    def close(self):
+        self.writeMessage(base.DISCONNECT)
+        # nothing more is sent or handled, frames already received included
+        self.connected = False
+        self.transport.loseConnection()
+
+
+    def protocolError(self, problem):
+        self.logger.warn('Dropping %s, %s' % (self.str(), problem))
+        self.close()
+
+
+    #*** partner side frame relaying and snapshots ***#
+
+    def relayFrame(self, data):
+        self.follower.sendFrame(data)
+
+
+    def requestSnapshot(self):
+        if self.room is not None:
+            self.room.sendSnapshot(self)
+
+
+    def frameData(self, messageType, payload):
+        frame = struct.pack(self.messageHeaderFmt, base.MAGIC_NUMBER, messageType, base.EDIT_TYPE_NA) + payload
+        return struct.pack(self.structFormat, len(frame)) + frame
+
+
+    def beginSnapshot(self, text, selection, positionData):
+        """
+        Send the partner the view of its room, relayed frames are held back until
+        the partner acknowledges it.
+
+        @param text: C{shadow.ShadowText} view contents the following relayed frames apply to
+        @param selection: C{list} of (a, b) tuples the next relayed selection is a difference to, or None
+        @param positionData: C{str} last POSITION frame of the host, or None
+        """
+        if self.follower.watching:
+            messageType = base.RESHARE_VIEW
+            payload = str(len(text))
+        else:
+            messageType = base.SHARE_VIEW
+            payload = '%s|%d' % (self.room.viewName, len(text))
+        frames = []
+        if selection is not None:
+            frames.append(self.frameData(base.SELECTION, regions.encodeSelection(selection, None)))
+        if positionData is not None:
+            frames.append(positionData)
+        if not self.follower.beginSnapshot(frames):
+            return
+        self.toAck = []
+        if base.FEATURE_ZLIB in self.features:
+            self.viewCompressor = zlib.compressobj(COMPRESSION_LEVEL)
+            chunkSize = stream.MAX_COMPRESSED_CHUNK_SIZE
+        else:
+            self.viewCompressor = None
+            chunkSize = stream.MAX_CHUNK_SIZE
+        self.writeMessage(messageType, payload=payload)
+        self.viewStreamProducer = stream.ViewStreamProducer(self, text, chunkSize, self.room.syntax, self.endViewStream)
+        self.viewStreamProducer.start()
+
+
+    def sendViewChunk(self, chunk):
+        payload = chunk.encode('utf-8')
+        if self.viewCompressor is not None:
+            payload = self.viewCompressor.compress(payload) + self.viewCompressor.flush(zlib.Z_SYNC_FLUSH)
+        self.toAck.append(len(payload))
+        self.writeMessage(base.VIEW_CHUNK, payload=payload)
+        return len(payload)
+
+
+    def viewStreamProgress(self, sent, total):
+        pass
+
+
+    def endViewStream(self):
+        self.viewStreamProducer = None
+        self.viewCompressor = None
+
+
+    #*** protocol.Protocol method implementations ***#
+
+    def connectionMade(self):
+        self.connected = True
+        self.sharingWithUser = self.transport.getPeer().host
+        self.transport.registerProducer(self.streamProducers, True)
+        self.streamProducers.add(stream.BacklogProducer(self.follower))
+
+
+    def connectionLost(self, reason):
+        self.connected = False
+        self.follower.reset()
+        self.endViewStream()
+        if self.room is not None:
+            self.hub.leave(self)
+
+
+    def stringReceived(self, data):
+        if not self.connected:
+            return
+        if len(data) < self.messageHeaderSize:
+            self.protocolError('frame of %d bytes is too short' % len(data))
+            return
+        magicNumber, msgTypeNum, msgSubTypeNum = struct.unpack(self.messageHeaderFmt, data[:self.messageHeaderSize])
+        if magicNumber != base.MAGIC_NUMBER:
+            self.logger.warn('Dropping %s, not a collaboration peer' % self.sharingWithUser)
+            self.transport.loseConnection()
+            return
+        msgType = base.numeric_to_symbolic.get(msgTypeNum)
+        method = getattr(self, 'recvd_%s' % msgType, None)
+        if method is None:
+            self.logger.debug('Ignoring %s message from %s' % (msgType, self.str()))
+            return
+        try:
+            method(msgSubTypeNum, data, data[self.messageHeaderSize:])
+        except (ValueError, IndexError, struct.error, zlib.error), e:
+            # payloads are decoded as they are handled, anyone may connect to the relay
+            self.protocolError('malformed %s message: %s' % (msgType, e))
+
+
+    #*** messages from either side ***#
+
+    def recvd_RELAY_JOIN(self, messageSubType, data, payload):
+        if not '|' in payload:
+            self.protocolError('no room named to join')
+            return
+        role, roomName = payload.split('|', 1)
+        if (self.room is not None) or (not self.hub.join(self, role, roomName)):
+            self.close()
+
+
+    def recvd_CONNECTED(self, messageSubType, data, payload):
+        features = set([feature for feature in payload.split(',') if feature])
+        self.features = OFFERED_FEATURES & features
+        self.writeMessage(base.CONNECTED, payload=','.join(sorted(self.features)))
+        if self.room is None:
+            self.logger.warn('%s did not join a room' % self.sharingWithUser)
+            self.close()
+        elif not REQUIRED_FEATURES.issubset(self.features):
+            self.logger.warn('%s does not support relayed sessions' % self.str())
+            self.close()
+        elif not self.isHost():
+            self.room.sendSnapshot(self)
+
+
+    def recvd_DISCONNECT(self, messageSubType, data, payload):
+        self.transport.loseConnection()
+
+
+    def recvd_SWAP_ROLE(self, messageSubType, data, payload):
+        self.writeMessage(base.SWAP_ROLE_NACK)
+
+
+    #*** messages from the host ***#
+
+    def recvd_SHARE_VIEW(self, messageSubType, data, payload):
+        if not self.isHost():
+            return
+        self.resetViewDecompressor()
+        self.writeMessage(base.SHARE_VIEW_ACK)
+        self.room.beginView(payload.split('|')[0])
+
+
+    def recvd_RESHARE_VIEW(self, messageSubType, data, payload):
+        if not self.isHost():
+            return
+        self.resetViewDecompressor()
+        self.writeMessage(base.SHARE_VIEW_ACK)
+        self.room.beginView()
+
+
+    def resetViewDecompressor(self):
+        if base.FEATURE_ZLIB in self.features:
+            self.viewDecompressor = zlib.decompressobj()
+        else:
+            self.viewDecompressor = None
+
+
+    def recvd_VIEW_CHUNK(self, messageSubType, data, payload):
+        if (not self.isHost()) or (self.room.chunks is None):
+            return
+        self.writeMessage(base.VIEW_CHUNK_ACK, payload=str(len(payload)))
+        if self.viewDecompressor is not None:
+            payload = self.viewDecompressor.decompress(payload)
+        self.room.addViewChunk(payload.decode('utf-8'))
+
+
+    def recvd_END_OF_VIEW(self, messageSubType, data, payload):
+        if (not self.isHost()) or (self.room.chunks is None):
+            return
+        self.viewDecompressor = None
+        self.writeMessage(base.END_OF_VIEW_ACK)
+        self.room.endView(payload)
+
+
+    def recvd_EDIT(self, messageSubType, data, payload):
+        if (not self.isHost()) or (not self.room.isReady()):
+            return
+        if (messageSubType != base.EDIT_TYPE_OPS) or (not self.room.applyEdit(payload)):
+            self.requestResync()
+            return
+        self.room.relay(struct.pack(self.structFormat, len(data)) + data)
+
+
+    def recvd_SELECTION(self, messageSubType, data, payload):
+        if not self.isHost():
+            return
+        if (payload[:1] == regions.SELECTION_DIFF) and (self.room.selection is None):
+            self.protocolError('selection difference without a selection to apply it to')
+            return
+        # kept up to date even while the view is resent, the next selection may be a difference to this one
+        self.room.selection = regions.decodeSelection(payload, self.room.selection)
+        if self.room.isReady():
+            self.room.relay(struct.pack(self.structFormat, len(data)) + data)
+
+
+    def recvd_POSITION(self, messageSubType, data, payload):
+        if not self.isHost():
+            return
+        self.room.positionData = struct.pack(self.structFormat, len(data)) + data
+        if self.room.isReady():
+            self.room.relay(self.room.positionData)
+
+
+    def recvd_VIEW_SYNC(self, messageSubType, data, payload):
+        if (not self.isHost()) or (not self.room.isReady()):
+            return
+        if not self.room.checkViewSync(payload):
+            self.requestResync()
+            return
+        self.room.relay(struct.pack(self.structFormat, len(data)) + data)
+
+
+    def requestResync(self):
+        """
+        The view copy of the room is out of sync with the host, ask for the whole view.
+        """
+        self.logger.info('View of room %s out of sync, requesting it from the host' % self.room.name)
+        self.room.beginView()
+        self.writeMessage(base.VIEW_RESYNC)
+
+
+    #*** messages from partners ***#
+
+    def recvd_SHARE_VIEW_ACK(self, messageSubType, data, payload):
+        self.ackdChunks = []
+
+
+    def recvd_VIEW_CHUNK_ACK(self, messageSubType, data, payload):
+        if self.ackdChunks is None:
+            self.protocolError('view chunk acknowledged before the view share')
+            return
+        ackdChunkSize = int(payload)
+        self.ackdChunks.append(ackdChunkSize)
+        if self.viewStreamProducer is not None:
+            self.viewStreamProducer.chunkAcked(ackdChunkSize)
+
+
+    def recvd_END_OF_VIEW_ACK(self, messageSubType, data, payload):
+        if (self.follower.heldFrames is None) or (self.ackdChunks is None):
+            self.protocolError('view acknowledged before it was sent')
+            return
+        if self.toAck == self.ackdChunks:
+            self.toAck = None
+            self.ackdChunks = None
+            self.follower.endSnapshot()
+        else:
+            self.logger.error('Sent %s chunks of data to %s but it received %s chunks of data' % (self.toAck, self.str(), self.ackdChunks))
+            self.writeMessage(base.BAD_VIEW_SEND)
+            self.close()
+
+
+    def recvd_VIEW_RESYNC(self, messageSubType, data, payload):
+        self.answerQuery(base.VIEW_RESYNC, payload)
+
+
+    def recvd_VIEW_TREE_QUERY(self, messageSubType, data, payload):
+        self.answerQuery(base.VIEW_TREE_QUERY, payload)
+
+
+    def recvd_VIEW_RANGE_QUERY(self, messageSubType, data, payload):
+        self.answerQuery(base.VIEW_RANGE_QUERY, payload)
+
+
+    def answerQuery(self, messageType, payload):
+        if (self.room is None) or (not self.room.isReady()):
+            return
+        compressionLevel = None
+        if base.FEATURE_ZLIB in self.features:
+            compressionLevel = COMPRESSION_LEVEL
+        reply = self.follower.answerQuery(messageType, payload, self.room, compressionLevel, self.MAX_LENGTH - self.messageHeaderSize)
+        if reply is not None:
+            self.writeMessage(reply[0], payload=reply[1])
+
+
+class RelayHub(protocol.ServerFactory):
+    """
+    Accepts host and partner connections and keeps the rooms they join.
+    """
+    logger = logging.getLogger('SubliminalCollaborator.relay.RelayHub')
+
+
+    def __init__(self):
+        self.rooms = {}
+
+
+    def buildProtocol(self, addr):
+        return RelayConnection(self)
+
+
+    def join(self, connection, role, roomName):
+        """
+        @return: True if the connection joined the room with the given name in the given role
+        """
+        room = self.rooms.get(roomName)
+        if room is None:
+            room = Room(roomName)
+            self.rooms[roomName] = room
+        if role == base.HOST_ROLE:
+            if room.host is not None:
+                self.logger.warn('Room %s already has a host, refusing %s' % (roomName, connection.sharingWithUser))
+                return False
+            room.host = connection
+        elif role == base.PARTNER_ROLE:
+            room.partners.add(connection)
+        else:
+            return False
+        connection.room = room
+        connection.role = role
+        self.logger.info('%s joined' % connection.str())
+        return True
+
+
+    def leave(self, connection):
+        room = connection.room
+        connection.room = None
+        self.logger.info('%s %s left room %s' % (connection.role, connection.sharingWithUser, room.name))
+        if room.host is connection:
+            # the partners have nothing left to follow
+            room.host = None
+            for partner in list(room.partners):
+                partner.close()
+            room.text = None
+            room.chunks = None
+        else:
+            room.partners.discard(connection)
+        if room.isEmpty():
+            del self.rooms[room.name]
+
+
+#*** twistd plugin support, see twisted.plugins.sub_collab_relay ***#
+
+class Options(usage.Options):
+    synopsis = '[options]'
+    longdesc = 'Relay hub for SubliminalCollaborator sessions.'
+    optParameters = [
+        ['port', 'p', DEFAULT_PORT, 'Port to listen on for hosts and partners.', int],
+        ['interface', 'i', '', 'Interface to listen on, all by default.'],
+        ['max-backlog', None, MAX_PARTNER_BACKLOG, 'Bytes a partner may fall behind by before it is sent the view again.', int],
+    ]
+
+
+def makeService(config):
+    global MAX_PARTNER_BACKLOG
+    MAX_PARTNER_BACKLOG = config['max-backlog']
+    return internet.TCPServer(config['port'], RelayHub(), interface=config['interface'])
@@ -23,79 +23,130 @@
 import sublime
 import threading
 import time
-import functools
 
 MESSAGE_FORMAT = 'Collaboration[ %s ]'
 PROGRESS_FORMAT = 'Collaboration[ %s ][%s]'
 HEARTBEAT_FORMAT = 'Collaboration[ %s ][%s-%s]'
 
+# milliseconds between frames of the heartbeat animation
+HEARTBEAT_FRAME_MS = 100
+# seconds without traffic after which the heartbeat stops animating
+HEARTBEAT_IDLE_SECONDS = 1.0
+# width of the heartbeat animation
+HEARTBEAT_SIZE = 6
+
 currentMessage = ''
 isHeartbeatMessage = False
 messageLock = threading.Lock()
+# set while a call to publish_pending() is scheduled
+publishScheduled = False
+# set while the heartbeat animation is running
+heartbeatAnimating = False
+# time of the latest heartbeat_message() call
+lastHeartbeat = 0
+heartbeatPosition = 0
+heartbeatStep = 1
 
 '''
-Thread to maintain the current status message, preventing other plugins from overwriting
-the status.
+Messages are published to the status bar on the main thread, and only when
+they change: any number of updates between two publishes are coalesced into
+one.  Heartbeat messages animate for as long as heartbeats keep coming in,
+and once traffic stops the plain message is left in place and nothing runs
+until the next update.
 '''
-class StatusMaintainingPublisherThread(threading.Thread):
-    def __init__(self):
-        self.size = 6
-        self.addend = 1
-        self.i = 0
-        threading.Thread.__init__(self)
-        
-    def next_heartbeat_message(self):
-        global currentMessage
-        before = self.i % self.size
-        after = (self.size - 1) - before
-        message = HEARTBEAT_FORMAT % \
-            (currentMessage, ' ' * before, ' ' * after)
-        if not after:
-            self.addend = -1
-        if not before:
-            self.addend = 1
-        self.i += self.addend
-        return message
-
-    def run(self):
-        global currentMessage
-        global isHeartbeatMessage
-        global messageLock
-        while(True):
-            messageLock.acquire()
-            if len(currentMessage) > 0:
-                message = currentMessage
-                if isHeartbeatMessage:
-                    message = self.next_heartbeat_message()
-                sublime.set_timeout(functools.partial(publish_now, message), 0)
-            messageLock.release()
-            time.sleep(0.1)
-
-
-if not 'STATUS_BAR_UPDATE_THREAD' in globals():
-    globals()['STATUS_BAR_UPDATE_THREAD'] = StatusMaintainingPublisherThread()
+
+
+def schedule_publish():
+    '''
+    Schedule publish_pending() on the main thread, unless already scheduled.
+    Called with messageLock held.
+    '''
+    global publishScheduled
+    if not publishScheduled:
+        publishScheduled = True
+        sublime.set_timeout(publish_pending, 0)
+
+
+def publish_pending():
+    global publishScheduled
+    messageLock.acquire()
+    publishScheduled = False
+    message = currentMessage
+    if isHeartbeatMessage and (len(message) > 0):
+        # heartbeat messages are kept unformatted for the animation frames
+        message = MESSAGE_FORMAT % message
+    messageLock.release()
+    publish_now(message)
+
+
+def next_heartbeat_message():
+    '''
+    Called with messageLock held.
+    '''
+    global heartbeatPosition
+    global heartbeatStep
+    before = heartbeatPosition % HEARTBEAT_SIZE
+    after = (HEARTBEAT_SIZE - 1) - before
+    if not after:
+        heartbeatStep = -1
+    if not before:
+        heartbeatStep = 1
+    heartbeatPosition += heartbeatStep
+    return HEARTBEAT_FORMAT % (currentMessage, ' ' * before, ' ' * after)
+
+
+def animate_heartbeat():
+    '''
+    Publish the next frame of the heartbeat animation, runs on the main thread.
+    '''
+    global heartbeatAnimating
+    messageLock.acquire()
+    if (not isHeartbeatMessage) or (len(currentMessage) == 0):
+        # replaced by another message in the meantime
+        heartbeatAnimating = False
+        messageLock.release()
+        return
+    if time.time() - lastHeartbeat > HEARTBEAT_IDLE_SECONDS:
+        # traffic stopped, leave the message standing still
+        heartbeatAnimating = False
+        message = MESSAGE_FORMAT % currentMessage
+    else:
+        message = next_heartbeat_message()
+        sublime.set_timeout(animate_heartbeat, HEARTBEAT_FRAME_MS)
+    messageLock.release()
+    publish_now(message)
 
 
 def publish_now(message):
     window = sublime.active_window()
     if window and window.active_view():
-        window.active_view().set_status('subliminal_collaborator', message)
-    else:
+        if len(message) > 0:
+            window.active_view().set_status('subliminal_collaborator', message)
+        else:
+            window.active_view().erase_status('subliminal_collaborator')
+    elif len(message) > 0:
         sublime.status_message(message)
 
+
+def republish():
+    '''
+    Publish the current message again, for a view that just became active.
+    '''
+    messageLock.acquire()
+    if len(currentMessage) > 0:
+        schedule_publish()
+    messageLock.release()
+
 '''
 Publish a basic status message to the status bar.
 '''
 def status_message(message):
     global currentMessage
     global isHeartbeatMessage
-    global messageLock
-    if STATUS_BAR_UPDATE_THREAD and not STATUS_BAR_UPDATE_THREAD.is_alive():
-        STATUS_BAR_UPDATE_THREAD.start()
     messageLock.acquire()
     currentMessage = MESSAGE_FORMAT % message
     isHeartbeatMessage = False
-    publish_now(currentMessage)
+    schedule_publish()
     messageLock.release()
 
 '''
@@ -105,36 +156,39 @@ Progress bar is 10 characters total.
 def progress_message(message, progress, total):
     global currentMessage
     global isHeartbeatMessage
-    global messageLock
-    if STATUS_BAR_UPDATE_THREAD and not STATUS_BAR_UPDATE_THREAD.is_alive():
-        STATUS_BAR_UPDATE_THREAD.start()
-    ticks = int(round(float(progress)/total)) * 10
+    ticks = 10
+    if total > 0:
+        ticks = min(10, int(round(float(progress) / total * 10)))
     space = 10 - ticks
     messageLock.acquire()
     currentMessage = PROGRESS_FORMAT % (message, ('=' * ticks + ' ' * space))
     isHeartbeatMessage = False
-    publish_now(currentMessage)
+    schedule_publish()
     messageLock.release()
 
 '''
-Publish a heartbeat message to the status bar.
+Publish a heartbeat message to the status bar, animated for as long as
+heartbeats keep coming in.  Cheap enough to call on every message sent or received.
 '''
 def heartbeat_message(message):
     global currentMessage
     global isHeartbeatMessage
-    global messageLock
-    if STATUS_BAR_UPDATE_THREAD and not STATUS_BAR_UPDATE_THREAD.is_alive():
-        STATUS_BAR_UPDATE_THREAD.start()
+    global heartbeatAnimating
+    global lastHeartbeat
     messageLock.acquire()
     currentMessage = message
     isHeartbeatMessage = True
+    lastHeartbeat = time.time()
+    if not heartbeatAnimating:
+        heartbeatAnimating = True
+        sublime.set_timeout(animate_heartbeat, 0)
     messageLock.release()
 
 def clear_message():
     global currentMessage
     global isHeartbeatMessage
-    global messageLock
     messageLock.acquire()
     currentMessage = ''
     isHeartbeatMessage = False
+    schedule_publish()
     messageLock.release()
@@ -0,0 +1,10 @@
+# All of SubliminalCollaborator is licensed under the MIT license.
+# See sub_collab.relay for details.
+
+from twisted.application.service import ServiceMaker
+
+SubliminalCollaboratorRelay = ServiceMaker(
+    "SubliminalCollaborator Relay",
+    "sub_collab.relay",
+    "Relay hub for SubliminalCollaborator sessions between peers that cannot connect directly.",
+    "sub-collab-relay")